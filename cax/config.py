@@ -6,9 +6,8 @@ import time
 import json
 import logging
 import os
-import pax
 import socket
-from zlib import adler32
+import threading
 import pymongo
 
 # global variable to store the specified .json config file
@@ -20,6 +19,50 @@ DATA_USER_PDC = 'bobau'
 DATA_GROUP_PDC = 'xenon-users'
 NCPU = 1
 
+# Number of run documents fetched per round trip when iterating over runs
+CURSOR_BATCH_SIZE = 100
+
+# Number of runs a task with parallelism > 1 may work on at the same time
+WORKERS = 1
+
+# Longest time in seconds buffered run updates wait before being written
+WRITE_BUFFER_DELAY = 10
+
+# Number of files of a directory hashed at the same time, and bytes read at
+# a time while hashing, see cax.digest
+DIGEST_WORKERS = 4
+DIGEST_READ_SIZE = 1024 * 1024
+
+# Whether copies with a few bad files are repaired by re-fetching those
+# files rather than purged and copied again, see cax.manifest
+REPAIR_TRANSFERS = False
+
+# SQLite file remembering the digests of unchanged files, see
+# cax.digest.ChecksumCache.  None disables the cache.
+CHECKSUM_CACHE_PATH = None
+
+# (file state, parsed config file, host configurations by name), see load_hosts
+_CONFIG_CACHE = None
+
+# Number of active ConfigWatchers.  While there are any, they decide when a
+# changed config file is loaded.
+_CONFIG_PINNED = 0
+
+# Options of the MongoClients shared by the whole process, see mongo_client.
+# Timeouts are in seconds, a socket timeout of None waits forever.
+MONGO_POOL_SIZE = 100
+MONGO_SOCKET_TIMEOUT = None
+MONGO_SERVER_SELECTION_TIMEOUT = 30
+MONGO_READ_PREFERENCE = 'secondaryPreferred'
+
+# (process id, {uri: MongoClient}, {(uri, collection name): Collection})
+_MONGO_CLIENTS = (None, {}, {})
+_MONGO_LOCK = threading.Lock()
+
+# File run updates are journaled to while the run database is unreachable,
+# see cax.journal.  None disables the journal.
+JOURNAL_PATH = None
+
 RUCIO_RSE = ''
 RUCIO_SCOPE = ''
 RUCIO_UPLOAD = None
@@ -77,19 +120,396 @@ def set_database_log(config):
     global DATABASE_LOG
     DATABASE_LOG = config
 
-def load():
+def set_cursor_batch_size(batch_size):
+    """Set the number of run documents fetched per round trip
+    """
+    global CURSOR_BATCH_SIZE
+    CURSOR_BATCH_SIZE = batch_size
+
+def set_mongo_options(pool_size=100, socket_timeout=None,
+                      server_selection_timeout=30,
+                      read_preference='secondaryPreferred'):
+    """Set the options of the runs database clients
+
+    Only clients created afterwards use them, so call this before the first
+    mongo_collection.
+    """
+    global MONGO_POOL_SIZE, MONGO_SOCKET_TIMEOUT, \
+        MONGO_SERVER_SELECTION_TIMEOUT, MONGO_READ_PREFERENCE
+    MONGO_POOL_SIZE = pool_size
+    MONGO_SOCKET_TIMEOUT = socket_timeout
+    MONGO_SERVER_SELECTION_TIMEOUT = server_selection_timeout
+    MONGO_READ_PREFERENCE = read_preference
+
+def set_workers(workers):
+    """Set the number of runs a parallel task works on at the same time
+    """
+    global WORKERS
+    WORKERS = workers
+
+
+def set_digest_options(workers=4, read_size=1024 * 1024):
+    """Set how many files of a directory are hashed at the same time, and
+    the bytes read at a time while hashing
+    """
+    global DIGEST_WORKERS, DIGEST_READ_SIZE
+    DIGEST_WORKERS = workers
+    DIGEST_READ_SIZE = read_size
+
+def set_repair_transfers(repair):
+    """Set whether copies with bad files are repaired rather than purged
+    """
+    global REPAIR_TRANSFERS
+    REPAIR_TRANSFERS = repair
+
+def set_checksum_cache(path):
+    """Set the file digests of unchanged files are remembered in, None to
+    always hash files
+    """
+    global CHECKSUM_CACHE_PATH
+    CHECKSUM_CACHE_PATH = path
+
+def set_journal(path):
+    """Set the file run updates are journaled to while the run database is
+    unreachable, None to not journal them
+    """
+    global JOURNAL_PATH
+    JOURNAL_PATH = path
+
+
+# Transfer methods CopyBase knows how to use
+TRANSFER_METHODS = ('scp', 'rsync', 'gfal-copy', 'lcg-cp', 'rucio', 'tsm')
+
+
+class TransferRoute:
+    """A host data can be uploaded to or downloaded from
+
+    Holds what a transfer needs of the remote host, resolved at load time,
+    and the base directories by data type where the data is copied to.
+    """
+    __slots__ = ('host', 'method', 'server', 'username', 'base_dirs')
+
+    def __init__(self, remote, destination):
+        self.host = remote.name
+        self.method = remote.method
+        self.server = remote.hostname
+        self.username = remote.username
+        self.base_dirs = destination.dirs
+
+
+class HostConfig:
+    """Configuration of one host in cax.json, checked and compiled"""
+    __slots__ = ('name', 'method', 'hostname', 'username', 'dirs',
+                 'data_types', 'purge', 'purge_version', 'nstreams',
+                 'grid_cert', 'upload_options', 'download_options',
+                 'upload_routes', 'download_routes')
+
+    def __init__(self, doc):
+        self.name = doc['name']
+        self.method = doc.get('method')
+        self.hostname = doc.get('hostname')
+        self.username = doc.get('username')
+
+        # e.g. dirs['raw'] from dir_raw
+        self.dirs = {key[4:]: value for key, value in doc.items()
+                     if key.startswith('dir_')}
+
+        self.data_types = doc.get('data_type')
+        self.purge = doc.get('purge')
+        self.purge_version = doc.get('pax_version_purge')
+        self.nstreams = doc.get('nstreams')
+        self.grid_cert = doc.get('grid_cert')
+        self.upload_options = doc.get('upload_options') or []
+        self.download_options = doc.get('download_options') or []
+
+        # Filled in by compile_hosts, which knows the other hosts
+        self.upload_routes = []
+        self.download_routes = []
+
+    def routes(self, transfer_kind):
+        """Transfer routes for 'upload' or 'download'"""
+        return getattr(self, '%s_routes' % transfer_kind)
+
+
+def check_host(doc):
+    """Error messages for a host configuration, empty if it is fine"""
+    errors = []
+    name = doc.get('name')
+
+    if not isinstance(name, str):
+        return ["host without a name: %s" % doc]
+
+    if doc.get('method') not in TRANSFER_METHODS + (None,):
+        errors.append("%s: unknown method %s" % (name, doc.get('method')))
+
+    for key in ('hostname', 'username', 'grid_cert', 'pax_version_purge'):
+        if not isinstance(doc.get(key), (str, type(None))):
+            errors.append("%s: %s must be a string" % (name, key))
+
+    for key in ('purge', 'nstreams'):
+        if not isinstance(doc.get(key), (int, type(None))):
+            errors.append("%s: %s must be a number" % (name, key))
+
+    for key, value in doc.items():
+        if key.startswith('dir_') and not isinstance(value, (str, type(None))):
+            errors.append("%s: %s must be a directory" % (name, key))
+
+    for key in ('upload_options', 'download_options', 'data_type'):
+        value = doc.get(key)
+        if value is not None and (not isinstance(value, list) or
+                                  not all(isinstance(v, str) for v in value)):
+            errors.append("%s: %s must be a list of names" % (name, key))
+
+    return errors
+
+
+def compile_hosts(docs):
+    """Check the parsed config file and compile its host configurations
+
+    Raises ValueError listing every problem found, so that a mistake in
+    cax.json stops cax at startup rather than in the middle of a transfer.
+    """
+    if not isinstance(docs, list):
+        raise ValueError("Config file must contain a list of hosts")
+
+    errors = []
+    for doc in docs:
+        errors.extend(check_host(doc) if isinstance(doc, dict) else
+                      ["host is not a dictionary: %s" % doc])
+    if errors:
+        raise ValueError("Invalid config file: " + "; ".join(errors))
+
+    hosts = {}
+    for doc in docs:
+        # Like a search through the file, the first entry of a host counts
+        hosts.setdefault(doc['name'], HostConfig(doc))
+
+    for host in hosts.values():
+        for kind in ('upload', 'download'):
+            for remote_name in getattr(host, '%s_options' % kind):
+                remote = hosts.get(remote_name)
+                if remote is None:
+                    errors.append("%s: unknown host %s in %s_options" %
+                                  (host.name, remote_name, kind))
+                    continue
+                if remote.method is None:
+                    errors.append("%s: no method for %s in %s_options" %
+                                  (remote.name, host.name, kind))
+                    continue
+
+                # Data goes there on upload, here on download.  Tape
+                # transfers keep their own paths.
+                destination = remote if kind == 'upload' else host
+                for data_type in (host.data_types or []
+                                  if remote.method != 'tsm' else []):
+                    if data_type not in destination.dirs:
+                        errors.append("%s: no dir_%s for %s from %s" %
+                                      (destination.name, data_type, kind,
+                                       host.name))
+
+                host.routes(kind).append(TransferRoute(remote, destination))
+
+    if errors:
+        raise ValueError("Invalid config file: " + "; ".join(errors))
+
+    return hosts
+
+
+def config_filename():
     # User-specified config file
     if CAX_CONFIGURE:
-        filename = os.path.abspath(CAX_CONFIGURE)
+        return os.path.abspath(CAX_CONFIGURE)
 
     # Default config file
-    else:
-        dirname = os.path.dirname(os.path.abspath(__file__))
-        filename = os.path.join(dirname, 'cax.json')
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(dirname, 'cax.json')
+
+
+def load_hosts():
+    """Returns the parsed config file and its host configurations by name
+
+    The file is only parsed again when its modification time or size
+    changed.  The result is shared, do not modify it.
+    """
+    cache = load_cache()
+    return cache[1], cache[2]
 
+
+def config_state(filename):
+    """What identifies a version of the config file: name, mtime and size"""
+    stat = os.stat(filename)
+    return (filename, stat.st_mtime_ns, stat.st_size)
+
+
+def read_config(filename, key):
+    """Parse and compile a config file into a cache entry, see load_cache"""
     logging.debug('Loading config file %s' % filename)
 
-    return json.loads(open(filename, 'r').read())
+    with open(filename, 'r') as f:
+        docs = json.loads(f.read())
+
+    compiled = compile_hosts(docs)
+
+    hosts = {}
+    for doc in docs:
+        # Like a search through the file, the first entry of a host counts
+        hosts.setdefault(doc['name'], doc)
+
+    return (key, docs, hosts, compiled)
+
+
+def load_cache():
+    """(file state, parsed config file, host dicts, HostConfigs by name)
+
+    While a ConfigWatcher is active, the loaded config is kept until the
+    watcher swaps in a new one.
+    """
+    global _CONFIG_CACHE
+
+    filename = config_filename()
+
+    # Read the global only once: another thread may replace it
+    cache = _CONFIG_CACHE
+    if _CONFIG_PINNED and cache is not None and cache[0][0] == filename:
+        return cache
+
+    key = config_state(filename)
+    if cache is not None and cache[0] == key:
+        return cache
+
+    _CONFIG_CACHE = read_config(filename, key)
+    return _CONFIG_CACHE
+
+
+def reload_config():
+    """Load the config file again if it changed
+
+    A config file that cannot be read or fails validation is logged and
+    the config loaded before stays in use.  Returns True if a new config
+    was swapped in.
+    """
+    global _CONFIG_CACHE
+
+    filename = config_filename()
+    cache = _CONFIG_CACHE
+    try:
+        key = config_state(filename)
+        if cache is not None and cache[0] == key:
+            return False
+        new_cache = read_config(filename, key)
+    except (OSError, ValueError) as e:
+        logging.error("Keeping the current config, %s is invalid: %s" %
+                      (filename, e))
+        return False
+
+    # A single assignment, readers see either the old or the new config
+    _CONFIG_CACHE = new_cache
+    logging.info("Loaded new config from %s" % filename)
+    return True
+
+
+class ConfigWatcher:
+    """Swaps in a new config when the config file changes
+
+    The daemons open one as a context manager around their loop, then call
+    reload() between passes so that tasks see the same config for a whole
+    pass.  File changes are noticed through inotify if the inotify_simple
+    package is installed, otherwise by polling the file modification time.
+    """
+
+    def __init__(self):
+        global _CONFIG_PINNED
+
+        # Fails right away if the config at startup is invalid
+        load_cache()
+        _CONFIG_PINNED += 1
+        self.active = True
+
+        self.inotify = None
+        self.watched = None
+        self.watch()
+
+    def watch(self):
+        """Watch the directory of the config file, editors replace files"""
+        filename = config_filename()
+        if filename == self.watched:
+            return
+
+        self.close()
+        try:
+            import inotify_simple
+        except ImportError:
+            return
+
+        flags = inotify_simple.flags
+        try:
+            self.inotify = inotify_simple.INotify()
+            self.inotify.add_watch(os.path.dirname(filename) or '.',
+                                   flags.CLOSE_WRITE | flags.MOVED_TO |
+                                   flags.CREATE)
+        except OSError as e:
+            logging.debug("No inotify, polling %s: %s" % (filename, e))
+            self.close()
+            return
+        self.watched = filename
+
+    def changed(self):
+        """Whether the config file may have changed since the last check"""
+        self.watch()
+        if self.inotify is None:
+            # Polling: compare the file state with the loaded one
+            cache = _CONFIG_CACHE
+            try:
+                return cache is None or cache[0] != config_state(config_filename())
+            except OSError:
+                return False
+
+        name = os.path.basename(self.watched)
+        return any(event.name == name
+                   for event in self.inotify.read(timeout=0))
+
+    def reload(self):
+        """Swap in the new config if the file changed, returns True if so"""
+        if not self.changed():
+            return False
+        return reload_config()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+        self.inotify = None
+        self.watched = None
+
+    def stop(self):
+        """Go back to loading the config file whenever it changed, unless
+        other watchers are still active
+        """
+        global _CONFIG_PINNED
+        self.close()
+        if self.active:
+            self.active = False
+            _CONFIG_PINNED -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def load():
+    return load_hosts()[0]
+
+
+def get_host(hostname=None):
+    """Returns the compiled HostConfig for a hostname, by default this one"""
+    if hostname is None:
+        hostname = get_hostname()
+
+    host = load_cache()[3].get(hostname)
+    if host is None:
+        raise LookupError("Unknown host %s" % hostname)
+    return host
 
 
 def purge_version(hostname=get_hostname()):
@@ -98,31 +518,26 @@ def purge_version(hostname=get_hostname()):
     in this way "vX.x.x" where X is the main pax version
     and x.x are the different relase. i.e. pax_v1.2.3
     """
-    return get_config(hostname).get('pax_version_purge',
-                                            None)
+    return get_host(hostname).purge_version
 
 
 def purge_settings(hostname=get_hostname()):
-    return get_config(hostname).get('purge',
-                                    None)
+    return get_host(hostname).purge
 
 def nstream_settings(hostname=get_hostname()):
-    return get_config(hostname).get('nstreams',
-                                    None)
+    return get_host(hostname).nstreams
 
 def get_cert(hostname=get_hostname()):
-    return get_config(hostname).get('grid_cert',
-                                    None)
+    return get_host(hostname).grid_cert
 
 def get_config(hostname=get_hostname()):
     """Returns the cax configuration for a particular hostname
-    NB this currently reloads the cax.json file every time it is called!!
     """
-    for doc in load():
-        if doc['name'] == hostname:
-            return doc
-        elif hostname == "upload_tsm":
-            return hostname
+    docs, hosts = load_hosts()
+    if hostname in hosts:
+        return hosts[hostname]
+    elif hostname == "upload_tsm" and docs:
+        return hostname
     raise LookupError("Unknown host %s" % hostname)
 
 
@@ -133,18 +548,23 @@ def get_transfer_options(transfer_kind='upload', transfer_method=None):
                      we can work using this method (e.g. scp)
     """
     try:
-        transfer_options = get_config(get_hostname())[
-            '%s_options' % transfer_kind]
+        routes = get_host().routes(transfer_kind)
     except LookupError:
         logging.info("Host %s has no known transfer options.",
                      get_hostname())
         return []
 
-    if transfer_method is not None:
-        transfer_options = [to for to in transfer_options
-                            if get_config(to['host'])['method'] == 'method']
+    return [route.host for route in routes
+            if transfer_method is None or route.method == transfer_method]
 
-    return transfer_options
+
+def pax_version():
+    """The installed pax version, e.g. 'v6.8.0'
+
+    pax takes seconds to import, so it is only imported when needed.
+    """
+    import pax
+    return 'v%s' % pax.__version__
 
 
 def get_pax_options(option_type='versions'):
@@ -176,19 +596,74 @@ def get_task_list():
 
     return options
 
+def mongo_clients():
+    """The client and collection caches of this process
+
+    MongoClients must not be shared with forked child processes, which start
+    over with empty caches.
+    """
+    global _MONGO_CLIENTS
+    if _MONGO_CLIENTS[0] != os.getpid():
+        _MONGO_CLIENTS = (os.getpid(), {}, {})
+    return _MONGO_CLIENTS
+
+
+def close_mongo_clients():
+    """Close the MongoClients of this process, e.g. when a worker finished a
+    job; the next mongo_client call connects again
+    """
+    _, clients, collections = mongo_clients()
+    with _MONGO_LOCK:
+        for client in clients.values():
+            client.close()
+        clients.clear()
+        collections.clear()
+
+
+def mongo_client(uri, **kwargs):
+    """The MongoClient for a URI, created once per process
+
+    Each client keeps its own connection pool and monitor threads, so one
+    client is shared by all tasks and threads.
+    """
+    _, clients, _ = mongo_clients()
+    client = clients.get(uri)
+    if client is not None:
+        return client
+
+    with _MONGO_LOCK:
+        client = clients.get(uri)
+        if client is None:
+            socket_timeout = MONGO_SOCKET_TIMEOUT
+            client = pymongo.MongoClient(
+                uri,
+                maxPoolSize=MONGO_POOL_SIZE,
+                socketTimeoutMS=(None if socket_timeout is None
+                                 else socket_timeout * 1000),
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT * 1000,
+                **kwargs)
+            clients[uri] = client
+    return client
+
+
 def mongo_collection(collection_name='runs_new'):
     # For the event builder to communicate with the gateway, we need to use the DAQ network address
     # Otherwise, use the internet to find the runs database
     if get_hostname().startswith('eb'):
-        c = pymongo.MongoClient('mongodb://eb:%s@gw:27017/run' % os.environ.get('MONGO_PASSWORD'))
+        uri = 'mongodb://eb:%s@gw:27017/run' % os.environ.get('MONGO_PASSWORD')
+        options = {}
     else:
         uri = RUNDB_URI
         uri = uri % os.environ.get('MONGO_PASSWORD')
-        c = pymongo.MongoClient(uri,
-                                replicaSet='runs',
-                                readPreference='secondaryPreferred')
-    db = c['run']
-    collection = db[collection_name]
+        options = dict(replicaSet='runs',
+                       readPreference=MONGO_READ_PREFERENCE)
+
+    _, _, collections = mongo_clients()
+    collection = collections.get((uri, collection_name))
+    if collection is None:
+        db = mongo_client(uri, **options)['run']
+        collection = db[collection_name]
+        collections[(uri, collection_name)] = collection
     return collection
 
 
@@ -219,7 +694,7 @@ def processing_script(args={}):
                         number=333,
                         ncpus=1 if midway else 1,
                         mem_per_cpu=2000,
-                        pax_version=(('v%s' % pax.__version__) if midway else 'head'),
+                        pax_version=(pax_version() if midway else 'head'),
                         partition='' if midway else '#SBATCH --partition=main',
 #                        partition='xenon1t' if midway else 'main',
 #                        partition='kicp' if midway else 'main',
@@ -278,10 +753,8 @@ rm -f ${{JOB_WORKING_DIR}}/pax_event_class*
     return script_template
 
 def get_base_dir(category, host):
-    destination_config = get_config(host)
-
     # Determine where data should be copied to
-    return destination_config['dir_%s' % category]
+    return get_host(host).dirs[category]
 
 
 def get_raw_base_dir(host=get_hostname()):
@@ -325,19 +798,9 @@ def get_adler32( fname ):
   """Calcualte an Adler32 checksum in python
      Used for cross checks with Rucio
   """
-  
-  BLOCKSIZE=256*1024*1024
-  asum = 1
-  with open(fname, "rb") as f:
-    while True:
-      data = f.read(BLOCKSIZE)
-      if not data:
-        break
-      asum = adler32(data, asum)
-      if asum < 0:
-        asum += 2**32
-
-  return hex(asum)[2:10].zfill(8).lower()
+  from cax import digest
+  return digest.file_digests(fname, ('adler32',),
+                             missing_ok=False)['adler32']
 
 #Rucio stuff:
 def set_rucio_rse( rucio_rse):
@@ -0,0 +1,313 @@
+"""Checksums of run data files and directories
+
+Any set of digests of a file is computed in a single pass over its data, so
+that e.g. the sha512 stored in the run database and the crc32 of the tape
+pre-test do not each read the raw data again.
+
+dirhash gives the same digest as checksumdir.dirhash, which made the
+checksums stored in the run database, but hashes the files of a directory
+concurrently: hashlib and zlib release the GIL while hashing, so threads
+keep several cores and disks busy.
+
+Digests are remembered in a ChecksumCache, if config.CHECKSUM_CACHE_PATH is
+set, so that files which did not change are not hashed again.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from cax import config
+
+# Digests that checksumdir can reduce to a directory digest
+HASH_FUNCS = {'md5': hashlib.md5,
+              'sha1': hashlib.sha1,
+              'sha256': hashlib.sha256,
+              'sha512': hashlib.sha512}
+
+
+class Checksum32:
+    """zlib checksum with the hashlib interface
+
+    hexdigest() gives the formats cax always used: lower case and zero padded
+    for adler32, like Rucio, upper case and unpadded for crc32.
+    """
+
+    def __init__(self, func, value, format):
+        self.func = func
+        self.value = value
+        self.format = format
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+    def hexdigest(self):
+        return self.format % (self.value & 0xFFFFFFFF)
+
+
+CHECKSUM_FUNCS = {'adler32': lambda: Checksum32(zlib.adler32, 1, '%08x'),
+                  'crc32': lambda: Checksum32(zlib.crc32, 0, '%X')}
+
+ALGORITHMS = dict(HASH_FUNCS, **CHECKSUM_FUNCS)
+
+
+def hash_func(algorithm):
+    try:
+        return ALGORITHMS[algorithm]
+    except KeyError:
+        raise NotImplementedError("%s not implemented." % algorithm)
+
+
+# Read buffers of each thread, reused from file to file
+_BUFFERS = threading.local()
+
+
+def read_buffer(size):
+    """This thread's buffer of 'size' bytes"""
+    buffer = getattr(_BUFFERS, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = _BUFFERS.buffer = bytearray(size)
+    return buffer
+
+
+def stream_digests(f, algorithms=('sha512',), read_size=None):
+    """Hex digests by algorithm of the rest of a binary file object
+
+    The data is read into a buffer of 'read_size' bytes, config.DIGEST_READ_SIZE
+    by default, reused for every block and file, so memory use does not
+    depend on the file.
+    """
+    hashers = [(algorithm, hash_func(algorithm)()) for algorithm in algorithms]
+    buffer = read_buffer(read_size or config.DIGEST_READ_SIZE)
+    view = memoryview(buffer)
+
+    while True:
+        n = f.readinto(buffer)
+        if not n:
+            break
+        for _, hasher in hashers:
+            hasher.update(view[:n])
+
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers}
+
+
+# Where the checksum cache is kept unless told otherwise
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cax',
+                                  'checksums.sqlite')
+
+# Files modified less than this many seconds before they were hashed may
+# still be written to within the same mtime, their digests are not cached
+RACY_SECONDS = 2
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (device INTEGER, inode INTEGER,
+                                    algorithm TEXT, size INTEGER,
+                                    mtime INTEGER, digest TEXT,
+                                    PRIMARY KEY (device, inode, algorithm));
+"""
+
+
+class ChecksumCache:
+    """SQLite file of digests by file identity and modification
+
+    Entries are keyed by (device, inode) and only used while the size and
+    the mtime of the file are unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(CACHE_SCHEMA)
+
+    def get(self, stat, algorithms):
+        """Cached digests by algorithm of a file with this os.stat result"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT algorithm, digest FROM digests WHERE device = ? AND '
+                'inode = ? AND size = ? AND mtime = ?',
+                (stat.st_dev, stat.st_ino, stat.st_size,
+                 stat.st_mtime_ns)).fetchall()
+        return {algorithm: digest for algorithm, digest in rows
+                if algorithm in algorithms}
+
+    def put(self, stat, digests):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                [(stat.st_dev, stat.st_ino, algorithm, stat.st_size,
+                  stat.st_mtime_ns, digest)
+                 for algorithm, digest in digests.items()])
+
+    def close(self):
+        self.connection.close()
+
+
+# (process id, cache) of this process, see get_cache
+_CACHE = (None, None)
+
+
+def get_cache():
+    """The ChecksumCache at config.CHECKSUM_CACHE_PATH, None if not caching"""
+    global _CACHE
+    if config.CHECKSUM_CACHE_PATH is None:
+        return None
+    pid, cache = _CACHE
+    # SQLite connections must not be used across a fork
+    if pid != os.getpid() or cache.path != config.CHECKSUM_CACHE_PATH:
+        cache = ChecksumCache(config.CHECKSUM_CACHE_PATH)
+        _CACHE = (os.getpid(), cache)
+    return cache
+
+
+def same_file(before, after):
+    return (before.st_dev, before.st_ino, before.st_size,
+            before.st_mtime_ns) == (after.st_dev, after.st_ino,
+                                    after.st_size, after.st_mtime_ns)
+
+
+def file_digests(path, algorithms=('sha512',), read_size=None,
+                 missing_ok=True):
+    """Hex digests of a file by algorithm, reading it once
+
+    Digests in the checksum cache are not computed again.  A missing file
+    has the digests of no data, like in checksumdir, unless missing_ok is
+    False: then FileNotFoundError is raised.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        if not missing_ok:
+            raise
+        return {algorithm: hash_func(algorithm)().hexdigest()
+                for algorithm in algorithms}
+
+    cache = get_cache()
+    result = cache.get(stat, algorithms) if cache is not None else {}
+    missing = [algorithm for algorithm in algorithms
+               if algorithm not in result]
+    if not missing:
+        return result
+
+    # Unbuffered: the data goes straight into our buffer
+    with open(path, 'rb', buffering=0) as f:
+        computed = stream_digests(f, missing, read_size)
+        after = os.fstat(f.fileno())
+
+    if cache is not None and same_file(stat, after) and \
+            time.time() - stat.st_mtime > RACY_SECONDS:
+        cache.put(stat, computed)
+
+    result.update(computed)
+    return result
+
+
+def filehash(path, algorithm='sha512', read_size=None):
+    """Hex digest of a file, like checksumdir._filehash"""
+    return file_digests(path, (algorithm,), read_size)[algorithm]
+
+
+def dir_files(dirname, followlinks=False):
+    """Paths of the files in a directory tree, in checksumdir order"""
+    for root, dirs, files in os.walk(dirname, topdown=True,
+                                     followlinks=followlinks):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+
+def reduce_hash(digests, algorithm='sha512'):
+    """Digest of a directory from the digests of its files"""
+    hasher = HASH_FUNCS[algorithm]()
+    for digest in sorted(digests):
+        hasher.update(digest.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class DirDigests:
+    """Digests of a directory and of each of its files
+
+    'files' lists (path relative to the directory, size, digests by algorithm)
+    in checksumdir order.  'digests' has the directory digests of the hashlib
+    algorithms, the same as checksumdir.dirhash.
+    """
+
+    def __init__(self, dirname, files, algorithms):
+        self.dirname = dirname
+        self.files = files
+        self.digests = {algorithm: reduce_hash([d[algorithm] for _, _, d in files],
+                                               algorithm)
+                        for algorithm in algorithms if algorithm in HASH_FUNCS}
+
+    def file_digests(self, algorithm):
+        """Digests of the files with one algorithm, in checksumdir order"""
+        return [digests[algorithm] for _, _, digests in self.files]
+
+    def to_doc(self):
+        """Digests as stored in a run database data entry
+
+        Algorithms without a directory digest are stored per file.
+        """
+        doc = dict(self.digests)
+        for algorithm in self.files[0][2] if self.files else ():
+            if algorithm not in doc:
+                doc[algorithm] = self.file_digests(algorithm)
+        return doc
+
+
+def dir_digests(dirname, algorithms=('sha512',), workers=None, read_size=None):
+    """DirDigests of a directory, reading each file once
+
+    Files are hashed on up to 'workers' threads, config.DIGEST_WORKERS by
+    default, reading 'read_size' bytes at a time.
+    """
+    for algorithm in algorithms:
+        hash_func(algorithm)
+    if not os.path.isdir(dirname):
+        raise TypeError("%s is not a directory." % dirname)
+
+    workers = workers or config.DIGEST_WORKERS
+    paths = list(dir_files(dirname))
+
+    def digest(path):
+        digests = file_digests(path, algorithms, read_size)
+        try:
+            return os.path.getsize(path), digests
+        except FileNotFoundError:
+            return 0, digests
+
+    if workers <= 1 or len(paths) <= 1:
+        results = list(map(digest, paths))
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            results = list(pool.map(digest, paths))
+
+    return DirDigests(dirname,
+                      [(os.path.relpath(path, dirname), size, result)
+                       for path, (size, result) in zip(paths, results)],
+                      algorithms)
+
+
+def dirhash(dirname, algorithm='sha512', workers=None, read_size=None):
+    """Hex digest of a directory, the same as checksumdir.dirhash"""
+    if algorithm not in HASH_FUNCS:
+        raise NotImplementedError("%s not implemented." % algorithm)
+    return dir_digests(dirname, (algorithm,), workers, read_size).digests[algorithm]
+
+
+def digests(location, algorithms=('sha512',), workers=None, read_size=None):
+    """Digests of a data location, file or directory, as stored in a run
+    database data entry
+    """
+    if os.path.isdir(location):
+        return dir_digests(location, algorithms, workers, read_size).to_doc()
+    return file_digests(location, algorithms, read_size)
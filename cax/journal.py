@@ -0,0 +1,429 @@
+"""Journal of run database writes made while the database is unreachable
+
+A transfer or checksum can take hours.  If the runs database cannot be
+reached when its result is written, the result used to be lost and the work
+redone.  JournaledCollection instead appends such writes to a local journal
+file, which is replayed once the database is back.  Until then, run
+documents read through the collection are overlaid with the pending writes,
+so tasks see their own progress.
+
+Replays are idempotent for the updates cax makes: $set, $unset, $pull and
+$currentDate are, and $push is journaled as $addToSet.  Several processes
+may share a journal file, access is serialized with a file lock.
+"""
+
+import contextlib
+import copy
+import datetime
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import pymongo
+from bson import json_util
+from bson.objectid import ObjectId
+
+from cax import config
+from cax.mirror import elem_matches, matches
+
+# Where the journal is kept unless told otherwise
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cax', 'write_journal.jsonl')
+
+# Errors meaning the write may not have reached the database, this
+# includes AutoReconnect and ServerSelectionTimeoutError
+CONNECTION_ERRORS = pymongo.errors.ConnectionFailure
+
+# Seconds between attempts to replay the journal before a write, while the
+# database is unreachable, so that not every write waits for a timeout
+RETRY_INTERVAL = 60
+
+JSON_OPTIONS = json_util.JSONOptions(json_mode=json_util.JSONMode.RELAXED,
+                                     tz_aware=False)
+
+# The journal of this process, see get_journal
+_JOURNAL = None
+
+
+def get_journal():
+    """The WriteJournal at config.JOURNAL_PATH, None if journaling is off"""
+    global _JOURNAL
+    if config.JOURNAL_PATH is None:
+        return None
+    if _JOURNAL is None or _JOURNAL.path != config.JOURNAL_PATH:
+        _JOURNAL = WriteJournal(config.JOURNAL_PATH)
+    return _JOURNAL
+
+
+def journaled(collection):
+    """Wrap a runs collection so its writes survive outages, if enabled"""
+    journal = get_journal()
+    if journal is None:
+        return collection
+    return JournaledCollection(collection, journal)
+
+
+def idempotent(update):
+    """The same update, safe to apply more than once"""
+    update = dict(update)
+    if '$push' in update:
+        add = dict(update.get('$addToSet', {}))
+        add.update(update.pop('$push'))
+        update['$addToSet'] = add
+    return update
+
+
+class WriteJournal:
+    """Append-only file of run database updates, one JSON line each
+
+    An update is {"id": ..., "filter": ..., "update": ..., "multi": ...}.
+    Once written to the database, {"done": id} is appended.  The file is
+    emptied when nothing is pending anymore.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.cache = (None, [])
+        # When the database was last found unreachable, None if it was not
+        self.failed_at = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Open the journal, locked against other threads and processes"""
+        with self.lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, filter, update, multi=False):
+        entry = {'id': str(ObjectId()), 'filter': filter,
+                 'update': idempotent(update), 'multi': multi,
+                 'time': datetime.datetime.utcnow()}
+        with self.locked() as f:
+            f.write(json_util.dumps(entry, json_options=JSON_OPTIONS) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return entry
+
+    def mark_done(self, f, entry_id):
+        f.write(json.dumps({'done': entry_id}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+    def pending(self):
+        """Updates not yet written to the database, oldest first"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        if stat.st_size == 0:
+            return []
+
+        # Only parse the file again when it changed
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if self.cache[0] == key:
+                return self.cache[1]
+            with self.locked() as f:
+                f.seek(0)
+                entries = self.parse(f)
+            self.cache = (key, entries)
+            return entries
+
+    def parse(self, f):
+        entries = {}
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json_util.loads(line, json_options=JSON_OPTIONS)
+            except ValueError:
+                # Torn last line of a crashed writer
+                logging.warning("Skipping corrupt line in %s" % self.path)
+                continue
+            if 'done' in entry:
+                entries.pop(entry['done'], None)
+            else:
+                entries[entry['id']] = entry
+        return list(entries.values())
+
+    def __len__(self):
+        return len(self.pending())
+
+    def replay(self, collection, log=logging):
+        """Write the pending updates to the database, in order
+
+        Stops at the first one that fails because the database is still
+        unreachable.  Updates the database rejects are logged and dropped,
+        so that they do not hold up the others.  Returns the number written.
+        """
+        if not self.pending():
+            return 0
+
+        written = 0
+        with self.locked() as f:
+            f.seek(0)
+            entries = self.parse(f)
+            for entry in entries:
+                method = 'update_many' if entry['multi'] else 'update_one'
+                try:
+                    getattr(collection, method)(entry['filter'],
+                                                entry['update'])
+                except CONNECTION_ERRORS as e:
+                    self.failed_at = time.time()
+                    log.warning("Runs database still unreachable, %d "
+                                "journaled updates pending: %s" %
+                                (len(entries) - written, e))
+                    return written
+                except pymongo.errors.PyMongoError as e:
+                    log.error("Dropping journaled update of %s: %s" %
+                              (entry['filter'], e))
+                else:
+                    written += 1
+                self.mark_done(f, entry['id'])
+
+            # Everything is written, start over with an empty file
+            f.truncate(0)
+            self.failed_at = None
+
+        log.info("Replayed %d journaled run database updates" % written)
+        return written
+
+    def overlay(self, doc, entries=None):
+        """Copy of a run document with the pending updates applied"""
+        entries = self.pending() if entries is None else entries
+        result = doc
+        for entry in entries:
+            if matches(result, entry['filter']):
+                if result is doc:
+                    result = copy.deepcopy(doc)
+                apply_update(result, entry['filter'], entry['update'])
+        return result
+
+
+class JournaledResult:
+    """Result of a write that was journaled instead of sent
+
+    Which runs it matches is only known once it is replayed, so the counts
+    are None: checks like 'result.matched_count == 0' do not fail on it.
+    """
+
+    acknowledged = False
+    journaled = True
+    matched_count = modified_count = upserted_count = upserted_id = None
+
+
+class JournaledCollection:
+    """Runs collection whose updates are journaled if the database is down
+
+    Pending updates are replayed before a new one is sent, so that the order
+    of updates is kept; if that fails, the new one is journaled behind them.
+    Read documents are overlaid with the pending updates.
+    """
+
+    def __init__(self, collection, journal, log=logging):
+        self.collection = collection
+        self.journal = journal
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def with_options(self, *args, **kwargs):
+        return JournaledCollection(self.collection.with_options(*args, **kwargs),
+                                   self.journal, self.log)
+
+    def replay(self):
+        return self.journal.replay(self.collection, log=self.log)
+
+    def overlay(self, doc):
+        return self.journal.overlay(doc)
+
+    def find(self, *args, **kwargs):
+        return OverlayCursor(self.collection.find(*args, **kwargs),
+                             self.journal)
+
+    def find_one(self, *args, **kwargs):
+        doc = self.collection.find_one(*args, **kwargs)
+        if doc is None:
+            return None
+        return self.journal.overlay(doc)
+
+    def writable(self):
+        """Whether a new write can be sent, replaying pending ones first
+
+        While the database is unreachable, replays are only retried every
+        RETRY_INTERVAL seconds.
+        """
+        if not self.journal.pending():
+            return True
+        failed_at = self.journal.failed_at
+        if failed_at is not None and time.time() - failed_at < RETRY_INTERVAL:
+            return False
+        self.replay()
+        return not self.journal.pending()
+
+    def _write(self, method, filter, update, multi, *args, **kwargs):
+        if self.writable():
+            try:
+                return getattr(self.collection, method)(filter, update,
+                                                        *args, **kwargs)
+            except CONNECTION_ERRORS as e:
+                self.journal.failed_at = time.time()
+                self.log.warning("Runs database unreachable, journaling "
+                                 "update of %s: %s" % (filter, e))
+        self.journal.append(filter, update, multi=multi)
+        return JournaledResult()
+
+    def update(self, spec, document, *args, **kwargs):
+        return self._write('update', spec, document, kwargs.get('multi', False),
+                           *args, **kwargs)
+
+    def update_one(self, filter, update, *args, **kwargs):
+        return self._write('update_one', filter, update, False,
+                           *args, **kwargs)
+
+    def update_many(self, filter, update, *args, **kwargs):
+        return self._write('update_many', filter, update, True,
+                           *args, **kwargs)
+
+    def find_one_and_update(self, filter, update, *args, **kwargs):
+        # Its result is the updated document, which cannot be known while
+        # the database is down: never journaled
+        self.writable()
+        return self.collection.find_one_and_update(filter, update,
+                                                   *args, **kwargs)
+
+    def bulk_write(self, requests, *args, **kwargs):
+        if self.writable():
+            try:
+                return self.collection.bulk_write(requests, *args, **kwargs)
+            except CONNECTION_ERRORS as e:
+                self.journal.failed_at = time.time()
+                self.log.warning("Runs database unreachable, journaling %d "
+                                 "updates: %s" % (len(requests), e))
+        for request in requests:
+            self.journal.append(request._filter, request._doc,
+                                multi=isinstance(request, pymongo.UpdateMany))
+        return JournaledResult()
+
+
+class OverlayCursor:
+    """Cursor overlaying the documents read with pending journaled updates"""
+
+    def __init__(self, cursor, journal):
+        self.cursor = cursor
+        self.journal = journal
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def batch_size(self, n):
+        self.cursor.batch_size(n)
+        return self
+
+    def __iter__(self):
+        for doc in self.cursor:
+            yield self.journal.overlay(doc)
+
+
+def apply_update(doc, filter, update):
+    """Apply a MongoDB update, of the operators cax uses, to a document"""
+    for op, fields in update.items():
+        for path, value in fields.items():
+            keys = resolve_positional(doc, filter, path.split('.'))
+            if keys is None:
+                continue
+            if op == '$set':
+                set_path(doc, keys, value)
+            elif op == '$currentDate':
+                set_path(doc, keys, datetime.datetime.utcnow())
+            elif op == '$unset':
+                parent = get_path(doc, keys[:-1])
+                if isinstance(parent, dict):
+                    parent.pop(keys[-1], None)
+            elif op in ('$push', '$addToSet'):
+                array = get_path(doc, keys)
+                if array is None:
+                    array = []
+                    set_path(doc, keys, array)
+                items = value['$each'] if isinstance(value, dict) and \
+                    '$each' in value else [value]
+                for item in items:
+                    if op == '$push' or item not in array:
+                        array.append(item)
+            elif op == '$pull':
+                array = get_path(doc, keys)
+                if isinstance(array, list):
+                    array[:] = [item for item in array
+                                if not pull_matches(item, value)]
+            else:
+                raise NotImplementedError("Cannot apply %s to a journaled "
+                                          "run" % op)
+
+
+def pull_matches(item, condition):
+    if isinstance(condition, dict):
+        return elem_matches(item, condition)
+    return item == condition
+
+
+def resolve_positional(doc, filter, keys):
+    """Replace a positional '$' in a path by the index the filter matched"""
+    if '$' not in keys:
+        return keys
+    i = keys.index('$')
+    array_path = '.'.join(keys[:i])
+    array = get_path(doc, keys[:i])
+    if not isinstance(array, list):
+        return None
+
+    conditions = []
+    for part in [filter] + list(filter.get('$and', [])):
+        for key, condition in part.items():
+            if key == array_path and isinstance(condition, dict) and \
+                    '$elemMatch' in condition:
+                conditions.append(lambda item, c=condition['$elemMatch']:
+                                  elem_matches(item, c))
+            elif key.startswith(array_path + '.'):
+                sub_path = key[len(array_path) + 1:]
+                conditions.append(lambda item, p=sub_path, c=condition:
+                                  matches(item, {p: c}))
+
+    for index, item in enumerate(array):
+        if conditions and all(condition(item) for condition in conditions):
+            return keys[:i] + [str(index)] + keys[i + 1:]
+    return None
+
+
+def get_path(doc, keys):
+    value = doc
+    for key in keys:
+        if isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        elif isinstance(value, dict):
+            value = value.get(key)
+        else:
+            return None
+    return value
+
+
+def set_path(doc, keys, value):
+    target = doc
+    for key in keys[:-1]:
+        if isinstance(target, list):
+            target = target[int(key)]
+        else:
+            target = target.setdefault(key, {})
+    if isinstance(target, list):
+        target[int(keys[-1])] = value
+    else:
+        target[keys[-1]] = value
@@ -6,17 +6,118 @@ import time
 import subprocess
 import json
 
+import pymongo
+
 from cax import __version__
-from cax import config, qsub
+from cax import config, qsub, rundb, scheduler
 
-import pax
+# The task modules, and the modules only some commands need, are imported by
+# the commands that use them: the transfer tasks need scp and paramiko
 
-from cax.tasks import checksum, clear, data_mover, process, process_hax, filesystem, tsm_mover, rucio_mover
 
-from cax.tasks import corrections
+# Seconds between checks for changed runs while the daemon sleeps
+POLL_INTERVAL = 10
 
 
-def main():
+def run_snapshot_query(specify_run):
+    """Runs loaded into the per-cycle snapshot"""
+    query = rundb.run_query(specify_run)
+    query['data'] = {'$exists': True}
+    return query
+
+
+def run_tasks(tasks, specify_run, snapshot, threads=1, schedule=None):
+    """Run one daemon cycle of tasks, independent ones concurrently"""
+
+    def run(task):
+        name = task.__class__.__name__
+
+        logging.info("Executing %s." % name)
+
+        try:
+            changed = task.go(specify_run, snapshot=snapshot)
+
+        except Exception as e:
+            logging.fatal("Exception caught from task %s" % name,
+                          exc_info=True)
+            logging.exception(e)
+            raise
+
+        if schedule is not None:
+            schedule.record(name, changed, task.backlog)
+
+    # Tasks keep the order of 'after' run by run, see Task.process_run
+    snapshot.expect(task.__class__.__name__ for task in tasks)
+    scheduler.run_task_graph(tasks, run, max_workers=threads)
+
+
+def run_daemon(tasks, specify_run, args):
+    """Run the tasks whenever the schedule says they are due"""
+    from cax import journal
+
+    tracker = None
+    if args.incremental:
+        tracker = rundb.RunChangeTracker(config.mongo_collection(),
+                                         full_interval=args.full_interval)
+
+    schedule = scheduler.AdaptiveSchedule(max_interval=args.max_interval)
+    for task in tasks:
+        schedule.add(task.__class__.__name__, task.interval, task.after)
+
+    # Pick up cax.json edits between passes, without a restart
+    with config.ConfigWatcher() as watcher:
+        while True:
+            watcher.reload()
+
+            # Send the run updates journaled while the run database was down
+            write_journal = journal.get_journal()
+            if write_journal is not None:
+                write_journal.replay(config.mongo_collection())
+
+            names = schedule.due()
+            due = [task for task in tasks if task.__class__.__name__ in names]
+
+            query = run_snapshot_query(specify_run)
+            if tracker is not None:
+                query = tracker.cycle_query(query, names)
+
+            # Load the runs once, shared by all tasks of this cycle
+            try:
+                snapshot = rundb.RunSnapshot(
+                    journal.journaled(config.mongo_collection()), query,
+                    projection=rundb.union_projection(due),
+                    batch_size=config.CURSOR_BATCH_SIZE)
+            except pymongo.errors.ConnectionFailure as e:
+                logging.warning("Run database unreachable, retrying in %d s: %s" %
+                                (POLL_INTERVAL, e))
+                if args.once:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            run_tasks(due, specify_run, snapshot, threads=args.threads,
+                      schedule=schedule)
+
+            # Decide to continue or not
+            if args.once:
+                break
+
+            wait = schedule.time_to_next_run()
+            logging.info('Sleeping %d s.' % wait)
+
+            # Wake up early if runs changed in the meantime
+            while wait > 0:
+                time.sleep(min(wait, POLL_INTERVAL))
+                if tracker is not None and tracker.poll():
+                    schedule.wake()
+                if watcher.reload():
+                    schedule.wake()
+                wait = schedule.time_to_next_run()
+
+
+def cax_parser():
+    from cax import digest, journal
+
     parser = argparse.ArgumentParser(description="Copying All kinds of XENON1T "
                                                  "data.")
     parser.add_argument('--once', action='store_true',
@@ -39,10 +140,52 @@ def main():
                         help="Select a single run using the run name")
     parser.add_argument('--host', type=str,
                         help="Host to pretend to be")
+    parser.add_argument('--incremental', action='store_true',
+                        help="After a full pass, only look at runs changed "
+                             "since the previous cycle")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of tasks run at the same time")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of runs a parallel task works on at once")
+    parser.add_argument('--journal', type=str, default=journal.DEFAULT_PATH,
+                        help="File run updates are journaled to while the "
+                             "run database is unreachable")
+    parser.add_argument('--no-journal', dest='journal', action='store_const',
+                        const=None,
+                        help="Lose run updates made while the run database "
+                             "is unreachable")
+    parser.add_argument('--checksum-cache', dest='checksum_cache', type=str,
+                        default=digest.DEFAULT_CACHE_PATH,
+                        help="File the checksums of unchanged files are "
+                             "remembered in")
+    parser.add_argument('--no-checksum-cache', dest='checksum_cache',
+                        action='store_const', const=None,
+                        help="Always checksum files anew")
+    parser.add_argument('--max-interval', dest='max_interval', type=int,
+                        default=600,
+                        help="Longest wait between passes of an idle task")
+    parser.add_argument('--full-interval', dest='full_interval', type=int,
+                        default=3600,
+                        help="Seconds between full passes in incremental mode")
     parser.add_argument('--ncpu', type=int, default=1,
                         help="Number of CPU per job")
+    parser.add_argument('--repair', action='store_true',
+                        help="Re-fetch only the bad files of a copy with a "
+                             "bad checksum, rather than all of it")
+    parser.add_argument('--digest-workers', dest='digest_workers', type=int,
+                        default=config.DIGEST_WORKERS,
+                        help="Number of files of a directory checksummed at once")
+    parser.add_argument('--digest-read-size', dest='digest_read_size', type=int,
+                        default=config.DIGEST_READ_SIZE,
+                        help="Bytes read at a time while checksumming")
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=config.CURSOR_BATCH_SIZE,
+                        help="Number of run documents fetched per round trip")
+    return parser
 
-    args = parser.parse_args()
+
+def main():
+    args = cax_parser().parse_args()
 
     if args.version:
         print(__version__)
@@ -50,25 +193,10 @@ def main():
 
     print(args.run, config.get_hostname())
 
-    if args.host:
-        config.HOST = args.host
-
     log_level = getattr(logging, args.log.upper())
     if not isinstance(log_level, int):
         raise ValueError('Invalid log level: %s' % args.log)
 
-    run_once = args.once
-    database_log = not args.disable_database_update
-
-    ncpu = args.ncpu
-    config.NCPU = ncpu
-
-    # Set information to update the run database
-    config.set_database_log(database_log)
-
-    # Check passwords and API keysspecified
-    config.mongo_password()
-
     # Setup logging
     cax_version = 'cax_v%s - ' % __version__
     logging.basicConfig(filename=args.logfile,
@@ -89,6 +217,35 @@ def main():
     # add the handler to the root logger
     logging.getLogger('').addHandler(console)
 
+    run_cax(args)
+
+
+def run_cax(args):
+    """Configure cax from the parsed arguments, then run the cax tasks"""
+    from cax.tasks import checksum, clear, corrections, data_mover, filesystem, process, process_hax
+
+    if args.host:
+        config.HOST = args.host
+
+    database_log = not args.disable_database_update
+
+    ncpu = args.ncpu
+    config.NCPU = ncpu
+
+    config.set_cursor_batch_size(args.batch_size)
+    config.set_workers(args.workers)
+    config.set_repair_transfers(args.repair)
+    config.set_digest_options(workers=args.digest_workers,
+                              read_size=args.digest_read_size)
+
+    # Set information to update the run database
+    config.set_database_log(database_log)
+    config.set_journal(args.journal)
+    config.set_checksum_cache(args.checksum_cache)
+
+    # Check passwords and API keysspecified
+    config.mongo_password()
+
     # Get specified cax.json configuration file for cax:
     if args.config_file:
         if not os.path.isfile(args.config_file):
@@ -130,34 +287,14 @@ def main():
 
     user_tasks = config.get_task_list()
 
-    while True:
-        for task in tasks:
-            name = task.__class__.__name__
+    # Skip tasks that user did not specify
+    if user_tasks:
+        tasks = [task for task in tasks
+                 if task.__class__.__name__ in user_tasks]
 
-            # Skip tasks that user did not specify
-            if user_tasks and name not in user_tasks:
-                continue
+    specify_run = args.name if args.name is not None else args.run
 
-            logging.info("Executing %s." % name)
-
-            try:
-                if args.name is not None:
-                    task.go(args.name)
-                else:
-                    task.go(args.run)
-
-            except Exception as e:
-                logging.fatal("Exception caught from task %s" % name,
-                              exc_info=True)
-                logging.exception(e)
-                raise
-
-        # Decide to continue or not
-        if run_once:
-            break
-        else:
-            logging.info('Sleeping.')
-            time.sleep(60)
+    run_daemon(tasks, specify_run, args)
 
 
 def massive():
@@ -250,102 +387,116 @@ def massive():
 
     # Establish mongo connection
     collection = config.mongo_collection()
-    sort_key = (('start', -1),
-                ('number', -1),
-                ('detector', -1),
-                ('_id', -1))
+    sort_key = rundb.DRIVER_SORT
 
     dt = datetime.timedelta(days=1)
     t0 = datetime.datetime.utcnow() - 2 * dt
 
-    while True:  # yeah yeah
-        query = {}
+    # Pass again after a minute while jobs are being submitted, backing off
+    # to an hour when there is nothing to do
+    schedule = scheduler.AdaptiveSchedule(interval=60, max_interval=3600)
+    schedule.add('massive')
 
-        t1 = datetime.datetime.utcnow()
-        if t1 - t0 < dt:
-            logging.info("Iterative mode")
+    # Pick up cax.json edits between passes, without a restart
+    with config.ConfigWatcher() as watcher:
+        while True:  # yeah yeah
+            watcher.reload()
+            submitted = 0
 
-            # See if there is something to do
-            query['start'] = {'$gt': t0}
+            query = {}
 
-            logging.info(query)
-        else:
-            logging.info("Full mode")
-            t0 = t1
+            t1 = datetime.datetime.utcnow()
+            if t1 - t0 < dt:
+                logging.info("Iterative mode")
+
+                # See if there is something to do
+                query['start'] = {'$gt': t0}
 
-        if args.run:
-            query['number'] = args.run
+                logging.info(query)
+            else:
+                logging.info("Full mode")
+                t0 = t1
 
-        if args.start:
-            query['number'] = {'$gte': args.start}
+            if args.run:
+                query['number'] = args.run
 
-        if args.stop:
-            query['number'] = {'$lte': args.stop}
+            if args.start:
+                query['number'] = {'$gte': args.start}
 
-        if tag is not '':
-            query['tags.name'] = str(tag)
+            if args.stop:
+                query['number'] = {'$lte': args.stop}
 
-        docs = list(collection.find(query,
-                                    sort=sort_key,
-                                    projection=['start', 'number', 'name',
-                                                'detector', '_id']))
+            if tag is not '':
+                query['tags.name'] = str(tag)
 
-        for doc in docs:
+            # Stream the runs, resuming if the cursor times out while the batch
+            # queue is full
+            docs = rundb.iterate_runs(collection, query,
+                                      projection=['start', 'number', 'name',
+                                                  'detector', '_id'],
+                                      sort=sort_key,
+                                      batch_size=config.CURSOR_BATCH_SIZE)
 
-            job_name = ''
+            for doc in docs:
 
-            if doc['detector'] == 'tpc':
-                job_name = str(doc['number'])
-                job = dict(command='cax --once --run {number} ' + config_arg + ' --ncpu ' + str(ncpu),
-                           number=int(job_name), ncpus=ncpu)
-            elif doc['detector'] == 'muon_veto':
-                job_name = doc['name']
-                job = dict(command='cax --once --name {number} ' + config_arg + ' --ncpu ' + str(ncpu),
-                           number=job_name, ncpus=ncpu)
+                job_name = ''
 
-            job['mem_per_cpu'] = mem_per_cpu
+                if doc['detector'] == 'tpc':
+                    job_name = str(doc['number'])
+                    job = dict(command='cax --once --run {number} ' + config_arg + ' --ncpu ' + str(ncpu),
+                               number=int(job_name), ncpus=ncpu)
+                elif doc['detector'] == 'muon_veto':
+                    job_name = doc['name']
+                    job = dict(command='cax --once --name {number} ' + config_arg + ' --ncpu ' + str(ncpu),
+                               number=job_name, ncpus=ncpu)
 
-            job['time'] = walltime
+                job['mem_per_cpu'] = mem_per_cpu
 
-            if partition is not None:
-                job['partition'] = '\n#SBATCH --partition=' + partition
+                job['time'] = walltime
 
-            job['extra'] = ''
-            if qos is not None:
-                job['extra'] += '\n#SBATCH --qos=' + qos
+                if partition is not None:
+                    job['partition'] = '\n#SBATCH --partition=' + partition
 
-            if reservation is not None:
-                job['extra'] += '\n#SBATCH --reservation=' + reservation
+                job['extra'] = ''
+                if qos is not None:
+                    job['extra'] += '\n#SBATCH --qos=' + qos
 
-            script = config.processing_script(job)
+                if reservation is not None:
+                    job['extra'] += '\n#SBATCH --reservation=' + reservation
 
-            if 'cax_%s_v%s' % (job_name, pax.__version__) in qsub.get_queue():
-                logging.debug('Skip: cax_%s_v%s job exists' %
-                              (job_name, pax.__version__))
-                continue
+                script = config.processing_script(job)
 
-            queue_num = qsub.get_number_in_queue(partition=partition)
+                if 'cax_%s_%s' % (job_name, config.pax_version()) in qsub.get_queue():
+                    logging.debug('Skip: cax_%s_%s job exists' %
+                                  (job_name, config.pax_version()))
+                    continue
 
-            while queue_num >= (500 if config.get_hostname() == 'midway-login1' else 30):
-                logging.info("Speed break 60s because %d in queue" % queue_num)
-                time.sleep(60)
                 queue_num = qsub.get_number_in_queue(partition=partition)
 
-            print(script)
-            qsub.submit_job(script)
+                while queue_num >= (500 if config.get_hostname() == 'midway-login1' else 30):
+                    logging.info("Speed break 60s because %d in queue" % queue_num)
+                    time.sleep(60)
+                    queue_num = qsub.get_number_in_queue(partition=partition)
 
-            logging.debug("Pace by 1 s")
-            time.sleep(1)  # Pace 1s for batch queue
+                print(script)
+                qsub.submit_job(script)
+                submitted += 1
 
-        if run_once:
-            break
-        else:
-            pace = 60
-            logging.info("Done, waiting %d minutes" % pace)
-            time.sleep(60 * pace)
+                logging.debug("Pace by 1 s")
+                time.sleep(1)  # Pace 1s for batch queue
+
+            if run_once:
+                break
+            else:
+                schedule.record('massive', submitted)
+                pace = schedule.time_to_next_run()
+                logging.info("Done, waiting %d s" % pace)
+                time.sleep(pace)
 
 
 def move():
+    from cax.tasks import filesystem
+
     parser = argparse.ArgumentParser(description="Move single file and notify"
                                                  " the run database.")
     parser.add_argument('--input', type=str, required=True,
@@ -368,6 +519,8 @@ def move():
 
 
 def remove():
+    from cax.tasks import filesystem
+
     parser = argparse.ArgumentParser(description="Remove data and notify"
                                                  " the run database.")
     parser.add_argument('--location', type=str, required=True,
@@ -388,18 +541,128 @@ def remove():
     filesystem.RemoveSingle(args.location).go(args.run)
 
 
+def datum_ids():
+    from cax.tasks import filesystem
+
+    parser = argparse.ArgumentParser(description="Give every data location "
+                                                 "in the run database an id.")
+    parser.add_argument('--disable_database_update', action='store_true',
+                        help="Disable the update function the run data base")
+    parser.add_argument('--run', type=int,
+                        help="Run number to process")
+
+    args = parser.parse_args()
+
+    database_log = not args.disable_database_update
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Set information to update the run database
+    config.set_database_log(database_log)
+    config.mongo_password()
+
+    filesystem.AddDatumIds().go(args.run)
+
+    # Updates of a data location look it up by datum_id
+    if database_log:
+        config.mongo_collection().create_index('data.datum_id', background=True)
+
+
+def db_index():
+    from cax import manifest
+
+    parser = argparse.ArgumentParser(description="Create the run database "
+                                                 "indexes cax needs and show "
+                                                 "the query plans.")
+    parser.add_argument('--check', action='store_true',
+                        help="Only report missing indexes, create none")
+    parser.add_argument('--explain', action='store_true',
+                        help="Show the plan of each typical cax query")
+    parser.add_argument('--host', type=str,
+                        help="Host whose queries are explained")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config.mongo_password()
+    collection = config.mongo_collection()
+
+    for keys, state in rundb.ensure_indexes(collection, create=not args.check):
+        print('%-8s %s' % (state, ', '.join('%s:%d' % key for key in keys)))
+    for keys, state in manifest.ensure_indexes(create=not args.check):
+        print('%-8s %s.%s' % (state, manifest.COLLECTION,
+                              ', '.join('%s:%d' % key for key in keys)))
+
+    if args.explain:
+        hostname = args.host or config.get_hostname()
+        for name, (query, sort) in rundb.canonical_queries(hostname).items():
+            print('%-20s %s' % (name, rundb.explain_query(collection, query, sort)))
+
+
+def mirror_collection(path):
+    """Read-only runs collection served from the local mirror at path"""
+    from cax import mirror
+
+    run_mirror = mirror.RunMirror(path)
+    run_mirror.check_age()
+    return run_mirror.collection()
+
+
+def sync_mirror():
+    from cax import mirror
+
+    parser = argparse.ArgumentParser(description="Keep a local mirror of the "
+                                                 "run database for read-only "
+                                                 "commands.")
+    parser.add_argument('--path', type=str, default=mirror.DEFAULT_PATH,
+                        help="Mirror file")
+    parser.add_argument('--full', action='store_true',
+                        help="Copy all runs rather than the changed ones")
+    parser.add_argument('--interval', type=int,
+                        help="Keep syncing, every this many seconds")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config.mongo_password()
+    collection = config.mongo_collection()
+    run_mirror = mirror.RunMirror(args.path)
+
+    full = args.full or None
+    while True:
+        run_mirror.sync(collection, full=full)
+        if not args.interval:
+            break
+        full = None
+        time.sleep(args.interval)
+
+
 def stray():
+    from cax import mirror
+    from cax.tasks import filesystem
+
     parser = argparse.ArgumentParser(description="Find stray files.")
     parser.add_argument('--delete', action='store_true',
                         help="Delete strays (default: false)")
+    parser.add_argument('--mirror', nargs='?', const=mirror.DEFAULT_PATH,
+                        help="Read runs from the local mirror kept by "
+                             "cax-mirror, optionally at this path")
 
     args = parser.parse_args()
     config.mongo_password()
 
-    filesystem.FindStrays().go()
+    task = filesystem.FindStrays()
+    if args.mirror:
+        task.collection = mirror_collection(args.mirror)
+    task.go()
 
 
 def status():
+    from cax import mirror
+    from cax.tasks import filesystem
+
     # Ask the database for the actual status of the file or folder:
 
     parser = argparse.ArgumentParser(description="Check the database status")
@@ -410,6 +673,9 @@ def status():
                         help="Which status should be asked: error, transferred, none, ")
     parser.add_argument('--disable_database_update', action='store_true',
                         help="Disable the update function the run data base")
+    parser.add_argument('--mirror', nargs='?', const=mirror.DEFAULT_PATH,
+                        help="Read runs from the local mirror kept by "
+                             "cax-mirror, optionally at this path")
 
     args = parser.parse_args()
 
@@ -439,12 +705,17 @@ def status():
     config.set_database_log(database_log)
     config.mongo_password()
 
-    filesystem.StatusSingle(args.host, args.status).go()
+    task = filesystem.StatusSingle(args.host, args.status)
+    if args.mirror:
+        task.collection = mirror_collection(args.mirror)
+    task.go()
 
 # Rucio Stuff
 
 
-def ruciax():
+def ruciax_parser():
+    from cax import digest, journal
+
     parser = argparse.ArgumentParser(description="Copying All kinds of XENON1T "
                                                  "data.")
     parser.add_argument('--once', action='store_true',
@@ -475,6 +746,33 @@ def ruciax():
 
     parser.add_argument('--host', type=str,
                         help="Host to pretend to be")
+    parser.add_argument('--incremental', action='store_true',
+                        help="After a full pass, only look at runs changed "
+                             "since the previous cycle")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of tasks run at the same time")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of runs a parallel task works on at once")
+    parser.add_argument('--journal', type=str, default=journal.DEFAULT_PATH,
+                        help="File run updates are journaled to while the "
+                             "run database is unreachable")
+    parser.add_argument('--no-journal', dest='journal', action='store_const',
+                        const=None,
+                        help="Lose run updates made while the run database "
+                             "is unreachable")
+    parser.add_argument('--checksum-cache', dest='checksum_cache', type=str,
+                        default=digest.DEFAULT_CACHE_PATH,
+                        help="File the checksums of unchanged files are "
+                             "remembered in")
+    parser.add_argument('--no-checksum-cache', dest='checksum_cache',
+                        action='store_const', const=None,
+                        help="Always checksum files anew")
+    parser.add_argument('--max-interval', dest='max_interval', type=int,
+                        default=600,
+                        help="Longest wait between passes of an idle task")
+    parser.add_argument('--full-interval', dest='full_interval', type=int,
+                        default=3600,
+                        help="Seconds between full passes in incremental mode")
 
     # parser for rucio arguments
     parser.add_argument('--rucio-scope', type=str, dest='rucio_scope',
@@ -485,28 +783,16 @@ def ruciax():
 
     parser.add_argument('--rucio-upload', type=str, dest='rucio_upload',
                         help="Rucio: Select a data file or data set")
+    return parser
 
-    args = parser.parse_args()
 
-    # This one is mandatory: hardcoded science run number!
-    config.set_rucio_campaign("001")
+def ruciax():
+    args = ruciax_parser().parse_args()
 
     log_level = getattr(logging, args.log.upper())
     if not isinstance(log_level, int):
         raise ValueError('Invalid log level: %s' % args.log)
 
-    run_once = args.once
-    database_log = not args.disable_database_update
-
-    # Set information to update the run database
-    config.set_database_log(database_log)
-
-    # Check passwords and API keysspecified
-    config.mongo_password()
-
-    # Set information for rucio transfer rules (config file)
-    config.set_rucio_rules(args.config_rule)
-
     # Setup logging
     cax_version = 'ruciax_v%s - ' % __version__
     logging.basicConfig(filename=args.logfile,
@@ -528,6 +814,31 @@ def ruciax():
     # add the handler to the root logger
     logging.getLogger('').addHandler(console)
 
+    run_ruciax(args)
+
+
+def run_ruciax(args):
+    """Configure ruciax from the parsed arguments, then run the rucio tasks"""
+    from cax.tasks import data_mover, rucio_mover
+
+    # This one is mandatory: hardcoded science run number!
+    config.set_rucio_campaign("001")
+
+    config.set_workers(args.workers)
+
+    database_log = not args.disable_database_update
+
+    # Set information to update the run database
+    config.set_database_log(database_log)
+    config.set_journal(args.journal)
+    config.set_checksum_cache(args.checksum_cache)
+
+    # Check passwords and API keysspecified
+    config.mongo_password()
+
+    # Set information for rucio transfer rules (config file)
+    config.set_rucio_rules(args.config_rule)
+
     # Get specified cax.json configuration file for cax:
     if args.config_file:
         if not os.path.isfile(args.config_file):
@@ -548,37 +859,20 @@ def ruciax():
 
     user_tasks = config.get_task_list()
 
-    while True:
-        for task in tasks:
-            name = task.__class__.__name__
+    # Skip tasks that user did not specify
+    if user_tasks:
+        tasks = [task for task in tasks
+                 if task.__class__.__name__ in user_tasks]
 
-            # Skip tasks that user did not specify
-            if user_tasks and name not in user_tasks:
-                continue
+    specify_run = args.name if args.name is not None else args.run
 
-            logging.info("Executing %s." % name)
-
-            try:
-                if args.name is not None:
-                    task.go(args.name)
-                else:
-                    task.go(args.run)
-
-            except Exception as e:
-                logging.fatal("Exception caught from task %s" % name,
-                              exc_info=True)
-                logging.exception(e)
-                raise
-
-        # Decide to continue or not
-        if run_once:
-            break
-        else:
-            logging.info('Sleeping.')
-            time.sleep(60)
+    run_daemon(tasks, specify_run, args)
 
 
 def massiveruciax():
+    from cax import worker
+    from cax.tasks import rucio_mover
+
     # Command line arguments setup
     parser = argparse.ArgumentParser(
         description="Submit ruciax tasks to batch queue.")
@@ -601,6 +895,9 @@ def massiveruciax():
     parser.add_argument('--rucio-rule', type=str,
                         dest='config_rule',
                         help="Load the a rule file")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of ruciax processes working on runs side "
+                             "by side, 0 starts a new ruciax per run")
 
     args = parser.parse_args()
 
@@ -682,174 +979,163 @@ def massiveruciax():
 
     # Establish mongo connection
     collection = config.mongo_collection()
-    sort_key = (('start', -1),
-                ('number', -1),
-                ('detector', -1),
-                ('_id', -1))
+    sort_key = rundb.DRIVER_SORT
 
     # Construct the pre-basic bash script(s) from rucio_mover.RucioConfig()
     RucioBashConfig = rucio_mover.RucioConfig()
 
     dt = datetime.timedelta(days=1)
 
-    while True:  # yeah yeah
-        #query = {'detector':'tpc'}
-        query = {}
+    # Pass again after a minute while there is work, backing off to ten
+    # minutes when there is nothing to do
+    schedule = scheduler.AdaptiveSchedule(interval=60, max_interval=600)
+    schedule.add('massiveruciax')
 
-        if args.run:
-            query['number'] = args.run
+    # Pick up cax.json edits between passes, without a restart
+    with config.ConfigWatcher() as watcher:
+        # ruciax processes kept running between runs, in the rucio environment
+        pool = worker.WorkerPool('ruciax', args.workers,
+                                 setup=RucioBashConfig.load_host_config(config.get_hostname(), "py3").format(
+                                     account=config.get_config("rucio-catalogue")['rucio_account']),
+                                 name='massive-ruciax')
 
-        if run_window == True:
-            query['number'] = {'$lt': end_run + 1, '$gt': beg_run - 1}
+        while True:  # yeah yeah
+            watcher.reload()
+            done = 0
+            jobs = []
+            #query = {'detector':'tpc'}
+            query = {}
 
-        if run_window_lastruns == True:
-            query['number'] = {'$gt': beg_run - 1}
+            if args.run:
+                query['number'] = args.run
 
-        if run_lastdays == True:
-            t1 = datetime.datetime.utcnow()
-            t0 = datetime.datetime.utcnow() - int(args.last_days) * dt
-            if t1 - t0 < (int(args.last_days) * dt):
-                logging.info(
-                    "Run ruciax up/downloads only on latest %s days", args.last_days)
-                # See if there is something to do
-                query['start'] = {'$gt': t0}
+            if run_window == True:
+                query['number'] = {'$lt': end_run + 1, '$gt': beg_run - 1}
 
-        # Select specific data sets
-        selection = {"detector": True,
-                     "number": True,
-                     "data": True,
-                     "_id": True,
-                     #"tags" : True,
-                     "name": True}
+            if run_window_lastruns == True:
+                query['number'] = {'$gt': beg_run - 1}
 
-        docs = list(collection.find(query,
-                                    selection,
-                                    sort=sort_key)
-                    )
+            if run_lastdays == True:
+                t1 = datetime.datetime.utcnow()
+                t0 = datetime.datetime.utcnow() - int(args.last_days) * dt
+                if t1 - t0 < (int(args.last_days) * dt):
+                    logging.info(
+                        "Run ruciax up/downloads only on latest %s days", args.last_days)
+                    # See if there is something to do
+                    query['start'] = {'$gt': t0}
 
-        for doc in docs:
+            # Select specific data sets, streamed through a batched cursor
+            selection = ["detector", "number", "_id", "name",
+                         "data.host", "data.status"]
 
-                # Select a single run for rucio upload (massive-ruciax -> ruciax)
-            if args.run:
-                if args.run != doc['number']:
-                    continue
+            docs = rundb.iterate_runs(collection, query,
+                                      projection=selection,
+                                      sort=sort_key,
+                                      batch_size=config.CURSOR_BATCH_SIZE)
 
-            # Double check if a 'data' field is defind in doc
-            if 'data' not in doc:
-                continue
+            for doc in docs:
 
-            # Check now if the data field is larger then zero:
-            if len(doc['data']) == 0:
-                continue
+                    # Select a single run for rucio upload (massive-ruciax -> ruciax)
+                if args.run:
+                    if args.run != doc['number']:
+                        continue
 
-            # Double check that rucio uploads are only triggered when data exists at the host
-            host_data = False
-            rucio_data = False
-            rucio_data_upload = None
-            host_data_error = False
-
-            for idoc in doc['data']:
-                if idoc['host'] == config.get_hostname() and idoc['status'] == "transferred":
-                    host_data = True
-                    host_data_error == False
-                elif idoc['host'] == config.get_hostname() and idoc['status'] == "error":
-                    host_data = True
-                    host_data_error = True
-
-                if idoc['host'] == "rucio-catalogue":
-                    rucio_data = True
-                    rucio_data_upload = idoc['status']
-
-            if verfication_only == False:
-
-                    # A rucio upload makes only sense if the data are stored at the host
-                    # where ruciax runs right now.
-                if host_data != True:
-                    continue
-                elif host_data == True and host_data_error == True:
-                    continue
-                # Trigger rucio uploads:
-                # If rucio data exists which are in status transferring or error let us skip them.
-                # RSEreupload is still executed
-                if rucio_data == True and (rucio_data_upload == "transferring" or rucio_data_upload == "error" or rucio_data_upload == "transferred"):
+                # Double check if a 'data' field is defind in doc
+                if 'data' not in doc:
                     continue
 
-            elif verfication_only == True:
-                if rucio_data == False or rucio_data_upload != "transferred":
+                # Check now if the data field is larger then zero:
+                if len(doc['data']) == 0:
                     continue
 
-            # Get the local time:
-            local_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-
-            # Prepare run name for upload and log file
-            run = "--name {name}".format(name=doc['name'])
-            runlogfile = "--log-file {log_path}/ruciax_log_{number}_{timestamp}.txt".format(
-                log_path=log_path[config.get_hostname()],
-                number=doc['number'],
-                timestamp=local_time)
-
-            # Define the job:
-            job = "{conf} {run} {rucio_rule} {runlogfile}".format(
-                  conf=config_arg,
-                  run=run,
-                  rucio_rule=rucio_rule,
-                  runlogfile=runlogfile)
-
-            # start the time for an upload:
-            time_start = datetime.datetime.utcnow()
-
-            # Create the command
-            command = """
-ruciax --once {job}
-""".format(job=job)
-
-            pre_bash_command = RucioBashConfig.load_host_config(config.get_hostname(), "py3").format(
-                account=config.get_config("rucio-catalogue")['rucio_account']
-            )
-
-            command = pre_bash_command + command
-
-            logging.info(command)
-
-            # Submit the command
-            sc = qsub.create_script(command)
-            execute = subprocess.Popen(['sh', sc.name],
-                                       stdin=subprocess.PIPE,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT, shell=False)
-            stdout_value, stderr_value = execute.communicate()
-            stdout_value = stdout_value.decode("utf-8")
-            stdout_value = stdout_value.split("\n")
-
-            # Return command output:
-            for i in stdout_value:
-                logging.info('massive-ruciax: %s', i)
-
-            # Manage the upload time:
-            time_end = datetime.datetime.utcnow()
-            diff = time_end - time_start
-            dd = divmod(diff.total_seconds(), 60)
-
-            # delete script:
-            qsub.delete_script(sc)
-
-            logging.info("+--------------------------->>>")
-            logging.info(
-                "| Summary: massive-ruciax for run/name: %s/%s", doc['number'], doc['name'])
-            logging.info("| Configuration script: %s", runlogfile)
-            logging.info("| Rucio-rule script: %s", abs_config_rule)
-            logging.info("| Run time of ruciax: %s min %s",
-                         str(dd[0]), str(dd[1]))
-            logging.info(
-                "+------------------------------------------------->>>")
-        if run_once:
-            break
-        else:
-            logging.info('Sleeping.')
-            time.sleep(60)
+                # Double check that rucio uploads are only triggered when data exists at the host
+                host_data = False
+                rucio_data = False
+                rucio_data_upload = None
+                host_data_error = False
+
+                for idoc in doc['data']:
+                    if idoc['host'] == config.get_hostname() and idoc['status'] == "transferred":
+                        host_data = True
+                        host_data_error == False
+                    elif idoc['host'] == config.get_hostname() and idoc['status'] == "error":
+                        host_data = True
+                        host_data_error = True
+
+                    if idoc['host'] == "rucio-catalogue":
+                        rucio_data = True
+                        rucio_data_upload = idoc['status']
+
+                if verfication_only == False:
+
+                        # A rucio upload makes only sense if the data are stored at the host
+                        # where ruciax runs right now.
+                    if host_data != True:
+                        continue
+                    elif host_data == True and host_data_error == True:
+                        continue
+                    # Trigger rucio uploads:
+                    # If rucio data exists which are in status transferring or error let us skip them.
+                    # RSEreupload is still executed
+                    if rucio_data == True and (rucio_data_upload == "transferring" or rucio_data_upload == "error" or rucio_data_upload == "transferred"):
+                        continue
+
+                elif verfication_only == True:
+                    if rucio_data == False or rucio_data_upload != "transferred":
+                        continue
+
+                # Get the local time:
+                local_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+
+                # Prepare run name for upload and log file
+                run = "--name {name}".format(name=doc['name'])
+                runlogfile = "--log-file {log_path}/ruciax_log_{number}_{timestamp}.txt".format(
+                    log_path=log_path[config.get_hostname()],
+                    number=doc['number'],
+                    timestamp=local_time)
+
+                # Define the job:
+                job = "{conf} {run} {rucio_rule} {runlogfile}".format(
+                      conf=config_arg,
+                      run=run,
+                      rucio_rule=rucio_rule,
+                      runlogfile=runlogfile)
+
+                logging.info("Job: ruciax --once %s", job)
+                jobs.append((job.split(), ({'number': doc['number'], 'name': doc['name']},
+                                           runlogfile)))
+
+            # Execute the jobs
+            for (doc, runlogfile), error, seconds in pool.run(jobs):
+                if error is not None:
+                    logging.error("ruciax failed for run %s: %s", doc['name'], error)
+
+                # Manage the upload time:
+                dd = divmod(seconds, 60)
+                done += 1
+
+                logging.info("+--------------------------->>>")
+                logging.info(
+                    "| Summary: massive-ruciax for run/name: %s/%s", doc['number'], doc['name'])
+                logging.info("| Configuration script: %s", runlogfile)
+                logging.info("| Rucio-rule script: %s", abs_config_rule)
+                logging.info("| Run time of ruciax: %s min %s",
+                             str(dd[0]), str(dd[1]))
+                logging.info(
+                    "+------------------------------------------------->>>")
+            if run_once:
+                pool.close()
+                break
+            else:
+                schedule.record('massiveruciax', done)
+                pace = schedule.time_to_next_run()
+                logging.info('Sleeping %d s.' % pace)
+                time.sleep(pace)
 
 
 def remove_from_tsm():
+    from cax.tasks import filesystem
+
     parser = argparse.ArgumentParser(description="Remove data and notify"
                                                  " the run database.")
     parser.add_argument('--location', type=str, required=True,
@@ -879,6 +1165,8 @@ def remove_from_tsm():
 
 
 def massive_tsmclient():
+    from cax import worker
+
     # Command line arguments setup
     parser = argparse.ArgumentParser(
         description="Submit ruciax tasks to batch queue.")
@@ -904,6 +1192,9 @@ def massive_tsmclient():
                         help="Specify a certain logfile")
     parser.add_argument('--disable_database_update', action='store_true',
                         help="Disable the update function the run data base")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of cax processes working on runs side "
+                             "by side, 0 starts a new cax per run")
 
     args = parser.parse_args()
 
@@ -1003,149 +1294,141 @@ def massive_tsmclient():
     # Establish mongo connection
     collection = config.mongo_collection()
 
-    sort_key = (('start', -1),
-                ('number', -1),
-                ('detector', -1),
-                ('_id', -1))
+    sort_key = rundb.DRIVER_SORT
 
     dt = datetime.timedelta(days=1)
 
-    while True:  # yeah yeah
+    # Pass again after a minute while there is work, backing off to ten
+    # minutes when there is nothing to do
+    schedule = scheduler.AdaptiveSchedule(interval=60, max_interval=600)
+    schedule.add('massive_tsmclient')
+
+    # Pick up cax.json edits between passes, without a restart
+    with config.ConfigWatcher() as watcher:
+        # cax processes kept running between runs
+        pool = worker.WorkerPool('cax', args.workers, name='massive-tsm')
+
+        while True:  # yeah yeah
+            watcher.reload()
+            done = 0
+            jobs = []
 
-        query = {}
+            query = {}
 
-        if args.run:
-            query['number'] = args.run
+            if args.run:
+                query['number'] = args.run
 
-        if run_window == True:
-            query['number'] = {'$lt': end_run + 1, '$gt': beg_run - 1}
+            if run_window == True:
+                query['number'] = {'$lt': end_run + 1, '$gt': beg_run - 1}
 
-        if run_window_lastruns == True:
-            query['number'] = {'$gt': beg_run - 1}
+            if run_window_lastruns == True:
+                query['number'] = {'$gt': beg_run - 1}
 
-        if run_lastdays == True:
-            t1 = datetime.datetime.utcnow()
-            t0 = datetime.datetime.utcnow() - int(args.last_days) * dt
+            if run_lastdays == True:
+                t1 = datetime.datetime.utcnow()
+                t0 = datetime.datetime.utcnow() - int(args.last_days) * dt
 
-            if t1 - t0 < (int(args.last_days) * dt):
-                logging.info(
-                    "Run massive-tsm for up-/downloads only on latest %s days", args.last_days)
-                # See if there is something to do
-                query['start'] = {'$gt': t0}
+                if t1 - t0 < (int(args.last_days) * dt):
+                    logging.info(
+                        "Run massive-tsm for up-/downloads only on latest %s days", args.last_days)
+                    # See if there is something to do
+                    query['start'] = {'$gt': t0}
 
-        # Select specific data sets
-        selection = {"detector": True,
-                     "number": True,
-                     "data": True,
-                     "_id": True,
-                     #"tags" : True,
-                     "name": True}
+            # Select specific data sets, streamed through a batched cursor
+            selection = ["detector", "number", "_id", "name",
+                         "data.host", "data.status"]
 
-        docs = list(collection.find(query,
-                                    selection,
-                                    sort=sort_key)
-                    )
+            docs = rundb.iterate_runs(collection, query,
+                                      projection=selection,
+                                      sort=sort_key,
+                                      batch_size=config.CURSOR_BATCH_SIZE)
 
-        for doc in docs:
+            for doc in docs:
 
-                # Select a single run up/download
-            if args.run:
-                #print("Test A")
-                if args.run != doc['number']:
-                    continue
-            if args.name:
-                if str(args.name) != str(doc['name']):
+                    # Select a single run up/download
+                if args.run:
+                    #print("Test A")
+                    if args.run != doc['number']:
+                        continue
+                if args.name:
+                    if str(args.name) != str(doc['name']):
+                        continue
+
+                # Double check if a 'data' field is defind in doc (runDB entry)
+                if 'data' not in doc:
                     continue
 
-            # Double check if a 'data' field is defind in doc (runDB entry)
-            if 'data' not in doc:
-                continue
+                # Double check that tsm uploads are only triggered when data exists at the host
+                host_data = False
+                tsm_data = False
+                for idoc in doc['data']:
+                    if idoc['host'] == config.get_hostname() and idoc['status'] == "transferred":
+                        host_data = True
+                    if idoc['host'] == "tsm-server" and (idoc['status'] == "transferred" or idoc['status'] == "transferring"):
+                        # we can skip a tsm-server transfer try if the tsm-status is:
+                        # - transferred [everything fine]
+                        # - transferring [the file is marked for upload right now [suppose that everything is fine]
+                        tsm_data = True
+
+                # Evaluate the double check
+                if host_data == False and tsm_task == "upload":
+                    # Do not try upload data which are not registered in the runDB
+                    continue
+                # make sure now that only "new data" are uploaded
+                if tsm_data == True and tsm_task == "upload":
+                    continue
 
-            # Double check that tsm uploads are only triggered when data exists at the host
-            host_data = False
-            tsm_data = False
-            for idoc in doc['data']:
-                if idoc['host'] == config.get_hostname() and idoc['status'] == "transferred":
-                    host_data = True
-                if idoc['host'] == "tsm-server" and (idoc['status'] == "transferred" or idoc['status'] == "transferring"):
-                    # we can skip a tsm-server transfer try if the tsm-status is:
-                    # - transferred [everything fine]
-                    # - transferring [the file is marked for upload right now [suppose that everything is fine]
-                    tsm_data = True
-
-            # Evaluate the double check
-            if host_data == False and tsm_task == "upload":
-                # Do not try upload data which are not registered in the runDB
-                continue
-            # make sure now that only "new data" are uploaded
-            if tsm_data == True and tsm_task == "upload":
-                continue
+                # Detector choice
+                local_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+
+                run_selection = None
+                if args.run != None and args.name == None:
+                        # select a run by run number
+                    run_selection = "--run {run}".format(run=args.run)
+                elif args.run == None and args.name != None:
+                    run_selection = "--name {run}".format(run=args.name)
+                elif args.run == None and args.name == None:
+                    run_selection = "--name {run}".format(run=doc['name'])
+
+                # The job defintin string:
+                job = "--config {conf} {run_selection} --log-file {log_path}/tsm_log_{number}_{timestamp}.txt".format(
+                      conf=config_arg,
+                      run_selection=run_selection,
+                      log_path=log_path[config.get_hostname()],
+                      number=doc['number'],
+                      timestamp=local_time)
+
+                # Disable runDB notifications
+                if args.disable_database_update == True:
+                    job = job + " --disable_database_update"
+
+                logging.info("Job: cax --once %s", job)
+                jobs.append((job.split(), {'number': doc['number'], 'name': doc['name']}))
+
+            # Execute the jobs, each only once
+            for doc, error, seconds in pool.run(jobs):
+                if error is not None:
+                    logging.error("cax failed for run %s: %s", doc['name'], error)
+                # Manage the upload time:
+                dd = divmod(seconds, 60)
+                logging.info("Upload time: %s min %s", str(dd[0]), str(dd[1]))
+                done += 1
 
-            # Detector choice
-            local_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-
-            run_selection = None
-            if args.run != None and args.name == None:
-                    # select a run by run number
-                run_selection = "--run {run}".format(run=args.run)
-            elif args.run == None and args.name != None:
-                run_selection = "--name {run}".format(run=args.name)
-            elif args.run == None and args.name == None:
-                run_selection = "--name {run}".format(run=doc['name'])
-
-            # The job defintin string:
-            job = "--config {conf} {run_selection} --log-file {log_path}/tsm_log_{number}_{timestamp}.txt".format(
-                  conf=config_arg,
-                  run_selection=run_selection,
-                  log_path=log_path[config.get_hostname()],
-                  number=doc['number'],
-                  timestamp=local_time)
-
-            # start the time for an upload:
-            time_start = datetime.datetime.utcnow()
-
-            # Create the command and execute the job only once
-            command = "cax --once {job}".format(job=job)
-
-            # Disable runDB notifications
-            if args.disable_database_update == True:
-                command = command + " --disable_database_update"
-
-            logging.info("Command: %s", command)
-
-            command = command.replace("\n", "")
-            command = command.split(" ")
-            execute = subprocess.Popen(command,
-                                       stdin=subprocess.PIPE,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT, shell=False)
-            stdout_value, stderr_value = execute.communicate()
-            stdout_value = stdout_value.decode()
-
-            stdout_value = str(stdout_value).split("\n")
-            stderr_value = str(stderr_value).split("\n")
-
-            stdout_value.remove('')  # remove '' entries from an array
-
-            # Return command output:
-            for i in stdout_value:
-                logging.info("massive-tsm: %s", i)
-
-            # Manage the upload time:
-            time_end = datetime.datetime.utcnow()
-            diff = time_end - time_start
-            dd = divmod(diff.total_seconds(), 60)
-            logging.info("Upload time: %s min %s", str(dd[0]), str(dd[1]))
-
-        if run_once:
-            break
-        else:
-            logging.info('Sleeping.')
-            time.sleep(60)
+            if run_once:
+                pool.close()
+                break
+            else:
+                schedule.record('massive_tsmclient', done)
+                pace = schedule.time_to_next_run()
+                logging.info('Sleeping %d s.' % pace)
+                time.sleep(pace)
 
 
 def cax_tape_log_file():
     """Analyses the tsm storage"""
+    from cax import mirror
+    from cax.tasks import tsm_mover
+
     parser = argparse.ArgumentParser(
         description="This program helps you to watch the tape backup")
 
@@ -1160,6 +1443,9 @@ def cax_tape_log_file():
     parser.add_argument('--log-path', type=str,
                         dest='log_path',
                         help="Point to the directory where the log files are stored.")
+    parser.add_argument('--mirror', nargs='?', const=mirror.DEFAULT_PATH,
+                        help="Read runs from the local mirror kept by "
+                             "cax-mirror, optionally at this path")
     run_once = True
     args = parser.parse_args()
 
@@ -1168,9 +1454,8 @@ def cax_tape_log_file():
 
     # Establish mongo connection
     collection = config.mongo_collection()
-    sort_key = (('number', -1),
-                ('detector', -1),
-                ('_id', -1))
+    if args.mirror:
+        collection = mirror_collection(args.mirror)
 
     if args.monitor == "logfile":
         """load the logfile watcher class"""
@@ -1183,9 +1468,11 @@ def cax_tape_log_file():
 
         while True:  # yeah yeah
 
-            query = {}
+            query = {'data.host': "tsm-server"}
 
-            docs = list(collection.find(query))
+            docs = rundb.iterate_runs(collection, query,
+                                      projection=['data.host', 'data.location'],
+                                      batch_size=config.CURSOR_BATCH_SIZE)
 
             for doc in docs:
 
@@ -1222,18 +1509,20 @@ def cax_tape_log_file():
                 "ATTENTION: Specify status by --status [transferred/transferring/error]")
             return 0
 
-        query = {}
-        docs = list(collection.find(query))
         number_name = None
         if args.name is not None:
             number_name = args.name
         else:
             number_name = args.run
 
-        tsm_mover.TSMStatusCheck(docs, args.status).go(number_name)
+        task = tsm_mover.TSMStatusCheck(None, args.status)
+        task.collection = collection
+        task.go(number_name)
 
 
 def ruciax_status():
+    from cax.tasks import filesystem
+
     parser = argparse.ArgumentParser(
         description="Allow to check the run database for rucio entries")
 
@@ -1273,6 +1562,8 @@ def ruciax_status():
 
 
 def remove_from_rucio():
+    from cax.tasks import filesystem
+
     parser = argparse.ArgumentParser(description="Remove data and notify"
                                                  " the run database.")
     parser.add_argument('--location', type=str, required=True,
@@ -1304,6 +1595,8 @@ def remove_from_rucio():
 
 
 def ruciax_purge():
+    from cax.tasks import rucio_mover
+
     # Ask the database for the actual status of the file or folder:
 
     parser = argparse.ArgumentParser(description="Check the database status")
@@ -1357,6 +1650,8 @@ def ruciax_purge():
 
 
 def ruciax_download():
+    from cax.tasks import rucio_mover
+
     # Ask the database for the actual status of the file or folder:
 
     parser = argparse.ArgumentParser(description="Check the database status")
@@ -1476,6 +1771,9 @@ def ruciax_download():
 
 
 def ruciax_locator():
+    from cax import mirror
+    from cax.tasks import rucio_mover
+
     # Ask the database for the actual status of the file or folder:
 
     parser = argparse.ArgumentParser(description="Check the database status")
@@ -1499,6 +1797,9 @@ def ruciax_locator():
     parser.add_argument('--method', type=str, required=True,
                         dest='method',
                         help="Select method: [SingleRun] (--run) | [Status] (--status) | [CheckRSEMultiple] (--rse) |  [CheckRSESingle] (--rse) | [MultiCopies] (--copies) | [ListSingleRules] (--run/--name)")
+    parser.add_argument('--mirror', nargs='?', const=mirror.DEFAULT_PATH,
+                        help="Read runs from the local mirror kept by "
+                             "cax-mirror, optionally at this path")
 
     args = parser.parse_args()
 
@@ -1538,8 +1839,11 @@ def ruciax_locator():
     else:
         number_name = args.run
 
-    rucio_mover.RucioLocator(args.rse, args.copies,
-                             args.method, args.status).go(number_name)
+    task = rucio_mover.RucioLocator(args.rse, args.copies,
+                                    args.method, args.status)
+    if args.mirror:
+        task.collection = mirror_collection(args.mirror)
+    task.go(number_name)
 
 
 if __name__ == '__main__':
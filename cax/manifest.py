@@ -0,0 +1,93 @@
+"""Per-file checksum manifests of run data
+
+A data entry of a run only has one checksum for a whole directory, so a
+single corrupted file used to make RetryBadChecksumTransfer purge and copy
+the whole dataset again.  AddChecksum therefore also records the name, size
+and sha512 of every file of the directories it checksums.  Comparing the
+manifest of a bad copy with the one of a good copy tells which files differ,
+and CopyPull can re-fetch only those.
+
+Manifests are kept in their own 'manifests' collection, one document per
+data entry, keyed by its datum_id, so that run documents stay small.
+"""
+
+import datetime
+import logging
+
+import pymongo
+
+from cax import config, rundb
+
+COLLECTION = 'manifests'
+
+MANIFEST_INDEXES = (
+    (('datum_id', 1),),
+    (('run_id', 1),),
+)
+
+# Digest recorded for each file
+ALGORITHM = 'sha512'
+
+
+def collection():
+    return config.mongo_collection(COLLECTION)
+
+
+def files(dir_digests):
+    """Manifest entries of a digest.DirDigests, in checksumdir order"""
+    return [{'name': name, 'size': size, ALGORITHM: digests[ALGORITHM]}
+            for name, size, digests in dir_digests.files]
+
+
+def save(run_doc, data_doc, checksum, entries, log=logging):
+    """Record the manifest of a data entry of a run"""
+    if data_doc.get('datum_id') is None or not config.DATABASE_LOG:
+        return
+    try:
+        collection().replace_one({'datum_id': data_doc['datum_id']},
+                                 {'datum_id': data_doc['datum_id'],
+                                  'run_id': run_doc['_id'],
+                                  'host': data_doc.get('host'),
+                                  'type': data_doc.get('type'),
+                                  'checksum': checksum,
+                                  'files': entries,
+                                  'creation_time': datetime.datetime.utcnow()},
+                                 upsert=True)
+    except pymongo.errors.ConnectionFailure as e:
+        # Only an optimization, the checksum itself is in the run document
+        log.warning("Could not save the manifest of %s: %s" %
+                    (data_doc.get('location'), e))
+
+
+def load(data_doc):
+    """Manifest of a data entry of a run, None if it has none"""
+    if data_doc.get('datum_id') is None:
+        return None
+    return collection().find_one({'datum_id': data_doc['datum_id']})
+
+
+def delete(data_doc):
+    if data_doc.get('datum_id') is not None and config.DATABASE_LOG:
+        collection().delete_one({'datum_id': data_doc['datum_id']})
+
+
+def diff(manifest, reference):
+    """Compare a manifest with the one of a good copy
+
+    Returns the names of the files that differ, that are missing and that
+    should not be there.
+    """
+    have = {entry['name']: entry for entry in manifest['files']}
+    want = {entry['name']: entry for entry in reference['files']}
+
+    changed = sorted(name for name in set(have) & set(want)
+                     if (have[name]['size'], have[name][ALGORITHM]) !=
+                     (want[name]['size'], want[name][ALGORITHM]))
+    missing = sorted(set(want) - set(have))
+    extra = sorted(set(have) - set(want))
+    return changed, missing, extra
+
+
+def ensure_indexes(create=True, log=logging):
+    return rundb.ensure_indexes(collection(), create=create, log=log,
+                                indexes=MANIFEST_INDEXES)
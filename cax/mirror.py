@@ -0,0 +1,413 @@
+"""Local mirror of the runs database for read-only commands
+
+Commands such as ruciax-locator, cax-status or cax-stray only read run
+documents, but scan the whole runs collection over the WAN for it.  A
+RunMirror keeps the run fields cax needs in a local SQLite file, synced
+incrementally by cax-mirror from the last_modified watermark, with a full
+resync now and then to pick up deleted runs and writers that do not stamp
+last_modified.  Its collection() can be given to tasks instead of the runs
+collection: it answers the queries cax makes, for reading only.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import pymongo
+from bson import json_util
+
+from cax import config, rundb
+
+# Where the mirror is kept unless told otherwise
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cax', 'runs_mirror.sqlite')
+
+# Run document fields kept in the mirror
+MIRROR_FIELDS = ('number', 'name', 'start', 'end', 'detector', 'tags', 'data',
+                 'source', 'trigger.events_built', 'user', 'last_modified')
+
+# Seconds between full resyncs
+FULL_SYNC_INTERVAL = 24 * 3600
+
+# Mirrors older than this many seconds are reported as stale
+MAX_AGE = 3600
+
+# Fields of the data locations of a run that have an index, for the
+# $elemMatch queries on 'data' that nearly every task makes
+LOCATION_FIELDS = ('host', 'type', 'status')
+
+# Version of the tables below, mirrors of older versions are resynced fully
+SCHEMA_VERSION = 2
+
+JSON_OPTIONS = json_util.JSONOptions(json_mode=json_util.JSONMode.RELAXED,
+                                     tz_aware=False)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id TEXT PRIMARY KEY, number INTEGER,
+                                 name TEXT, doc TEXT);
+CREATE INDEX IF NOT EXISTS runs_number ON runs (number);
+CREATE INDEX IF NOT EXISTS runs_name ON runs (name);
+CREATE TABLE IF NOT EXISTS locations (id TEXT, host TEXT, type TEXT,
+                                      status TEXT);
+CREATE INDEX IF NOT EXISTS locations_id ON locations (id);
+CREATE INDEX IF NOT EXISTS locations_host ON locations (host, status, type);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+"""
+
+
+class ReadOnlyError(pymongo.errors.PyMongoError):
+    """Raised on writes to the run mirror"""
+
+
+class RunMirror:
+    """SQLite copy of the fields cax needs of every run document
+
+    The host, type and status of the data locations of the runs are also
+    kept in an indexed table, so that the queries on them only decode the
+    documents of the runs they select.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.indexed = self.meta('schema') == SCHEMA_VERSION
+
+    def meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?',
+                                      (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                (key, value))
+
+    def age(self, now=None):
+        """Seconds since the data was last synced, None if never"""
+        synced = self.meta('synced_at')
+        if synced is None:
+            return None
+        return (time.time() if now is None else now) - synced
+
+    def sync(self, collection, full=None, log=logging):
+        """Copy runs changed since the last sync, returns how many
+
+        A full resync replaces all runs.  By default it is done on the first
+        sync and every FULL_SYNC_INTERVAL.  Readers see the old state until
+        the sync completes.
+        """
+        started = time.time()
+        synced = self.meta('synced_at')
+        full_synced = self.meta('full_synced_at')
+        if full is None:
+            full = (synced is None or full_synced is None or
+                    not self.indexed or
+                    started - full_synced > FULL_SYNC_INTERVAL)
+
+        query = {}
+        if not full:
+            since = datetime.datetime.utcfromtimestamp(synced)
+            query = rundb.watermark_query(since - rundb.WATERMARK_OVERLAP)
+
+        count = 0
+        with self.lock, self.connection:
+            if full:
+                self.connection.execute('DELETE FROM runs')
+                self.connection.execute('DELETE FROM locations')
+
+            for doc in rundb.iterate_runs(collection, query,
+                                          projection=MIRROR_FIELDS,
+                                          batch_size=config.CURSOR_BATCH_SIZE,
+                                          log=log):
+                run_id = str(doc['_id'])
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                    (run_id, doc.get('number'), doc.get('name'),
+                     json_util.dumps(doc, json_options=JSON_OPTIONS)))
+                self.connection.execute('DELETE FROM locations WHERE id = ?',
+                                        (run_id,))
+                self.connection.executemany(
+                    'INSERT INTO locations VALUES (?, ?, ?, ?)',
+                    [(run_id,) + tuple(datum.get(field)
+                                       for field in LOCATION_FIELDS)
+                     for datum in doc.get('data') or []
+                     if isinstance(datum, dict)])
+                count += 1
+
+            self.set_meta('synced_at', started)
+            if full:
+                self.set_meta('full_synced_at', started)
+                self.set_meta('schema', SCHEMA_VERSION)
+                self.indexed = True
+
+        log.info("%s sync of %s: %d runs" % ('Full' if full else 'Incremental',
+                                             self.path, count))
+        return count
+
+    def collection(self):
+        return MirrorCollection(self)
+
+    def check_age(self, log=logging):
+        """Log how fresh the mirror is, warn if it is stale"""
+        age = self.age()
+        if age is None:
+            log.warning("Run mirror %s was never synced, run cax-mirror" %
+                        self.path)
+        elif age > MAX_AGE:
+            log.warning("Run mirror %s is stale, last synced %d s ago" %
+                        (self.path, age))
+        else:
+            log.info("Run mirror %s synced %d s ago" % (self.path, age))
+
+    def close(self):
+        self.connection.close()
+
+
+class MirrorCollection:
+    """Read-only stand-in for the runs collection, backed by a RunMirror"""
+
+    name = 'runs_mirror'
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def find(self, filter=None, projection=None, sort=None):
+        filter = filter or {}
+        where, params = index_condition(filter, self.mirror.indexed)
+        with self.mirror.lock:
+            rows = self.mirror.connection.execute(
+                'SELECT doc FROM runs' + where, params).fetchall()
+
+        docs = [json_util.loads(doc, json_options=JSON_OPTIONS)
+                for doc, in rows]
+        docs = [doc for doc in docs if matches(doc, filter)]
+        for key, direction in reversed(list(sort or [])):
+            docs.sort(key=lambda doc: sort_key(values_at(doc, key)),
+                      reverse=direction < 0)
+        return MirrorCursor([project(doc, projection) for doc in docs])
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        for doc in self.find(filter, projection, sort):
+            return doc
+        return None
+
+    def count_documents(self, filter):
+        return len(self.find(filter).docs)
+
+    def read_only(self, *args, **kwargs):
+        raise ReadOnlyError("The run mirror is read-only")
+
+    insert_one = insert_many = update = update_one = update_many = \
+        find_one_and_update = bulk_write = delete_one = delete_many = read_only
+
+
+class MirrorCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def batch_size(self, n):
+        return self
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+def index_condition(query, locations=True):
+    """SQL condition on the indexed columns implied by a query
+
+    Conditions on the data locations are used too if 'locations'.
+    """
+    equalities = {}
+    conditions = []
+    for part in [query] + list(query.get('$and', [])):
+        for key in ('number', 'name'):
+            value = part.get(key)
+            if value is not None and not isinstance(value, dict):
+                equalities[key] = value
+
+        if not locations:
+            continue
+        for key, value in part.items():
+            if key == 'data' and isinstance(value, dict) and \
+                    isinstance(value.get('$elemMatch'), dict):
+                condition = location_condition(value['$elemMatch'])
+            elif key.startswith('data.') and \
+                    key[len('data.'):] in LOCATION_FIELDS:
+                condition = location_condition({key[len('data.'):]: value})
+            else:
+                condition = None
+            if condition is not None:
+                conditions.append(condition)
+
+    keys = sorted(equalities)
+    conditions = [('%s = ?' % key, (equalities[key],))
+                  for key in keys] + conditions
+    if not conditions:
+        return '', ()
+    return (' WHERE ' + ' AND '.join(sql for sql, _ in conditions),
+            tuple(param for _, params in conditions for param in params))
+
+
+def location_condition(condition):
+    """SQL condition selecting the runs with a data location satisfying the
+    equalities and $in of a condition on it, None if it has none
+    """
+    clauses = []
+    params = []
+    for field in LOCATION_FIELDS:
+        value = condition.get(field)
+        if isinstance(value, dict) and list(value) == ['$in']:
+            values = list(value['$in'])
+        else:
+            values = [value]
+        # null also matches a missing field, which the table cannot tell
+        if not values or not all(isinstance(v, str) for v in values):
+            continue
+        clauses.append('%s IN (%s)' % (field, ', '.join('?' * len(values))))
+        params.extend(values)
+
+    if not clauses:
+        return None
+    return ('id IN (SELECT id FROM locations WHERE %s)' % ' AND '.join(clauses),
+            tuple(params))
+
+
+def values_at(doc, path):
+    """Values at a dotted path, descending into arrays like MongoDB does"""
+    values = [doc]
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit() and int(key) < len(value):
+                    found.append(value[int(key)])
+                found.extend(item[key] for item in value
+                             if isinstance(item, dict) and key in item)
+        values = found
+    return values
+
+
+def sort_key(values):
+    # Missing values and null sort first, like in MongoDB
+    value = values[0] if values else None
+    return (0, 0) if value is None else (1, value)
+
+
+def candidates(values):
+    """Values compared against a condition: arrays match on any element"""
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            yield from value
+
+
+def compare(values, test):
+    for value in candidates(values):
+        try:
+            if test(value):
+                return True
+        except TypeError:
+            pass
+    return False
+
+
+def matches_field(values, condition):
+    """Whether the values at a field path satisfy a query condition"""
+    if not (isinstance(condition, dict) and condition and
+            all(key.startswith('$') for key in condition)):
+        if condition is None and not values:
+            return True
+        return any(value == condition for value in candidates(values))
+
+    for op, arg in condition.items():
+        if op == '$eq':
+            ok = matches_field(values, arg)
+        elif op == '$ne':
+            ok = not matches_field(values, arg)
+        elif op == '$in':
+            ok = any(matches_field(values, item) for item in arg)
+        elif op == '$nin':
+            ok = not any(matches_field(values, item) for item in arg)
+        elif op == '$gt':
+            ok = compare(values, lambda value: value > arg)
+        elif op == '$gte':
+            ok = compare(values, lambda value: value >= arg)
+        elif op == '$lt':
+            ok = compare(values, lambda value: value < arg)
+        elif op == '$lte':
+            ok = compare(values, lambda value: value <= arg)
+        elif op == '$exists':
+            ok = bool(values) == bool(arg)
+        elif op == '$not':
+            ok = not matches_field(values, arg)
+        elif op == '$elemMatch':
+            ok = any(elem_matches(item, arg)
+                     for value in values if isinstance(value, list)
+                     for item in value)
+        else:
+            raise NotImplementedError("Run mirror cannot evaluate %s" % op)
+        if not ok:
+            return False
+    return True
+
+
+def elem_matches(item, condition):
+    if any(not key.startswith('$') for key in condition):
+        return isinstance(item, dict) and matches(item, condition)
+    return matches_field([item], condition)
+
+
+def matches(doc, query):
+    """Whether a document matches a MongoDB query, for the operators cax uses"""
+    for key, condition in query.items():
+        if key == '$and':
+            ok = all(matches(doc, part) for part in condition)
+        elif key == '$or':
+            ok = any(matches(doc, part) for part in condition)
+        elif key == '$nor':
+            ok = not any(matches(doc, part) for part in condition)
+        else:
+            ok = matches_field(values_at(doc, key), condition)
+        if not ok:
+            return False
+    return True
+
+
+def project(doc, projection):
+    """Copy of a document with only the fields of an inclusion projection"""
+    if projection is None:
+        return doc
+    if isinstance(projection, dict):
+        projection = [key for key, include in projection.items() if include]
+
+    result = {'_id': doc['_id']} if '_id' in doc else {}
+    for path in projection:
+        copy_path(doc, result, path.split('.'))
+    return result
+
+
+def copy_path(source, target, keys):
+    key, rest = keys[0], keys[1:]
+    if not isinstance(source, dict) or key not in source:
+        return
+    value = source[key]
+    if not rest:
+        target[key] = value
+    elif isinstance(value, dict):
+        copy_path(value, target.setdefault(key, {}), rest)
+    elif isinstance(value, list):
+        items = target.setdefault(key, [{} for _ in value])
+        for item, projected in zip(value, items):
+            copy_path(item, projected, rest)
@@ -0,0 +1,724 @@
+"""Run database access helpers
+
+Shared routines for reading the runs collection efficiently, used by the task
+framework and the command line drivers.
+"""
+
+import copy
+import datetime
+import logging
+import threading
+import time
+
+import pymongo
+from bson.objectid import ObjectId
+
+# Default sort used when iterating over runs: newest first.  The '_id' makes
+# the order total, which is required to resume an interrupted iteration.
+RUN_SORT = (('start', -1), ('_id', -1))
+
+# Maximum number of consecutive cursor failures before giving up a pass
+MAX_CURSOR_RETRIES = 5
+
+# Safety margin for clock differences when polling the last_modified watermark
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+
+# Sort of the massive drivers, newest first
+DRIVER_SORT = (('start', -1), ('number', -1), ('detector', -1), ('_id', -1))
+
+# Indexes supporting the queries cax makes on the runs collection.  The
+# 'data' ones are multikey indexes, used by $elemMatch on data locations.
+RUN_INDEXES = (
+    (('number', 1), ('detector', 1)),
+    (('name', 1),),
+    RUN_SORT,
+    DRIVER_SORT,
+    (('tags.name', 1),),
+    (('data.host', 1), ('data.status', 1), ('data.type', 1)),
+    (('data.host', 1), ('data.type', 1), ('data.pax_version', 1)),
+    (('data.datum_id', 1),),
+    (('last_modified', 1),),
+)
+
+
+def resume_query(sort, last_doc):
+    """Query selecting documents after last_doc in the given sort order
+
+    For a sort (k1, k2, ..., kn) this builds the usual keyset pagination
+    condition: k1 past last, or k1 equal and k2 past last, etc.
+
+    Null and missing values sort before all others, but compare neither
+    less nor greater than them, so they get clauses of their own.
+    """
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        equal = {k: last_doc.get(k) for k, _ in sort[:i]}
+        value = last_doc.get(key)
+        if value is None:
+            # Only non-null values come after null in ascending order
+            past = [{'$ne': None}] if direction > 0 else []
+        elif direction < 0:
+            past = [{'$lt': value}, None]
+        else:
+            past = [{'$gt': value}]
+        clauses.extend(dict(equal, **{key: condition}) for condition in past)
+    return {'$or': clauses}
+
+
+def iterate_runs(collection, query=None, projection=None, sort=RUN_SORT,
+                 batch_size=100, log=logging):
+    """Stream run documents matching query through a batched cursor
+
+    If the cursor dies (e.g. CursorNotFound because a task spent more than
+    the server cursor timeout on a run), iteration resumes after the last
+    document yielded instead of starting over.
+    """
+    query = query if query is not None else {}
+    sort = tuple(sort)
+
+    # Sort keys are needed to know where to resume
+    if projection is not None:
+        projection = dict.fromkeys(projection, True) \
+            if not isinstance(projection, dict) else dict(projection)
+        for key, _ in sort:
+            projection[key] = True
+
+    last_doc = None
+    retries = 0
+
+    while True:
+        this_query = query
+        if last_doc is not None:
+            this_query = {'$and': [query, resume_query(sort, last_doc)]}
+
+        cursor = collection.find(this_query,
+                                 projection=projection,
+                                 sort=list(sort))
+        cursor.batch_size(batch_size)
+
+        try:
+            for doc in cursor:
+                retries = 0
+                last_doc = doc
+                yield doc
+            return
+
+        except (pymongo.errors.CursorNotFound,
+                pymongo.errors.AutoReconnect) as e:
+            retries += 1
+            if retries > MAX_CURSOR_RETRIES:
+                log.error("Cursor failed %d times, giving up: %s" % (retries,
+                                                                     e))
+                return
+            log.warning("%s, resuming after %s" % (e.__class__.__name__,
+                                                   None if last_doc is None
+                                                   else last_doc.get('_id')))
+
+        finally:
+            cursor.close()
+
+
+def run_query(specify_run=None):
+    """Query selecting a single run by number or name, or all runs"""
+    query = {}
+
+    # argument can be run number or run name
+    if specify_run is not None:
+        if isinstance(specify_run, int):
+            query['number'] = specify_run
+        elif isinstance(specify_run, str):
+            query['name'] = specify_run
+
+    return query
+
+
+def new_datum_id():
+    """Immutable id for a new data entry of a run"""
+    return ObjectId()
+
+
+def datum_filter(datum):
+    """Condition selecting one data entry of a run
+
+    Entries are matched by their datum_id.  Entries created before these
+    existed are matched on all their fields.
+    """
+    if datum.get('datum_id') is not None:
+        return {'datum_id': datum['datum_id']}
+    return datum
+
+
+def datum_query(run_id, datum):
+    """Query for a positional ('data.$') update of one data entry of a run"""
+    return {'_id': run_id, 'data': {'$elemMatch': datum_filter(datum)}}
+
+
+def union_projection(tasks):
+    """Smallest projection serving all tasks, or None for whole documents"""
+    fields = set()
+    for task in tasks:
+        projection = task.projection()
+        if projection is None:
+            return None
+        fields.update(projection)
+
+    # MongoDB refuses e.g. both 'processor' and 'processor.DEFAULT'
+    return sorted(field for field in fields
+                  if not any(field.startswith(other + '.')
+                             for other in fields))
+
+
+def stamp(update):
+    """Add a last_modified timestamp to an update document
+
+    Replacement documents are left untouched.
+    """
+    if not update or not all(key.startswith('$') for key in update):
+        return update
+
+    update = dict(update)
+    current_date = dict(update.get('$currentDate', {}))
+    current_date['last_modified'] = True
+    update['$currentDate'] = current_date
+    return update
+
+
+def stamped(collection):
+    """Wrap a runs collection so that every update stamps last_modified"""
+    if isinstance(collection, StampedCollection):
+        return collection
+    return StampedCollection(collection)
+
+
+def primary(collection):
+    """The collection reading from the primary, for reads that must see the
+    latest writes rather than what a secondary has replicated so far
+    """
+    with_options = getattr(collection, 'with_options', None)
+    if with_options is None:
+        return collection
+    return with_options(read_preference=pymongo.ReadPreference.PRIMARY)
+
+
+def unstamped(doc):
+    """A run document without the last_modified timestamp of stamp()"""
+    return {key: value for key, value in doc.items() if key != 'last_modified'}
+
+
+def watermark_query(since):
+    """Query selecting runs created or modified since a UTC datetime"""
+    return {'$or': [{'last_modified': {'$gte': since}},
+                    {'_id': {'$gte': ObjectId.from_datetime(since)}}]}
+
+
+def ensure_indexes(collection, create=True, log=logging, indexes=RUN_INDEXES):
+    """Check the indexes cax relies on exist, creating the missing ones
+
+    Returns (index keys, state) pairs, where the state is 'exists', 'created'
+    or, without create, 'missing'.
+    """
+    existing = set(tuple((key, int(direction)) for key, direction in info['key'])
+                   for info in collection.index_information().values())
+
+    states = []
+    missing = []
+    for keys in indexes:
+        if tuple(keys) in existing:
+            states.append((keys, 'exists'))
+        elif create:
+            missing.append(keys)
+            states.append((keys, 'created'))
+        else:
+            states.append((keys, 'missing'))
+
+    if missing:
+        # Foreground builds, the default before MongoDB 4.2, lock the whole
+        # database until done, which on the multikey 'data' indexes of the
+        # runs collection takes long
+        log.info("Creating %d indexes on %s in the background" %
+                 (len(missing), collection.name))
+        collection.create_indexes([pymongo.IndexModel(list(keys),
+                                                      background=True)
+                                   for keys in missing])
+    return states
+
+
+def canonical_queries(hostname, pax_version='v6.8.0'):
+    """The typical queries cax makes for a host, by description
+
+    Values are (query, sort) pairs, sort None if the query is not sorted.
+    Run numbers, names and the pax version are examples, the query plans
+    do not depend on them.
+    """
+    here = {'host': hostname, 'status': 'transferred'}
+    return {
+        'run by number': ({'number': 6000, 'detector': 'tpc'}, None),
+        'run by name': ({'name': '170101_1200'}, None),
+        'runs newest first': ({}, RUN_SORT),
+        'runs of a tag': ({'tags.name': '_sciencerun0'}, DRIVER_SORT),
+        'runs started since': ({'start': {'$gt': datetime.datetime(2017, 1, 1)}},
+                               DRIVER_SORT),
+        'data here': ({'data': {'$elemMatch': here}}, RUN_SORT),
+        'data to verify here': ({'data': {'$elemMatch': {'host': hostname,
+                                                        'status': 'verifying'}}},
+                                RUN_SORT),
+        'raw data here': ({'data': {'$elemMatch': dict(here, type='raw')}},
+                          RUN_SORT),
+        'processed data here': ({'data': {'$elemMatch': dict(
+            here, type='processed', pax_version=pax_version)}}, RUN_SORT),
+        'data location by id': ({'data.datum_id': ObjectId()}, None),
+        'runs changed since': (watermark_query(datetime.datetime.utcnow()),
+                               None),
+    }
+
+
+def plan_summary(plan):
+    """Short description of a query plan, e.g. 'FETCH <- IXSCAN name_1'"""
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if 'indexName' in plan:
+            stage += ' ' + plan['indexName']
+        stages.append(stage)
+
+        if 'inputStages' in plan:
+            # e.g. OR of several index scans
+            stage_list = ', '.join(plan_summary(p) for p in plan['inputStages'])
+            stages.append('(%s)' % stage_list)
+            break
+        plan = plan.get('inputStage')
+    return ' <- '.join(stages)
+
+
+def explain_query(collection, query, sort=None):
+    """Summary of the winning plan of a query, or why there is none"""
+    cursor = collection.find(query, sort=list(sort) if sort else None)
+    try:
+        explanation = cursor.explain()
+    except (AttributeError, pymongo.errors.PyMongoError) as e:
+        return 'no plan: %s' % e
+    return plan_summary(explanation.get('queryPlanner', {}).get('winningPlan'))
+
+
+class RunSnapshot:
+    """Run documents loaded once per cycle and shared by all tasks
+
+    Writes made through the 'collection' attribute are forwarded to the run
+    database, after which the affected run documents are re-read and updated
+    in place, so that later tasks in the same cycle see fresh state.
+
+    The snapshot also keeps track of the runs each task of the cycle still
+    has to work on, so that a task can leave a run to a later cycle while a
+    task it runs after is not done with it yet.
+    """
+
+    def __init__(self, collection, query=None, projection=None,
+                 batch_size=100, log=logging):
+        # Refreshed documents keep the sort keys that iterate_runs adds
+        if projection is not None:
+            projection = list(projection) + [key for key, _ in RUN_SORT
+                                             if key not in projection]
+        self.projection = projection
+        self.log = log
+        self.lock = threading.RLock()
+        self.run_locks = {}
+        self.todo = {}
+        self.collection = SnapshotCollection(stamped(collection), self)
+
+        # Runs are re-read after writes, or before a task deletes data
+        self.primary = primary(collection)
+
+        self.runs = list(iterate_runs(collection, query,
+                                      projection=projection,
+                                      batch_size=batch_size,
+                                      log=log))
+        self.by_id = {doc['_id']: doc for doc in self.runs}
+
+        log.debug("Snapshot of %d runs" % len(self.runs))
+
+    def __iter__(self):
+        return iter(list(self.runs))
+
+    def __len__(self):
+        return len(self.runs)
+
+    def writer(self):
+        """New collection proxy, recording the runs changed through it"""
+        return SnapshotCollection(self.collection.collection, self)
+
+    def run_lock(self, run_id):
+        """Lock held by a task while it works on a run"""
+        with self.lock:
+            return self.run_locks.setdefault(run_id, threading.Lock())
+
+    def expect(self, names):
+        """Note that these tasks will work on every run in this cycle"""
+        with self.lock:
+            for name in names:
+                self.todo[name] = set(self.by_id)
+
+    def visited(self, name, run_id):
+        """Note that a task is done with a run in this cycle"""
+        with self.lock:
+            if name in self.todo:
+                self.todo[name].discard(run_id)
+
+    def finished(self, name):
+        """Note that a task is done with all runs in this cycle"""
+        with self.lock:
+            self.todo.pop(name, None)
+
+    def waiting_for(self, run_id, names):
+        """Those of the named tasks that still have to work on a run"""
+        with self.lock:
+            return [name for name in names
+                    if run_id in self.todo.get(name, ())]
+
+    def refresh(self, run_id):
+        """Re-read a run document from the run database, in place
+
+        Returns whether the document changed, not counting last_modified.
+        """
+        with self.lock:
+            doc = self.by_id.get(run_id)
+            if doc is None:
+                return False
+
+            collection = self.primary
+            try:
+                fresh = collection.find_one({'_id': run_id},
+                                            projection=self.projection)
+            except pymongo.errors.ConnectionFailure:
+                # The write went to the journal, see cax.journal
+                if not hasattr(collection, 'overlay'):
+                    raise
+                fresh = collection.overlay(doc)
+            if fresh is None:
+                return False
+
+            # Values are replaced, not changed in place, so a shallow copy
+            # keeps the old ones
+            before = dict(doc)
+
+            # Other tasks may be reading this document: never leave it
+            # half empty
+            doc.update(fresh)
+            for key in set(doc) - set(fresh):
+                del doc[key]
+
+            return unstamped(before) != unstamped(doc)
+
+    def covers(self, update):
+        """Whether the fields an update writes are in the snapshot"""
+        if self.projection is None:
+            return True
+        if not update or not all(key.startswith('$') for key in update):
+            return False
+        return all(any(path == field or path.startswith(field + '.')
+                       for field in self.projection)
+                   for op, fields in update.items()
+                   if op != '$currentDate'
+                   for path in fields)
+
+    def matching_ids(self, query):
+        """Ids of the snapshot runs a write with this query may change"""
+        run_id = query.get('_id')
+        if run_id is not None and not isinstance(run_id, dict):
+            return [run_id]
+
+        try:
+            return [doc['_id'] for doc in
+                    self.primary.find(query, projection=['_id'])
+                    if doc['_id'] in self.by_id]
+        except pymongo.errors.ConnectionFailure:
+            if not hasattr(self.primary, 'overlay'):
+                raise
+            # Journaled write while the database is down: match the
+            # snapshot documents instead
+            from cax.mirror import matches
+            with self.lock:
+                return [doc['_id'] for doc in self.runs if matches(doc, query)]
+
+
+class SnapshotCollection:
+    """Collection proxy keeping a RunSnapshot in sync with writes
+
+    'changed' collects the ids of the runs the writes actually changed:
+    writing the values a run already has does not count.
+    """
+
+    def __init__(self, collection, snapshot):
+        self.collection = collection
+        self.snapshot = snapshot
+        self.changed = set()
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def record(self, run_ids, updates):
+        """Refresh the runs written to and note those that changed"""
+        # Changes of fields outside the snapshot cannot be seen
+        covered = all(self.snapshot.covers(update) for update in updates)
+        changed = set()
+        for run_id in run_ids:
+            if self.snapshot.refresh(run_id) or not covered:
+                changed.add(run_id)
+        with self.snapshot.lock:
+            self.changed.update(changed)
+
+    def _write(self, method, query, update, *args, **kwargs):
+        # Look up affected runs first: the write may change what matches
+        run_ids = self.snapshot.matching_ids(query)
+        result = getattr(self.collection, method)(query, update,
+                                                  *args, **kwargs)
+        self.record(run_ids, [update])
+        return result
+
+    def update(self, query, update, *args, **kwargs):
+        return self._write('update', query, update, *args, **kwargs)
+
+    def update_one(self, query, update, *args, **kwargs):
+        return self._write('update_one', query, update, *args, **kwargs)
+
+    def update_many(self, query, update, *args, **kwargs):
+        return self._write('update_many', query, update, *args, **kwargs)
+
+    def replace_one(self, query, replacement, *args, **kwargs):
+        return self._write('replace_one', query, replacement, *args, **kwargs)
+
+    def bulk_write(self, requests, *args, **kwargs):
+        run_ids = set()
+        for request in requests:
+            run_ids.update(self.snapshot.matching_ids(request._filter))
+        result = self.collection.bulk_write(requests, *args, **kwargs)
+        self.record(run_ids, [request._doc for request in requests])
+        return result
+
+    def find_one_and_update(self, query, update, *args, **kwargs):
+        result = self.collection.find_one_and_update(query, update,
+                                                     *args, **kwargs)
+        if result is not None:
+            self.record([result['_id']], [update])
+        return result
+
+
+class StampedCollection:
+    """Collection proxy adding the last_modified timestamp to every update
+
+    The change tracker only sees runs written through it, see stamp().
+    Replaced documents get the time of this host instead.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def with_options(self, *args, **kwargs):
+        return StampedCollection(self.collection.with_options(*args, **kwargs))
+
+    @staticmethod
+    def stamp_replacement(replacement):
+        return dict(replacement, last_modified=datetime.datetime.utcnow())
+
+    def update(self, query, update, *args, **kwargs):
+        # The legacy update also replaces documents
+        if update and not all(key.startswith('$') for key in update):
+            update = self.stamp_replacement(update)
+        return self.collection.update(query, stamp(update), *args, **kwargs)
+
+    def update_one(self, query, update, *args, **kwargs):
+        return self.collection.update_one(query, stamp(update), *args, **kwargs)
+
+    def update_many(self, query, update, *args, **kwargs):
+        return self.collection.update_many(query, stamp(update),
+                                           *args, **kwargs)
+
+    def find_one_and_update(self, query, update, *args, **kwargs):
+        return self.collection.find_one_and_update(query, stamp(update),
+                                                   *args, **kwargs)
+
+    def replace_one(self, query, replacement, *args, **kwargs):
+        return self.collection.replace_one(
+            query, self.stamp_replacement(replacement), *args, **kwargs)
+
+    def find_one_and_replace(self, query, replacement, *args, **kwargs):
+        return self.collection.find_one_and_replace(
+            query, self.stamp_replacement(replacement), *args, **kwargs)
+
+    def bulk_write(self, requests, *args, **kwargs):
+        stamped_requests = []
+        for request in requests:
+            if isinstance(request, (pymongo.UpdateOne, pymongo.UpdateMany,
+                                    pymongo.ReplaceOne)):
+                request = copy.copy(request)
+                if isinstance(request, pymongo.ReplaceOne):
+                    request._doc = self.stamp_replacement(request._doc)
+                else:
+                    request._doc = stamp(request._doc)
+            stamped_requests.append(request)
+        return self.collection.bulk_write(stamped_requests, *args, **kwargs)
+
+
+class WriteBuffer:
+    """Collect run updates and send them with few bulk_write calls
+
+    Updates are flushed once max_ops are waiting, once the oldest waited
+    max_delay seconds, or when flush() is called.  Unless two updates touch
+    the same run, their order does not matter and they are sent unordered.
+    """
+
+    def __init__(self, collection, max_ops=100, max_delay=10, log=logging):
+        self.collection = collection
+        self.max_ops = max_ops
+        self.max_delay = max_delay
+        self.log = log
+        self.lock = threading.Lock()
+        self.ops = []
+        self.since = None
+
+    def update(self, query, update, multi=False):
+        """Queue an update, as collection.update would apply it"""
+        op = pymongo.UpdateMany if multi else pymongo.UpdateOne
+        with self.lock:
+            if not self.ops:
+                self.since = time.time()
+            self.ops.append(op(query, stamp(update)))
+        self.flush_if_due()
+
+    def pending(self, run_id):
+        """Whether queued updates may touch a run"""
+        with self.lock:
+            # Only an update of one other run by _id surely does not
+            return any(set(op._filter) != {'_id'} or
+                       isinstance(op._filter['_id'], dict) or
+                       op._filter['_id'] == run_id
+                       for op in self.ops)
+
+    def flush_if_due(self):
+        with self.lock:
+            due = len(self.ops) >= self.max_ops or \
+                (self.ops and time.time() - self.since >= self.max_delay)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Send all queued updates"""
+        with self.lock:
+            ops, self.ops = self.ops, []
+        if not ops:
+            return None
+
+        # Only updates of distinct, single runs can be reordered
+        run_ids = [op._filter.get('_id') for op in ops]
+        ordered = any(run_id is None or isinstance(run_id, dict)
+                      for run_id in run_ids) or \
+            len(set(map(str, run_ids))) < len(ops)
+
+        self.log.debug("Writing %d updates%s" % (len(ops),
+                                               '' if ordered else
+                                               ' (unordered)'))
+        return self.collection.bulk_write(ops, ordered=ordered)
+
+
+class RunChangeTracker:
+    """Decide which runs a daemon cycle needs to look at
+
+    After an initial full pass, only runs changed since the previous cycle
+    are selected.  Changes are taken from a MongoDB change stream, or, where
+    change streams are not available, from the last_modified timestamp that
+    cax writes set (and the creation time encoded in '_id').  Writes that do
+    not set last_modified are picked up by the full reconciliation pass that
+    runs every full_interval seconds.
+
+    When not all tasks run every cycle, each keeps its own set of changes
+    still to look at and its own time of the last full pass.
+    """
+
+    def __init__(self, collection, full_interval=3600, log=logging):
+        self.collection = collection
+        self.full_interval = full_interval
+        self.log = log
+        self.stream = None
+        self.watermark = None
+        self.last_full = {}
+        self.pending = {}
+        self.open()
+
+    def open(self):
+        """Start recording changes"""
+        self.watermark = datetime.datetime.utcnow()
+        try:
+            self.stream = self.collection.watch(
+                [{'$project': {'documentKey': 1}}])
+        except Exception as e:
+            # Standalone or old servers have no change streams
+            self.log.info("Change streams unavailable (%s), using "
+                          "last_modified watermark" % e)
+            self.stream = None
+
+    def changed_ids(self):
+        """Ids of the runs changed since the previous call
+
+        Returns None if this is not known, e.g. the change stream broke.
+        """
+        if self.stream is not None:
+            ids = set()
+            try:
+                while True:
+                    change = self.stream.try_next()
+                    if change is None:
+                        return ids
+                    ids.add(change['documentKey']['_id'])
+            except pymongo.errors.PyMongoError as e:
+                self.log.warning("Change stream lost: %s" % e)
+                self.stream.close()
+                self.open()
+                return None
+
+        now = datetime.datetime.utcnow()
+        since = self.watermark - WATERMARK_OVERLAP
+        ids = set(doc['_id'] for doc in
+                  self.collection.find(watermark_query(since),
+                                       projection=['_id']))
+        self.watermark = now
+        return ids
+
+    def poll(self):
+        """Record the runs changed since the last call
+
+        Returns whether there were any, or it is not known.
+        """
+        changed = self.changed_ids()
+
+        if changed is None:
+            # Unknown what changed, everybody needs a full pass
+            self.last_full = {}
+            return True
+
+        for ids in self.pending.values():
+            ids.update(changed)
+        return len(changed) > 0
+
+    def cycle_query(self, query, names=(None,)):
+        """Query selecting the runs for this cycle of the named tasks"""
+        self.poll()
+        now = time.time()
+
+        if any(name not in self.last_full or
+               now - self.last_full[name] >= self.full_interval
+               for name in names):
+            self.log.info("Full reconciliation pass")
+            for name in names:
+                self.last_full[name] = now
+                self.pending[name] = set()
+            return query
+
+        ids = set()
+        for name in names:
+            ids.update(self.pending[name])
+            self.pending[name] = set()
+
+        self.log.info("Incremental pass over %d changed runs" % len(ids))
+        return {'$and': [query, {'_id': {'$in': sorted(ids)}}]}
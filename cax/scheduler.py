@@ -0,0 +1,148 @@
+"""Decide when tasks run, and run them concurrently where independent
+
+Tasks declare which other tasks must have worked on a run first in the same
+cycle through their 'after' attribute, e.g. AddChecksum runs after CopyPull
+for the same run.  That order is kept per run, see RunSnapshot.expect, so
+a long task does not hold up the runs it is done with: all tasks may run at
+the same time on a thread pool, started in dependency order.
+
+Each task is rerun every 'interval' seconds while it finds work, backs off
+exponentially while it does not, and is rerun immediately if it left a
+backlog or a task it runs after did some work.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def task_name(task):
+    return task.__class__.__name__
+
+
+def dependencies(tasks):
+    """Map each task name to the names it waits for in this task list
+
+    Dependencies on tasks that are not in the list are ignored, so the user
+    task list in cax.json can select any subset of tasks.
+    """
+    names = set(task_name(task) for task in tasks)
+    return {task_name(task): [name for name in task.after if name in names]
+            for task in tasks}
+
+
+def run_task_graph(tasks, run, max_workers=1, log=logging):
+    """Call run(task) for every task, starting tasks after their dependencies
+
+    A task may start once the tasks it runs after have started, the order
+    for each run is kept by the tasks themselves.  Ready tasks are started
+    in list order, so with a single worker each task finishes before the
+    tasks that run after it start.  If a task raises, no new tasks are
+    started, the running ones are waited for and the exception is re-raised.
+    """
+    depends = dependencies(tasks)
+    pending = list(tasks)
+    started = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for task in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if all(name in started for name in depends[task_name(task)]):
+                    pending.remove(task)
+                    started.add(task_name(task))
+                    running[pool.submit(run, task)] = task
+
+            if not running:
+                raise ValueError("Circular task dependencies between %s" %
+                                 ', '.join(task_name(task) for task in pending))
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                future.result()
+                log.debug("%s finished" % task_name(task))
+
+
+class AdaptiveSchedule:
+    """When each task, or driver loop, should run next"""
+
+    def __init__(self, interval=60, max_interval=3600, backoff=2):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.base = {}
+        self.intervals = {}
+        self.next_run = {}
+        self.followers = {}
+
+    def add(self, name, interval=None, after=()):
+        """Schedule a task, due right away"""
+        with self.lock:
+            self.base[name] = interval or self.interval
+            self.intervals[name] = self.base[name]
+            self.next_run[name] = 0
+            for other in after:
+                self.followers.setdefault(other, set()).add(name)
+
+    def wake(self, now=None):
+        """Make all tasks due, e.g. because new runs showed up"""
+        now = time.time() if now is None else now
+        with self.lock:
+            for name in self.next_run:
+                self.intervals[name] = self.base[name]
+                self.next_run[name] = min(self.next_run[name], now)
+
+    def due(self, now=None):
+        """Names of the tasks to run now, in the order they were added"""
+        now = time.time() if now is None else now
+        with self.lock:
+            return [name for name, when in self.next_run.items()
+                    if when <= now]
+
+    def record(self, name, work=None, backlog=0, now=None):
+        """Schedule the next run of a task after a pass
+
+        work is the amount of work the pass did, None if unknown, backlog
+        the amount it left for later.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if backlog:
+                self.intervals[name] = self.base[name]
+                self.next_run[name] = now
+            elif work is None or work > 0:
+                self.intervals[name] = self.base[name]
+                self.next_run[name] = now + self.intervals[name]
+            else:
+                self.intervals[name] = min(self.intervals[name] * self.backoff,
+                                           max(self.max_interval,
+                                               self.base[name]))
+                self.next_run[name] = now + self.intervals[name]
+
+            # Whatever waited on this work can go ahead
+            if work:
+                for other in self.followers.get(name, ()):
+                    if other in self.next_run:
+                        self.intervals[other] = self.base[other]
+                        self.next_run[other] = min(self.next_run[other], now)
+
+    def time_to_next_run(self, name=None, now=None):
+        """Seconds until a task, or if no name is given any task, is due
+
+        With no tasks at all, e.g. when the task list of cax.json selects
+        none, this is the longest interval.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if name is not None:
+                when = self.next_run[name]
+            elif not self.next_run:
+                return self.max_interval
+            else:
+                when = min(self.next_run.values())
+        return max(0, when - now)
@@ -1,71 +1,254 @@
 
+import copy
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from json import loads
 
-import pymongo
 from bson.json_util import dumps
 
-from cax import config
+from cax import config, journal, rundb
 
 
 class Task:
+    # Run document fields this task reads.  Only these are fetched from the
+    # run database (plus the few the framework itself needs).  None means the
+    # whole run document.
+    fields = None
+
+    # Names of tasks that must have worked on a run first in the same daemon
+    # cycle.  Tasks may run concurrently, the order is kept run by run.
+    after = ()
+
+    # Maximum number of runs this task may work on at the same time, within
+    # the limit set by config.WORKERS.  Only raise this for tasks whose
+    # each_run keeps no state on the task between runs.
+    parallelism = 1
+
+    # Seconds between passes of the daemon while there is work to do.  The
+    # scheduler backs off from this when passes find nothing to do.
+    interval = 60
+
+    # Send run updates made through self.update in bulk, see rundb.WriteBuffer
+    buffer_writes = False
+    write_buffer = None
+
+    # Re-read each run from the primary before working on it, rather than
+    # trust a snapshot that may be a whole cycle old.  Set for tasks that
+    # delete data based on what the run document says.
+    reread_runs = False
+
     def __init__(self):
-        # Grab the Run DB so we can query it
-        self.collection = config.mongo_collection()
+        # Grab the Run DB so we can query it.  Updates made while it is
+        # unreachable are journaled, see cax.journal, and all of them stamp
+        # last_modified for the change tracker.
+        self.collection = rundb.stamped(
+            journal.journaled(config.mongo_collection()))
         self.log = logging.getLogger(self.__class__.__name__)
         self.run_doc = None
         self.untriggered_data = None
+        self.backlog = 0
+        self.acted = set()
 
-    def go(self, specify_run = None):
-        """Run this periodically"""
+    def go(self, specify_run = None, snapshot=None):
+        """Run this periodically
 
-        query = {}
+        If a RunSnapshot is given, iterate over its runs instead of querying
+        the run database, and route writes through it.  In that case the
+        number of runs acted on is returned, those changed in the run
+        database or passed to acted_on, and self.backlog is the number of
+        runs left for the next pass.
+        """
 
-        # argument can be run number or run name
-        if specify_run is not None:
-            if isinstance(specify_run,int):
-                query['number'] = specify_run
-            elif isinstance(specify_run,str):
-                query['name'] = specify_run
+        query = rundb.run_query(specify_run)
+
+        # Only look at runs this task can act on
+        work = self.work_query()
+        if work:
+            query = {'$and': [query, work]}
 
         # Get user-specified list of datasets
         datasets = config.get_dataset_list()
 
-        # Collect all run document ids.  This has to be turned into a list
-        # to avoid timeouts if a task takes too long.
+        if snapshot is not None:
+            # Shared with the other tasks of this cycle.  The work query is
+            # not needed here since each_run checks the same conditions.
+            runs = snapshot
+            collection, self.collection = self.collection, snapshot.writer()
+        else:
+            # Stream full run documents in batches rather than fetching each
+            # one separately.  If the cursor times out because a task took too
+            # long, the iteration resumes after the last run processed.
+            runs = rundb.iterate_runs(self.collection, query,
+                                      projection=self.projection(),
+                                      batch_size=config.CURSOR_BATCH_SIZE,
+                                      log=self.log)
+
+        if self.buffer_writes:
+            self.write_buffer = rundb.WriteBuffer(
+                self.collection,
+                max_ops=config.CURSOR_BATCH_SIZE,
+                max_delay=config.WRITE_BUFFER_DELAY,
+                log=self.log)
+
+        # Shared with the copies of go_parallel
+        self.acted = set()
+
+        changed = None
         try:
-            ids = [doc['_id'] for doc in self.collection.find(query,
-                                                              projection=('_id'),
-                                                              sort=(('start', -1),))]
-        except pymongo.errors.CursorNotFound:
-            self.log.warning("Cursor not found exception.  Skipping")
-            return
-
-        # Iterate over each run
-        for id in ids:
-            # Make sure up to date
-            try:
-                self.run_doc = self.collection.find_one({'_id': id})
-            except pymongo.errors.AutoReconnect:
-                self.log.error("pymongo.errors.AutoReconnect, skipping...")
-                continue
-
-            if 'data' not in self.run_doc:
-                continue
-
-            # Operate on only user-specified datasets
-            if datasets:
-                if self.run_doc['name'] not in datasets:
-                    continue
-
-            # DAQ experts only:
-            # Find location of untriggered DAQ data (if exists)
-            self.untriggered_data = self.get_daq_buffer()
+            workers = min(self.parallelism, config.WORKERS)
+            if workers > 1:
+                self.backlog = self.go_parallel(runs, datasets, snapshot,
+                                                workers)
+            else:
+                self.backlog = 0
+                for run_doc in runs:
+                    if not self.process_run(run_doc, datasets, snapshot):
+                        self.backlog += 1
 
-            self.each_run()
+        finally:
+            if self.write_buffer is not None:
+                self.write_buffer.flush()
+                self.write_buffer = None
+
+            if snapshot is not None:
+                snapshot.finished(self.__class__.__name__)
+                changed = len(self.collection.changed | self.acted)
+                self.collection = collection
 
         self.shutdown()
 
+        return changed
+
+    def process_run(self, run_doc, datasets, snapshot=None):
+        """Call each_run for one run, if it should be processed
+
+        Returns False if the run was left for the next pass.
+        """
+        self.run_doc = run_doc
+
+        if snapshot is not None:
+            # Leave a run that a task this one runs after still has to work
+            # on to the next cycle, rather than wait
+            waiting_for = snapshot.waiting_for(run_doc['_id'], self.after)
+            if waiting_for:
+                self.log.debug("Run %s not done by %s, skipping" %
+                               (run_doc.get('number'), ', '.join(waiting_for)))
+                return False
+
+        if not self.process_run_data(datasets, snapshot):
+            return False
+
+        if snapshot is not None:
+            # Tasks that run after this one must see its writes: send those
+            # still queued, which refreshes the run in the snapshot
+            if self.write_buffer is not None and \
+                    self.write_buffer.pending(run_doc['_id']):
+                self.write_buffer.flush()
+            snapshot.visited(self.__class__.__name__, run_doc['_id'])
+        return True
+
+    def process_run_data(self, datasets, snapshot):
+        """Call each_run for self.run_doc, unless it is filtered out
+
+        Returns False if the run was busy.
+        """
+        if 'data' not in self.run_doc:
+            return True
+
+        # Operate on only user-specified datasets
+        if datasets:
+            if self.run_doc['name'] not in datasets:
+                return True
+
+        # DAQ experts only:
+        # Find location of untriggered DAQ data (if exists)
+        self.untriggered_data = self.get_daq_buffer()
+
+        if snapshot is None:
+            self.each_run()
+            self.flush_if_due()
+            return True
+
+        # Tasks of a cycle may run concurrently.  Leave a run another
+        # task is working on to the next cycle rather than wait.
+        lock = snapshot.run_lock(self.run_doc['_id'])
+        if not lock.acquire(blocking=False):
+            self.log.debug("Run %s busy, skipping" %
+                           self.run_doc.get('number'))
+            return False
+
+        try:
+            if self.reread_runs:
+                snapshot.refresh(self.run_doc['_id'])
+            self.each_run()
+        finally:
+            lock.release()
+
+        self.flush_if_due()
+        return True
+
+    def go_parallel(self, runs, datasets, snapshot, workers):
+        """Process several runs at the same time on a thread pool
+
+        Each run gets a shallow copy of this task, so that run_doc is not
+        shared between threads while the collection and log are.  Returns
+        the number of runs left for the next pass.
+        """
+        pending = set()
+        backlog = 0
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for run_doc in runs:
+                # Do not read ahead of the workers more than needed
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if not future.result():
+                            backlog += 1
+
+                pending.add(pool.submit(copy.copy(self).process_run,
+                                        run_doc, datasets, snapshot))
+
+            for future in pending:
+                if not future.result():
+                    backlog += 1
+
+        return backlog
+
+    def update(self, query, update):
+        """Update a run, through the write buffer if this task has one"""
+        if self.write_buffer is None:
+            return self.collection.update(query, update)
+
+        self.write_buffer.update(query, update)
+
+    def acted_on(self):
+        """Count this run as work done in this pass, e.g. a submitted job,
+        also when nothing in the run database changed
+        """
+        self.acted.add(self.run_doc['_id'])
+
+    def flush_if_due(self):
+        if self.write_buffer is not None:
+            self.write_buffer.flush_if_due()
+
+    def projection(self):
+        """Fields to fetch from the run database, or None for everything"""
+        if self.fields is None:
+            return None
+
+        return ('name', 'number', 'data') + tuple(self.fields)
+
+    def work_query(self):
+        """MongoDB filter selecting the runs this task can act on
+
+        Overload this to let the server skip runs that each_run would ignore
+        anyway, e.g. with an $elemMatch on data.host/data.status/data.type.
+        It must select at least every run the task would act on.
+        """
+        return {}
+
     def each_run(self):
         for data_doc in self.run_doc['data']:
             self.log.debug('%s on %s %s' % (self.__class__.__name__,
@@ -1,47 +1,32 @@
 """Responsible for all checksum operations on data.
 """
 
-import hashlib
 import os
 
-import checksumdir
 import shutil
 import subprocess
-from zlib import adler32, crc32
 
-from cax import config
+from cax import config, digest, manifest, rundb
 from ..task import Task
 
 
 class ChecksumMethods():
     """Implement own checksum methods"""
-    
-    def get_adler32(self, fname ):
+
+    def get_adler32(self, fname):
         """Calcualte an Adler32 checksum in python
             Used for cross checks with Rucio
         """
-        BLOCKSIZE=256*1024*1024
-        asum = 1
-        with open(fname, "rb") as f:
-          while True:
-            data = f.read(BLOCKSIZE)
-            if not data:
-                break
-            asum = adler32(data, asum)
-            if asum < 0:
-                asum += 2**32
-
-        return hex(asum)[2:10].zfill(8).lower()
+        return digest.file_digests(fname, ('adler32',),
+                                   missing_ok=False)['adler32']
 
     def get_crc32(self, fname):
         """Calcualte an crc32 checksum in python
             Used for cross checks for tape uploads
             2^32 hashes allow to calculate a quick checksum
         """
-        prev = 0
-        for eachLine in open(fname,"rb"):
-          prev = crc32(eachLine, prev)
-        return "%X"%(prev & 0xFFFFFFFF)
+        return digest.file_digests(fname, ('crc32',),
+                                   missing_ok=False)['crc32']
 
 class AddChecksum(Task):
     """Perform a checksum on accessible data.
@@ -49,6 +34,24 @@ class AddChecksum(Task):
     If no previous checksum present, then adds one.  Otherwise, confirms the
     checksum still is true.
     """
+    fields = ('number', 'data')
+    after = ('CopyPull',)
+    parallelism = 8
+    buffer_writes = True
+
+    # Digests computed in the same pass over the data, all stored with it.
+    # The sha512 is the checksum, adler32 is what Rucio compares.
+    algorithms = ('sha512', 'adler32')
+
+    def work_query(self):
+        hosts = [config.get_hostname()]
+
+        # Special case of midway-srm accessible via POSIX on midway-login1
+        if config.get_hostname() == 'midway-login1':
+            hosts.append('midway-srm')
+
+        return {'data': {'$elemMatch': {'host': {'$in': hosts},
+                                        'status': 'verifying'}}}
 
     def each_location(self, data_doc):
         # Only data waiting to be verified
@@ -77,16 +80,19 @@ class AddChecksum(Task):
         status = 'transferred'
 
         # Find file and perform checksum
+        files = None
         if os.path.isdir(data_doc['location']):
-            value = checksumdir.dirhash(data_doc['location'],
-                                        'sha512')
+            result = digest.dir_digests(data_doc['location'], self.algorithms)
+            digests = result.to_doc()
+            files = manifest.files(result)
+            value = digests['sha512']
         elif os.path.isfile(data_doc['location']):
-            value = checksumdir._filehash(data_doc['location'],
-                                          hashlib.sha512)
+            digests = digest.file_digests(data_doc['location'], self.algorithms)
+            value = digests['sha512']
         else:
             # Data not actually found
             self.log.error("Location %s not found." % data_doc['location'])
-            value = None
+            digests = value = None
             status = 'error'
 
         if config.DATABASE_LOG:
@@ -94,22 +100,28 @@ class AddChecksum(Task):
                 self.log.info("Adding a checksum to run "
                               "%d %s" % (self.run_doc['number'],
                                          data_doc['type']))
-                self.collection.update({'_id' : self.run_doc['_id'],
-                                        'data': {'$elemMatch': data_doc}},
-                                       {'$set': {'data.$.status'  : status,
-                                                 'data.$.checksum': value}})
+                self.update(rundb.datum_query(self.run_doc['_id'], data_doc),
+                            {'$set': {'data.$.status'  : status,
+                                      'data.$.checksum': value,
+                                      'data.$.digests' : digests},
+                             '$unset': {'data.$.repair': True}})
+                if files is not None:
+                    manifest.save(self.run_doc, data_doc, value, files,
+                                  log=self.log)
             elif data_doc['checksum'] != value or status == 'error':
                 self.log.info("Checksum fail "
                               "%d %s" % (self.run_doc['number'],
                                          data_doc['type']))
-                self.collection.update({'_id' : self.run_doc['_id'],
-                                        'data': {'$elemMatch': data_doc}},
-                                       {'$set': {'data.$.checksumproblem': True}})
+                self.update(rundb.datum_query(self.run_doc['_id'], data_doc),
+                            {'$set': {'data.$.checksumproblem': True}})
 
 
 
 class CompareChecksums(Task):
     "Perform a checksum on accessible data."
+    fields = ('number', 'data')
+    buffer_writes = True
+    reread_runs = True
 
     def get_main_checksum(self, type='raw', pax_version='', **kwargs):
         """Iterate over data locations and search for priviledged checksum
@@ -228,7 +240,17 @@ class CompareChecksums(Task):
                     self.log.error('did not exist, notify run database.')
 
         if config.DATABASE_LOG == True:
+            # The data is gone already, so this must not wait in the write
+            # buffer: send what is queued before it, then the $pull itself
+            if self.write_buffer is not None:
+                self.write_buffer.flush()
             resp = self.collection.update({'_id': self.run_doc['_id']},
-                                              {'$pull': {'data': data_doc}})
+                                          {'$pull': {'data': rundb.datum_filter(data_doc)}})
+            manifest.delete(data_doc)
             self.log.info('Removed from run database: %s' % data_doc['location'])
             self.log.debug(resp)
+
+            # Later copy counts of this run must not include the purged
+            # location, also when the run document is not re-read
+            self.run_doc['data'] = [datum for datum in self.run_doc['data']
+                                    if datum is not data_doc]
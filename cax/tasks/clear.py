@@ -9,11 +9,10 @@ import datetime
 import os
 import shutil
 
-from cax import config
+from cax import config, manifest, rundb
 from cax.task import Task
 from cax.tasks import checksum
 
-import pax
 
 class RetryStalledTransfer(checksum.CompareChecksums):
     """Alert if stale transfer.
@@ -21,10 +20,18 @@ class RetryStalledTransfer(checksum.CompareChecksums):
     Inherits from the checksum task since we use checksums to know when we
     can delete data.
     """
+    fields = ('number', 'name', 'data')
+    parallelism = 8
 
     # Do not overload this routine from checksum inheritance.
     each_run = Task.each_run
 
+    def work_query(self):
+        # Local data that is not (yet) transferred
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'status': {'$nin': ['transferred',
+                                                            'verifying']}}}}
+
     def each_location(self, data_doc):
         if 'host' not in data_doc or data_doc['host'] != config.get_hostname():
             return  # Skip places where we can't locally access data
@@ -46,6 +53,10 @@ class RetryStalledTransfer(checksum.CompareChecksums):
             # Assume only one list entry that contains the time
             time_made = time_made[0]
 
+        # A repair of a bad copy is as old as the repair, not the copy
+        if data_doc['status'] == 'repairing' and 'repair' in data_doc:
+            time_made = data_doc['repair'].get('started', time_made)
+
         difference = datetime.datetime.utcnow() - max(time_modified,
                                                       time_made)
 
@@ -62,7 +73,7 @@ class RetryStalledTransfer(checksum.CompareChecksums):
 
         # Do not delete stalled or failed raw data transfers to recover with rsync 
         # (Warning: do not use scp, which may create nested directories)
-        delete_data = (data_doc['type'] == 'processed' and 'v%s' % pax.__version__ == data_doc['pax_version'])
+        delete_data = (data_doc['type'] == 'processed' and config.pax_version() == data_doc['pax_version'])
 
         if difference > datetime.timedelta(hours=24):
             self.give_error("Transfer lasting more than 24 hours, retry.")
@@ -82,6 +93,10 @@ class RetryBadChecksumTransfer(checksum.CompareChecksums):
     # Do not overload this routine from checksum inheritance.
     each_run = Task.each_run
 
+    def work_query(self):
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'status': 'transferred'}}}
+
     def each_location(self, data_doc):
         if 'host' not in data_doc or data_doc['host'] != config.get_hostname():
             return  # Skip places where we can't locally access data
@@ -103,19 +118,72 @@ class RetryBadChecksumTransfer(checksum.CompareChecksums):
                 self.purge(data_doc)
                 return
 
+            # Which files are bad, if the manifests tell
+            bad_files = self.bad_files(data_doc, comparison)
+            if bad_files is not None:
+                changed, missing, extra = bad_files
+                self.give_error("Files differing from the good copy: %s, "
+                                "missing: %s, extra: %s" %
+                                (changed, missing, extra))
+
+                if config.REPAIR_TRANSFERS:
+                    self.repair(data_doc, comparison, bad_files)
+                    return
+
             # Check for 2 or more copies with raw data
             if self.check(data_doc['type'], warn=False) > 1:
                 self.purge(data_doc)
 
+    def bad_files(self, data_doc, checksum):
+        """(changed, missing, extra) files of a local copy compared to a
+        copy with the given checksum, None without manifests of both
+        """
+        local = manifest.load(data_doc)
+        if local is None:
+            return None
+
+        for other in self.run_doc['data']:
+            if other is data_doc or other.get('type') != data_doc['type'] or \
+                    other.get('status') != 'transferred' or \
+                    other.get('checksum') != checksum:
+                continue
+            reference = manifest.load(other)
+            if reference is not None:
+                return manifest.diff(local, reference)
+        return None
+
+    def repair(self, data_doc, checksum, bad_files):
+        """Leave the bad files of a copy for CopyPull to fetch again"""
+        changed, missing, extra = bad_files
+        self.log.info("Repairing %s: %d files to fetch again" %
+                      (data_doc['location'], len(changed) + len(missing)))
+        repair = {'checksum': checksum,
+                  'fetch': changed + missing,
+                  'delete': changed + extra,
+                  # RetryStalledTransfer measures the repair time from this
+                  'started': datetime.datetime.utcnow()}
+        if config.DATABASE_LOG:
+            self.update(rundb.datum_query(self.run_doc['_id'], data_doc),
+                        {'$set': {'data.$.status': 'repairing',
+                                  'data.$.repair': repair}})
+
 
 class BufferPurger(checksum.CompareChecksums):
     """Purge buffer
 
     """
+    fields = ('number', 'data', 'start')
+    after = ('CopyPush', 'AddChecksum')
 
     # Do not overload this routine from checksum inheritance.
     each_run = Task.each_run
 
+    def work_query(self):
+        # Transferred local data, except processed data (see PurgeProcessed)
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'status': 'transferred',
+                                        'type': {'$ne': 'processed'}}}}
+
     def each_location(self, data_doc):
         """Check every location with data whether it should be purged.
         """
@@ -204,10 +272,18 @@ class PurgeProcessed(checksum.CompareChecksums):
     """
     Purge Processed root files
     """
+    after = ('ProcessBatchQueueHax',)
 
     # Do not overload this routine from checksum inheritance.
     each_run = Task.each_run
 
+    def work_query(self):
+        location = {'host': config.get_hostname(),
+                    'type': {'$ne': 'raw'}}
+        if config.purge_version():
+            location['pax_version'] = config.purge_version()
+        return {'data': {'$elemMatch': location}}
+
     def each_location(self, data_doc):
         """
         Check every location with data whether it should be purged.
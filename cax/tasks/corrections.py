@@ -1,16 +1,21 @@
 """Add electron lifetime
 """
-import sympy
 import pytz
-import hax
-from pax import configuration, units
-from sympy.parsing.sympy_parser import parse_expr
 
 from cax import config
 from cax.task import Task
 
-PAX_CONFIG = configuration.load_configuration('XENON1T')
-PAX_CONFIG_MV = configuration.load_configuration('XENON1T_MV')
+# pax configurations by name, loaded on first use, see pax_config
+PAX_CONFIGS = {}
+
+
+def pax_config(name='XENON1T'):
+    """The pax configuration, only importing pax when a correction needs it"""
+    if name not in PAX_CONFIGS:
+        from pax import configuration
+        PAX_CONFIGS[name] = configuration.load_configuration(name)
+    return PAX_CONFIGS[name]
+
 
 class CorrectionBase(Task):
     """Base class for corrections.
@@ -35,6 +40,11 @@ class CorrectionBase(Task):
     collection_name = 'not_set'
     version = 'not_set'
 
+    # Run document fields read by the corrections defined here.  Override
+    # this in child classes whose evaluate method needs more.
+    fields = ('number', 'start', 'end', 'detector', 'reader.self_trigger',
+              'processor.correction_versions')
+
     def __init__(self):
         self.correction_collection = config.mongo_collection(self.collection_name)
         if self.key == 'not_set':
@@ -68,6 +78,7 @@ class CorrectionBase(Task):
 
         # Get the correction sympy function, if one is set
         if 'function' in cdoc:
+            from sympy.parsing.sympy_parser import parse_expr
             self.function = parse_expr(cdoc['function'])
 
         # We have to (re)compute the correction setting value. This is done in the evaluate method.
@@ -93,6 +104,8 @@ class AddDriftVelocity(CorrectionBase):
     collection_name = 'drift_velocity'
 
     def evaluate(self):
+        import hax
+        from pax import units
         run_number = self.run_doc['number']
 
         # Minimal init of hax. It's ok if hax is inited again with different settings before or after this.
@@ -112,7 +125,11 @@ class AddGains(CorrectionBase):
     """Add PMT gains to each run"""
     key = 'processor.DEFAULT.gains'
     collection_name = 'gains'
-    correction_units = units.V  # should be 1
+
+    @property
+    def correction_units(self):
+        from pax import units
+        return units.V  # should be 1
 
     def evaluate(self):
         """Make an array of all PMT gains."""
@@ -124,16 +141,18 @@ class AddGains(CorrectionBase):
             gains = self.get_gains(timestamp)
         elif self.run_doc['detector'] == 'muon_veto':
             self.log.info("Run %d: using 1e6 as gain for MV" % self.run_doc['number'])
-            gains = len(PAX_CONFIG_MV['DEFAULT']['pmts'])*[1e6]
+            gains = len(pax_config('XENON1T_MV')['DEFAULT']['pmts'])*[1e6]
         else:
             self.log.info("Run %d: using 1 as gain for LED" % self.run_doc['number'])
-            gains = len(PAX_CONFIG['DEFAULT']['pmts'])*[1]
+            gains = len(pax_config()['DEFAULT']['pmts'])*[1]
 
         return gains
 
     def get_gains(self, timestamp):
         """Timestamp is a UNIX timestamp in UTC
         """
+        import hax
+        import sympy
         V = sympy.symbols('V')
         pmt = sympy.symbols('pmt', integer=True)
         t = sympy.symbols('t')
@@ -142,7 +161,7 @@ class AddGains(CorrectionBase):
         hax.init(pax_version_policy='loose', main_data_paths=[])
 
         gains = []
-        for i in range(0, len(PAX_CONFIG['DEFAULT']['pmts'])):
+        for i in range(0, len(pax_config()['DEFAULT']['pmts'])):
             gain = self.function.evalf(subs={pmt: i,
                                              t: self.run_doc['start'].replace(tzinfo=pytz.utc).timestamp(),
                                              't0': 0
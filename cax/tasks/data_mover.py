@@ -12,43 +12,41 @@ import shutil
 import scp
 from paramiko import SSHClient, util
 
-import pax
-
-from cax import config
+from cax import config, digest, rundb
 from cax.task import Task
 from cax import qsub
 from cax.tasks.clear import BufferPurger
 
 from cax.tasks.tsm_mover import TSMclient
 from cax.tasks.rucio_mover import RucioBase, RucioRule, RucioDownload
-from cax.tasks.checksum import ChecksumMethods
 
 import subprocess
 
 
 class CopyBase(Task):
+    # Includes what the Rucio and TSM movers read from the run document
+    fields = ('number', 'name', 'start', 'detector', 'user', 'source',
+              'trigger.events_built', 'data')
 
     def copy(self, datum_original, datum_destination, method, option_type, data_type):
 
         if option_type == 'upload':
-            config_destination = config.get_config(datum_destination['host'])
-            server = config_destination['hostname']
-            username = config_destination['username']
-
+            remote = config.get_host(datum_destination['host'])
         else:
-            config_original = config.get_config(datum_original['host'])
-            server = config_original['hostname']
-            username = config_original['username']
+            remote = config.get_host(datum_original['host'])
+        server = remote.hostname
+        username = remote.username
 
-        if config.nstream_settings() == None:
+        here = config.get_host()
+        if here.nstreams == None:
             nstreams = 1
         else:
-            nstreams = config.nstream_settings()
+            nstreams = here.nstreams
 
-        if config.get_cert() == None:
+        if here.grid_cert == None:
             grid_cert = ''
         else:
-            grid_cert = config.get_cert()
+            grid_cert = here.grid_cert
 
         # Determine method for remote site
         if method == 'scp':
@@ -301,13 +299,14 @@ class CopyBase(Task):
     def each_run(self):
         """Run over the requested data types according to the json config file"""
 
-        if 'data_type' not in config.get_config(config.get_hostname()):
+        data_types = config.get_host().data_types
+        if data_types is None:
             logging.info(
                 "Error: Define a data_type in your configuration file")
             logging.info("       (e.g. 'data_type': ['raw'])")
             exit()
 
-        for data_type in config.get_config(config.get_hostname())['data_type']:
+        for data_type in data_types:
             self.log.debug("%s" % data_type)
             self.do_possible_transfers(option_type=self.option_type,
                                        data_type=data_type)
@@ -323,11 +322,12 @@ class CopyBase(Task):
         :return:
         """
 
-        # Get the 'upload' or 'download' options.
-        options = config.get_transfer_options(option_type)
+        # Get the 'upload' or 'download' routes, resolved when cax.json
+        # was loaded
+        routes = config.get_host().routes(option_type)
 
         # If no options, can't do anything
-        if options is None:
+        if not routes:
             return None, None
 
         # If should be purged, don't pull
@@ -342,15 +342,12 @@ class CopyBase(Task):
         # For this run, where do we have transfer access?
         datum_there = None
         datum_here = None
-        for remote_host in options:
+        for route in routes:
+            remote_host = route.host
             self.log.debug(remote_host)
 
-            # Get transfer protocol
-            method = config.get_config(remote_host)['method']
-
-            if not method:
-                print("Must specify transfer protocol (method) for " + remote_host)
-                raise
+            # Transfer protocol, checked to be set when cax.json was loaded
+            method = route.method
 
             datum_here, datum_there = self.local_data_finder(data_type,
                                                              option_type,
@@ -365,7 +362,7 @@ class CopyBase(Task):
                     "[('Connection aborted.', BadStatusLine('',))] -> Delete runDB status and start again")
 
                 self.collection.update({'_id': self.run_doc['_id']},
-                                       {'$pull': {'data': datum_there}})
+                                       {'$pull': {'data': rundb.datum_filter(datum_there)}})
 
             # Upload logic for everything exepct tape
             if option_type == 'upload' and method != "tsm" and datum_here and (datum_there is None or datum_there['status'] == 'RSEreupload'):
@@ -373,6 +370,14 @@ class CopyBase(Task):
                                     method, option_type, data_type)
                 break
 
+            # Re-fetch the bad files of a copy being repaired, from a copy
+            # with the checksum it should have (see RetryBadChecksumTransfer)
+            if option_type == 'download' and datum_there and datum_here is not None and \
+                    datum_here['status'] == 'repairing' and method in ('rsync', 'scp') and \
+                    datum_there.get('checksum') == datum_here.get('repair', {}).get('checksum'):
+                self.repair(datum_here, datum_there, method)
+                break
+
             # Download logic for everything exepct tape
             if option_type == 'download' and datum_there and datum_here is None and method != "tsm":
                 self.copy_handshake(
@@ -381,8 +386,7 @@ class CopyBase(Task):
 
             # Upload tsm:
             if option_type == 'upload' and datum_here and datum_there is None and method == "tsm":
-                self.copy_tsm(datum_here, config.get_config(
-                    remote_host)['name'], method, option_type)
+                self.copy_tsm(datum_here, remote_host, method, option_type)
                 break
 
             # Download tsm:
@@ -403,11 +407,44 @@ class CopyBase(Task):
             self.log.info(method + " " + option_type +
                           " dataset " + dataset + " took %d seconds" % elapsed)
 
+    def repair(self, datum_here, datum_there, method):
+        """Fetch again only the bad files of a local copy
+
+        The repaired copy is then verified again by AddChecksum.
+        """
+        repair = datum_here['repair']
+        self.log.info("Repairing %s from %s: fetching %d files" %
+                      (datum_here['location'], datum_there['host'],
+                       len(repair['fetch'])))
+
+        status = 'verifying'
+        try:
+            for name in repair['delete']:
+                path = os.path.join(datum_here['location'], name)
+                if os.path.exists(path):
+                    os.remove(path)
+
+            for name in repair['fetch']:
+                path = os.path.join(datum_here['location'], name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Not as 'raw' data: rsync must not --append to a bad file
+                self.copy({'host': datum_there['host'],
+                           'location': os.path.join(datum_there['location'], name)},
+                          {'host': datum_here['host'], 'location': path},
+                          method, 'download', None)
+        except:
+            self.log.exception("Unexpected repair error")
+            status = 'error'
+
+        if config.DATABASE_LOG:
+            self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_here),
+                                   {'$set': {'data.$.status': status}})
+
     def local_data_finder(self, data_type, option_type, remote_host):
         datum_here = None  # Information about data here
         datum_there = None  # Information about data there
 
-        version = 'v%s' % pax.__version__
+        version = config.pax_version()
 
         # Iterate over data locations to know status
         for datum in self.run_doc['data']:
@@ -464,6 +501,7 @@ class CopyBase(Task):
                      'location': "n/a",
                      'checksum': None,
                      'creation_time': datetime.datetime.utcnow(),
+                     'datum_id': rundb.new_datum_id(),
                      }
         logging.info("new entry for rundb: %s", datum_new)
 
@@ -492,9 +530,7 @@ class CopyBase(Task):
             if config.DATABASE_LOG:
                 # Notify the database if something went wrong during the download:
                 logging.info("Notifiy the runDB: error")
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                    '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                     {'$set': {'data.$.status': "error",
                               'data.$.location': "n/a",
                                                  'data.$.checksum': "n/a",
@@ -546,9 +582,7 @@ class CopyBase(Task):
             if config.DATABASE_LOG:
                 # Notify the database if everything was fine:
                 logging.info("Notifiy the runDB: transferred")
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                    '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                     {'$set': {'data.$.status': "transferred",
                               'data.$.location': raw_data_path + raw_data_filename,
                               'data.$.checksum': checksum_after,
@@ -561,9 +595,7 @@ class CopyBase(Task):
             if config.DATABASE_LOG:
                 # Notify the database if something went wrong during the download:
                 logging.info("Notifiy the runDB: error")
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                    '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                     {'$set': {'data.$.status': "error",
                               'data.$.location': "n/a",
                                                  'data.$.checksum': "n/a",
@@ -593,6 +625,7 @@ class CopyBase(Task):
                      'location': "n/a",
                      'checksum': None,
                      'creation_time': datetime.datetime.utcnow(),
+                     'datum_id': rundb.new_datum_id(),
                      }
         logging.info("new entry for rundb: %s", datum_new)
 
@@ -638,9 +671,7 @@ class CopyBase(Task):
                 logging.info("Check the error(s) and start again")
 
                 if config.DATABASE_LOG:
-                    self.collection.update({'_id': self.run_doc['_id'],
-                                            'data': {
-                        '$elemMatch': datum_new}},
+                    self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                         {'$set': {'data.$.status': "error",
                                   'data.$.location': "n/a",
                                                      'data.$.checksum': "n/a",
@@ -651,12 +682,11 @@ class CopyBase(Task):
             logging.info(
                 "Pre-test of %s counts %s files for tape upload [succcessful]", raw_data_path + raw_data_filename, len(list_files))
 
-        # Do a checksum pre-test for double counts:
-        checksum_pretest_list = []
-        for i_file in files:
-            f_path = os.path.join(raw_data_path, raw_data_filename, i_file)
-            pre_test_checksum = ChecksumMethods.get_crc32(self, f_path)
-            checksum_pretest_list.append(pre_test_checksum)
+        # Do a checksum pre-test for double counts.  The sha512 of the raw
+        # data is computed in the same pass, for the copy & rename check.
+        raw_digests = digest.dir_digests(raw_data_path + raw_data_filename,
+                                         ('crc32', 'sha512'))
+        checksum_pretest_list = raw_digests.file_digests('crc32')
 
         double_counts = set(
             [x for x in checksum_pretest_list if checksum_pretest_list.count(x) > 1])
@@ -666,9 +696,7 @@ class CopyBase(Task):
             logging.info("There are two or more identical checksums observed in %s", os.path.join(
                 raw_data_path, raw_data_filename))
             if config.DATABASE_LOG:
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                    '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                     {'$set': {'data.$.status': "error",
                               'data.$.location': "n/a",
                                                  'data.$.checksum': "n/a",
@@ -682,9 +710,7 @@ class CopyBase(Task):
         if self.tsm.check_client_installation() == False:
             logging.info("There is a problem with your dsmc client")
             if config.DATABASE_LOG:
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                    '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                     {'$set': {'data.$.status': "error",
                               'data.$.location': "n/a",
                                                  'data.$.checksum': "n/a",
@@ -715,8 +741,7 @@ class CopyBase(Task):
         logging.info("Start tape upload")
 
         # Prepare a copy from raw data location to tsm location ( including renaming)
-        checksum_before_raw = self.tsm.get_checksum_folder(
-            raw_data_path + raw_data_filename)
+        checksum_before_raw = raw_digests.digests['sha512']
         file_list = []
         for (dirpath, dirnames, filenames) in os.walk(raw_data_path + raw_data_filename):
             file_list.extend(filenames)
@@ -738,9 +763,7 @@ class CopyBase(Task):
         if checksum_before_raw != checksum_before_tsm:
             logging.info("Something went wrong during copy & rename")
             if config.DATABASE_LOG:
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                    '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                     {'$set': {'data.$.status': "error",
                               'data.$.location': "n/a",
                                                  'data.$.checksum': "n/a",
@@ -820,14 +843,15 @@ class CopyBase(Task):
                      raw_data_tsm + raw_data_filename, test_download + "/" + raw_data_filename)
 
         if config.DATABASE_LOG:
-            self.collection.update({'_id': self.run_doc['_id'],
-                                    'data': {
-                '$elemMatch': datum_new}},
-                {'$set': {'data.$.status': status,
-                          'data.$.location': raw_data_tsm + raw_data_filename,
-                          'data.$.checksum': checksum_after,
-                          }
-                 })
+            update = {'data.$.status': status,
+                      'data.$.location': raw_data_tsm + raw_data_filename,
+                      'data.$.checksum': checksum_after,
+                      }
+            if status == "transferred":
+                # The tape copy has the digests of the raw data
+                update['data.$.digests'] = raw_digests.to_doc()
+            self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
+                                   {'$set': update})
             logging.info("Update database")
 
         return 0
@@ -843,14 +867,14 @@ class CopyBase(Task):
         """
 
         # Get information about this destination
-        destination_config = config.get_config(destination)
+        destination_config = config.get_host(destination)
 
         self.log.info(option_type + "ing run %d to: %s" % (self.run_doc['number'],
                                                            destination))
 
         # Determine where data should be copied to
-        if destination_config['dir_%s' % datum['type']] != None:
-            base_dir = destination_config['dir_%s' % datum['type']]
+        if destination_config.dirs[datum['type']] != None:
+            base_dir = destination_config.dirs[datum['type']]
             if base_dir is None:
                 self.log.info("no directory specified for %s" % datum['type'])
                 return
@@ -882,6 +906,7 @@ class CopyBase(Task):
                                               filename),
                      'checksum': None,
                      'creation_time': datetime.datetime.utcnow(),
+                     'datum_id': rundb.new_datum_id(),
                      }
 
         if datum['type'] == 'processed':
@@ -970,9 +995,7 @@ class CopyBase(Task):
                 logging.info("  * Preliminary rule information: %s",
                              self.rucio.get_rucio_info()['rule_info'])
 
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                                        '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                                        {'$set': {
                                            'data.$.status': self.rucio.get_rucio_info()['status'],
                                            'data.$.location': self.rucio.get_rucio_info()['location'],
@@ -989,9 +1012,7 @@ class CopyBase(Task):
                 logging.info("  * Location: %s",
                              self.ruciodw.get_rucio_info()['location'])
 
-                self.collection.update({'_id': self.run_doc['_id'],
-                                        'data': {
-                                        '$elemMatch': datum_new}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                                        {'$set': {
                                            'data.$.status': self.ruciodw.get_rucio_info()['status'],
                                            'data.$.location': self.ruciodw.get_rucio_info()['location']
@@ -1001,9 +1022,7 @@ class CopyBase(Task):
             else:
                 # Fill the data if method is not rucio
                 if config.DATABASE_LOG:
-                    self.collection.update({'_id': self.run_doc['_id'],
-                                            'data': {
-                        '$elemMatch': datum_new}},
+                    self.collection.update(rundb.datum_query(self.run_doc['_id'], datum_new),
                         {'$set': {
                             'data.$.status': status
                         }
@@ -1072,3 +1091,4 @@ class CopyPull(CopyBase):
     If data exists at a reachable host but not here, pull it.
     """
     option_type = 'download'
+    after = ('RetryStalledTransfer', 'RetryBadChecksumTransfer')
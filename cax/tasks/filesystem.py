@@ -9,11 +9,14 @@ import os
 import shutil
 import subprocess
 
-from cax import config
+from cax import config, rundb
 from cax.task import Task
 
 class SetPermission(Task):
     """Set the correct permissions at the PDC in Stockholm"""
+    fields = ('data',)
+    after = ('CopyPull',)
+    parallelism = 8
 
     def __init__(self):
 
@@ -36,6 +39,9 @@ class SetPermission(Task):
         self.hostname_config = config.get_config(config.get_hostname())
         self.hostname = config.get_hostname()
 
+    def work_query(self):
+        return {'data.host': config.get_hostname()}
+
     def each_run(self):
         """Set ownership and permissons for files/folders"""
         for data_doc in self.run_doc['data']:
@@ -88,6 +94,7 @@ class RenameSingle(Task):
     This renames a file or folder then updates the run database to reflect it.
     This is an unsafe operation since it does not perform a new checksum.
     """
+    fields = ('data',)
 
     def __init__(self, input, output):
         # Save filesnames to use
@@ -118,8 +125,7 @@ class RenameSingle(Task):
 
             ## Notify run database
             if config.DATABASE_LOG is True:
-                self.collection.update({'_id' : self.run_doc['_id'],
-                                        'data': {'$elemMatch': data_doc}},
+                self.collection.update(rundb.datum_query(self.run_doc['_id'], data_doc),
                                        {'$set': {
                                            'data.$.location': self.output}})
             break
@@ -130,6 +136,7 @@ class RemoveSingle(Task):
 
     This notifies the run database.
     """
+    fields = ('data',)
 
     def __init__(self, location):
         # Save filesnames to use
@@ -152,7 +159,7 @@ class RemoveSingle(Task):
             # Notify run database
             if config.DATABASE_LOG is True:
                 self.collection.update({'_id': self.run_doc['_id']},
-                                       {'$pull': {'data': data_doc}})
+                                       {'$pull': {'data': rundb.datum_filter(data_doc)}})
 
             # Perform operation
             self.log.info("Removing %s" % (self.location))
@@ -170,6 +177,12 @@ class AddSize(Task):
         the number of files in the raw data directory match
         with the number of events recorded
     """
+    fields = ('number', 'name', 'data', 'trigger.events_built', 'reader.ini',
+              'raw_size_byte')
+    after = ('AddChecksum',)
+    parallelism = 8
+    buffer_writes = True
+
     def __init__(self):
         Task.__init__(self)
 
@@ -251,8 +264,8 @@ class AddSize(Task):
                             self.log.debug("Raw size: %d Byte  %.2f GByte nEvents: %d Size per evnt: %.1f" %
                                              (raw_size,raw_size*1e-9, nevents,float(raw_size/nevents) ))
                          
-                            self.collection.update( {'_id' : self.run_doc['_id'] },
-                                                      {'$set': {'raw_size_byte' : raw_size } } )
+                            self.update( {'_id' : self.run_doc['_id'] },
+                                         {'$set': {'raw_size_byte' : raw_size } } )
                     else:
                         self.log.debug("Size Raw data: %.2f GB" % (float(self.run_doc['raw_size_byte']/1.e9)))
 
@@ -264,9 +277,8 @@ class AddSize(Task):
                            byt= os.stat(_location)
                            self.log.debug("Location: %s Size: %i Byte (%.2f GB)"
                                           % (_location, byt.st_size, byt.st_size/1024/1024/1024 ) )
-                           self.collection.update({'_id' : self.run_doc['_id'],
-                                               'data': {'$elemMatch': data_doc}},
-                                              {'$set': {'data.$.size': byt.st_size } } )
+                           self.update(rundb.datum_query(self.run_doc['_id'], data_doc),
+                                       {'$set': {'data.$.size': byt.st_size } } )
                    else:
                        if os.path.isfile(_location):
                            byt= os.stat(_location)
@@ -316,7 +328,7 @@ class RemoveTSMEntry(Task):
             if config.DATABASE_LOG is True:
               print("Delete this: ", data_doc)
               res = self.collection.update({'_id': self.run_doc['_id']},
-                                           {'$pull': {'data': data_doc}}
+                                           {'$pull': {'data': rundb.datum_filter(data_doc)}}
                                            )
               for key, value in res.items():
                 print( " * " + str(key) + ": " + str(value) )
@@ -332,6 +344,7 @@ class FindStrays(Task):
 
     This notifies the run database.
     """
+    fields = ('data',)
 
     locations = []
 
@@ -359,11 +372,51 @@ class FindStrays(Task):
         self.check(config.get_processing_base_dir())
 
 
+class AddDatumIds(Task):
+    """Give data locations made before datum_ids existed their id
+
+    One-off migration of the run database, safe to run again.
+    """
+    fields = ('data',)
+
+    def __init__(self):
+        self.added = 0
+
+        # Perform base class initialization
+        Task.__init__(self)
+
+    def work_query(self):
+        return {'data': {'$elemMatch': {'datum_id': {'$exists': False}}}}
+
+    def each_run(self):
+        for data_doc in self.run_doc['data']:
+            if 'datum_id' in data_doc:
+                continue
+
+            self.log.debug("Adding datum_id to run %s %s" %
+                           (self.run_doc.get('number'), data_doc.get('host')))
+
+            if config.DATABASE_LOG is True:
+                # Identical entries would otherwise get the same id
+                match = dict(data_doc, datum_id={'$exists': False})
+                result = self.collection.update_one(
+                    {'_id': self.run_doc['_id'],
+                     'data': {'$elemMatch': match}},
+                    {'$set': {'data.$.datum_id': rundb.new_datum_id()}})
+                # Counts are unknown for updates journaled during an outage
+                self.added += 1 if result.modified_count is None else \
+                    result.modified_count
+
+    def shutdown(self):
+        self.log.info("Added %d datum_ids" % self.added)
+
+
 class StatusSingle(Task):
     """Status of a single file or directory
 
     This notifies the run database.
     """
+    fields = ('data',)
 
     def __init__(self, node__, status__):
         # Save filesnames to use
@@ -434,7 +487,7 @@ class RemoveRucioEntry(Task):
             if config.DATABASE_LOG is True:
               print("Delete this: ", data_doc)
               res = self.collection.update({'_id': self.run_doc['_id']},
-                                           {'$pull': {'data': data_doc}}
+                                           {'$pull': {'data': rundb.datum_filter(data_doc)}}
                                            )
               for key, value in res.items():
                 print( " * " + str(key) + ": " + str(value) )
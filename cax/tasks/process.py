@@ -4,17 +4,14 @@ Performs batch queue operations to run pax.
 """
 
 import datetime
-import hashlib
 import subprocess
 import sys
 import os
 from collections import defaultdict
 
-import pax
-import checksumdir
 from pymongo import ReturnDocument
 
-from cax import qsub, config
+from cax import qsub, config, digest, rundb
 from cax.task import Task
 
 
@@ -37,7 +34,7 @@ def _process(name, in_location, host, pax_version, pax_hash,
     from pax import core, parallel
 
     # Grab the Run DB so we can query it
-    collection = config.mongo_collection()
+    collection = rundb.stamped(config.mongo_collection())
 
     if detector == 'muon_veto':
         output_fullname = out_location + '/' + name + '_MV'
@@ -55,6 +52,7 @@ def _process(name, in_location, host, pax_version, pax_hash,
              'location'      : output_fullname + '.root',
              'checksum'      : None,
              'creation_time' : datetime.datetime.utcnow(),
+             'datum_id'      : rundb.new_datum_id(),
              'creation_place': host}
 
     # This query is used to find if this run has already processed this data
@@ -107,31 +105,51 @@ def _process(name, in_location, host, pax_version, pax_hash,
         # Data processing failed.
         datum['status'] = 'error'
         if config.DATABASE_LOG == True:
-            collection.update(query, {'$set': {'data.$': datum}})
+            collection.update(rundb.datum_query(doc['_id'], datum),
+                              {'$set': {'data.$': datum}})
         raise
 
     datum['status'] = 'verifying'
     if config.DATABASE_LOG == True:
-        collection.update(query, {'$set': {'data.$': datum}})
+        collection.update(rundb.datum_query(doc['_id'], datum),
+                          {'$set': {'data.$': datum}})
 
-    datum['checksum'] = checksumdir._filehash(datum['location'],
-                                              hashlib.sha512)
+    datum['checksum'] = digest.filehash(datum['location'], 'sha512')
     if verify():
         datum['status'] = 'transferred'
     else:
         datum['status'] = 'failed'
 
     if config.DATABASE_LOG == True:
-        collection.update(query, {'$set': {'data.$': datum}})
+        collection.update(rundb.datum_query(doc['_id'], datum),
+                          {'$set': {'data.$': datum}})
 
 
 class ProcessBatchQueue(Task):
     "Create and submit job submission script."
+    fields = ('name', 'detector', 'data', 'tags',
+              'processor.DEFAULT.gains',
+              'processor.DEFAULT.drift_velocity_liquid',
+              'processor.DEFAULT.electron_lifetime_liquid',
+              'reader.ini.write_mode', 'trigger.events_built')
+    after = ('AddGains', 'AddDriftVelocity', 'SetNeuralNetwork', 'AddSize')
 
     def verify(self):
         """Verify processing worked"""
         return True  # yeah... TODO.
 
+    def work_query(self):
+        # Raw data here, but not yet processed here with this pax version
+        thishost = config.get_hostname()
+        return {'tags.name': {'$ne': 'donotprocess'},
+                '$and': [{'data': {'$elemMatch': {'host': thishost,
+                                                  'type': 'raw',
+                                                  'status': 'transferred'}}},
+                         {'data': {'$not': {'$elemMatch': {
+                             'host': thishost,
+                             'type': 'processed',
+                             'pax_version': config.pax_version()}}}}]}
+
     def each_run(self):
         if self.has_tag('donotprocess'):
             self.log.debug("Do not process tag found, skip processing")
@@ -151,7 +169,7 @@ class ProcessBatchQueue(Task):
 
         thishost = config.get_hostname()
 
-        versions = ['v%s' % pax.__version__]
+        versions = [config.pax_version()]
 
         have_processed, have_raw = self.local_data_finder(thishost,
                                                           versions)
@@ -212,6 +230,7 @@ class ProcessBatchQueue(Task):
                      version, pax_hash, out_location,
                      self.run_doc['detector'],
                      ncpus)
+            self.acted_on()
 
 
     def local_data_finder(self, thishost, versions):
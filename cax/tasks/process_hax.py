@@ -6,14 +6,12 @@ Performs batch queue operations to run pax.
 import sys
 import os
 
-import pax
-import hax
-
 from cax import qsub, config
 from cax.task import Task
 
 
 def init_hax(in_location, pax_version, out_location):
+    import hax
     hax.init(experiment='XENON1T',
              pax_version_policy=pax_version.replace("v", ""),
              main_data_paths=[in_location],
@@ -34,6 +32,9 @@ def _process_hax(name, in_location, host, pax_version,
     """
     print('Welcome to cax-process-hax')
 
+    # Import hax so can make the minitrees
+    import hax
+
     os.makedirs(out_location, exist_ok=True)
 
     init_hax(in_location, pax_version, out_location)   # may initialize once only
@@ -65,17 +66,27 @@ def _process_hax(name, in_location, host, pax_version,
 
 class ProcessBatchQueueHax(Task):
     "Create and submit job submission script."
+    fields = ('name', 'detector', 'data')
+    after = ('ProcessBatchQueue',)
 
     def verify(self):
         """Verify processing worked"""
         return True  # yeah... TODO.
 
+    def work_query(self):
+        # Processed data of this pax version here
+        return {'data': {'$elemMatch': {'host': config.get_hostname(),
+                                        'type': 'processed',
+                                        'status': 'transferred',
+                                        'pax_version': config.pax_version()}}}
+
     def each_run(self):
 
         thishost = config.get_hostname()
 
+        import hax
         hax_version = 'v%s' % hax.__version__
-        pax_version = 'v%s' % pax.__version__
+        pax_version = config.pax_version()
         have_processed, have_raw = self.local_data_finder(thishost,
                                                           pax_version)
 
@@ -102,6 +113,7 @@ class ProcessBatchQueueHax(Task):
         _process_hax(self.run_doc['name'], in_location, thishost,
                      pax_version, out_location,
                      self.run_doc['detector'])
+        self.acted_on()
 
     def local_data_finder(self, thishost, pax_version):
         have_processed = False
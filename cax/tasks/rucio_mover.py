@@ -33,9 +33,8 @@ import json
 import scp
 from paramiko import SSHClient, util
 
-from cax import config
+from cax import config, digest, rundb
 from cax.task import Task
-from cax.tasks.checksum import ChecksumMethods
 #from cax.tasks.data_mover import local_data_finder
 
 
@@ -1493,7 +1492,7 @@ class RucioBase(Task):
         for i_file in files:
             for key_filename, value in file_locations.items():
                 if i_file.find(key_filename) >= 0 and entrance_rse in value:
-                    local_cksum = config.get_adler32(i_file)
+                    local_cksum = digest.filehash(i_file, 'adler32')
                     local_file = i_file.split("/")[-1]
                     rucio_cksum = value[entrance_rse]['checksum']
                     rucio_file = value[entrance_rse]['name']
@@ -2134,7 +2133,7 @@ class RucioPurge(Task):
                 # Notify run database
                 if self.purge is True:
                     self.collection.update({'_id': self.run_doc['_id']},
-                                           {'$pull': {'data': data_doc}})
+                                           {'$pull': {'data': rundb.datum_filter(data_doc)}})
 
                 # Perform operation
                     self.log.info("Removing %s" % (location))
@@ -2406,7 +2405,7 @@ class RucioDownload(Task):
 
             for key, value in result['details'].items():
 
-                cksum_download = ChecksumMethods().get_adler32(os.path.join(self.data_dir, key))
+                cksum_download = digest.filehash(os.path.join(self.data_dir, key), 'adler32')
                 cksum_rucio = lf[1][key]['checksum']
                 if cksum_download == cksum_rucio:
                     count_checksum += 1
@@ -2431,6 +2430,7 @@ class RucioDownload(Task):
                                  'location': self.data_dir,
                                  'checksum': None,
                                  'creation_time': datetime.datetime.utcnow(),
+                                 'datum_id': rundb.new_datum_id(),
                                  }
                     logging.info(
                         "New entry for Xenon1T data base: %s", datum_new)
@@ -2865,7 +2865,7 @@ class RucioRule(Task):
                     # Delete old entry
                     print("Old entry: ", there)
                     self.collection.update({'_id': self.run_doc['_id']},
-                                           {'$pull': {'data': there}})
+                                           {'$pull': {'data': rundb.datum_filter(there)}})
 
                 # Add the modified one:
                 there['rse'] = new_rses
@@ -26,13 +26,12 @@ import time
 import tarfile
 import copy
 import shutil
-import checksumdir
 import tempfile
 
 import scp
 from paramiko import SSHClient, util
 
-from cax import config
+from cax import config, digest, rundb
 from cax.task import Task
 
 
@@ -102,7 +101,7 @@ class TSMclient(Task):
         return stdout_value, stderr_value
 
     def get_checksum_folder(self, raw_data_location):
-        return checksumdir.dirhash(raw_data_location, 'sha512')
+        return digest.dirhash(raw_data_location, 'sha512')
 
     def get_checksum_list(self, raw_data_location):
         """Get a dictionary with filenames and their checksums"""
@@ -410,8 +409,7 @@ class AddTSMChecksum(Task):
 
                 if config.DATABASE_LOG:
                     logging.info("Notify the runDB to add checksum")
-                    self.collection.update({'_id': self.run_doc['_id'],
-                                            'data': {'$elemMatch': data_doc}},
+                    self.collection.update(rundb.datum_query(self.run_doc['_id'], data_doc),
                                            {'$set': {'data.$.checksum': checksum_after}})
 
                 # Delete from temp directory
@@ -0,0 +1,257 @@
+"""Long-lived cax and ruciax processes fed with runs over a pipe
+
+massive-tsm and massive-ruciax used to start a new 'cax --once' or
+'ruciax --once' process for every run, paying the imports, the runs database
+connection and the environment setup each time.  A worker started with
+
+    python -m cax.worker cax
+
+instead reads one job per line from stdin, as a JSON list of command line
+arguments, e.g. ["--name", "170101_1200", "--log-file", "run.txt"].  It runs
+the job as 'cax --once' with those arguments would, streaming the log lines
+back as {"log": message, "level": levelno} lines on stdout, and ends each job
+with {"done": true, "ok": true/false, "error": message or null}.
+"""
+
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
+
+from cax import __version__, config, qsub
+
+
+def commands():
+    """Parser and run function of the commands workers can run"""
+    from cax import main
+    return {'cax': (main.cax_parser, main.run_cax),
+            'ruciax': (main.ruciax_parser, main.run_ruciax)}
+
+
+class ProtocolWriter:
+    """Writes the JSON lines sent back to the driver, from any thread"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def send(self, **message):
+        with self.lock:
+            self.stream.write(json.dumps(message) + '\n')
+            self.stream.flush()
+
+
+class StreamedLogHandler(logging.Handler):
+    """Sends log records to the driver"""
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            self.writer.send(log=self.format(record), level=record.levelno)
+        except Exception:
+            self.handleError(record)
+
+
+class StreamedOutput:
+    """Stands in for sys.stdout, sending printed lines to the driver"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.buffer = ''
+
+    def write(self, text):
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split('\n')
+        for line in lines:
+            self.writer.send(log=line, level=logging.INFO)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def run_job(command, job_args, writer):
+    """Run one job in this process, returns the error message or None"""
+    make_parser, run = commands()[command]
+    args = make_parser().parse_args(job_args)
+    args.once = True
+
+    log_level = getattr(logging, args.log.upper())
+    handlers = [StreamedLogHandler(writer)]
+    if args.logfile:
+        handler = logging.FileHandler(args.logfile)
+        handler.setFormatter(logging.Formatter(
+            '%s_v%s - %%(asctime)s [%%(levelname)s] %%(message)s' %
+            (command, __version__)))
+        handlers.append(handler)
+
+    root = logging.getLogger('')
+    root.setLevel(log_level)
+    for handler in handlers:
+        root.addHandler(handler)
+
+    try:
+        run(args)
+    except (Exception, SystemExit) as e:
+        logging.exception("%s job %s failed" % (command, ' '.join(job_args)))
+        return repr(e)
+    finally:
+        for handler in handlers:
+            root.removeHandler(handler)
+            handler.close()
+
+        # Start the next job afresh, without the connections of this one
+        config.close_mongo_clients()
+    return None
+
+
+def serve(command, stdin=None, stdout=None):
+    """Run the jobs read from stdin until it is closed"""
+    if stdout is None:
+        # Keep the real stdout for the protocol.  Output of programs the
+        # tasks start goes to stderr, printed lines are sent as log lines.
+        stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    writer = ProtocolWriter(stdout)
+    sys.stdout, real_stdout = StreamedOutput(writer), sys.stdout
+
+    try:
+        for line in stdin or sys.stdin:
+            if not line.strip():
+                continue
+            error = run_job(command, json.loads(line), writer)
+            writer.send(done=True, ok=error is None, error=error)
+    finally:
+        sys.stdout = real_stdout
+
+
+class Worker:
+    """A worker process, started through a shell script
+
+    The setup is shell code run before the worker starts, e.g. to source the
+    environment of ruciax.
+    """
+
+    def __init__(self, command, setup=''):
+        python = 'python' if setup else shlex.quote(sys.executable)
+        self.script = qsub.create_script(
+            '%s\nexec %s -m cax.worker %s\n' % (setup, python, command))
+        self.process = subprocess.Popen(['sh', self.script.name],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, job_args, log):
+        """Run a job, calling log(message, level) for each line streamed back
+
+        Returns the error message, None if the job succeeded.
+        """
+        try:
+            self.process.stdin.write(json.dumps(job_args) + '\n')
+            self.process.stdin.flush()
+        except OSError as e:
+            return "worker died: %s" % e
+
+        for line in self.process.stdout:
+            message = json.loads(line)
+            if message.get('done'):
+                return message['error']
+            log(message['log'], message['level'])
+
+        return "worker died with exit code %s" % self.process.wait()
+
+    def close(self):
+        if self.alive():
+            self.process.stdin.close()
+            self.process.wait()
+        qsub.delete_script(self.script)
+
+
+def run_process(command, job_args, log, setup=''):
+    """Run a job as a new '<command> --once' process, as before workers"""
+    script = qsub.create_script(
+        '%s\n%s\n' % (setup, ' '.join(shlex.quote(arg) for arg in
+                                      [command, '--once'] + job_args)))
+    execute = subprocess.Popen(['sh', script.name],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, shell=False)
+    stdout_value, _ = execute.communicate()
+    qsub.delete_script(script)
+
+    for line in stdout_value.decode().split('\n'):
+        if line:
+            log(line, logging.INFO)
+    if execute.returncode:
+        return "exit code %d" % execute.returncode
+    return None
+
+
+class WorkerPool:
+    """Runs cax or ruciax jobs on a number of workers side by side
+
+    With zero workers, every job is run as a new process.
+    """
+
+    def __init__(self, command, workers=1, setup='', name=None):
+        self.command = command
+        self.setup = setup
+        self.name = name or command
+        self.n_workers = workers
+        self.idle = Queue()
+        for _ in range(workers):
+            self.idle.put(None)
+
+    def log(self, message, level):
+        logging.log(level, '%s: %s', self.name, message)
+
+    def run_one(self, job_args):
+        if not self.n_workers:
+            return run_process(self.command, job_args, self.log, self.setup)
+
+        worker = self.idle.get()
+        try:
+            if worker is None or not worker.alive():
+                worker = Worker(self.command, self.setup)
+            return worker.run(job_args, self.log)
+        finally:
+            self.idle.put(worker)
+
+    def run(self, jobs):
+        """Run (job arguments, payload) jobs, yields (payload, error, seconds)
+
+        Results are yielded in the order the jobs finish.
+        """
+        def timed(job_args):
+            start = time.time()
+            error = self.run_one(job_args)
+            return error, time.time() - start
+
+        with ThreadPoolExecutor(max_workers=max(1, self.n_workers)) as pool:
+            futures = {pool.submit(timed, job_args): payload
+                       for job_args, payload in jobs}
+            for future in as_completed(futures):
+                error, seconds = future.result()
+                yield futures[future], error, seconds
+
+    def close(self):
+        while not self.idle.empty():
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
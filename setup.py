@@ -31,6 +31,8 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
+    # Notices cax.json edits without polling, see config.ConfigWatcher
+    extras_require={'inotify': ['inotify_simple']},
     data_files=[ ('cax', ['cax/cax.json']),
                  ('cax/host_config', ['cax/host_config/tegner_bash_p3.config', 'cax/host_config/tegner_bash_p2.config', 'cax/host_config/midway_bash_p3.config', 'cax/host_config/midway_bash_p2.config', 'cax/host_config/xe1tdatamanager_bash_p3.config', 'cax/host_config/xe1tdatamanager_bash_p2.config'])
                 ],
@@ -59,6 +61,9 @@ setup(
             'cax-mv = cax.main:move',
             'cax-rm = cax.main:remove',
             'cax-stray = cax.main:stray',
+            'cax-datum-ids = cax.main:datum_ids',
+            'cax-db-index = cax.main:db_index',
+            'cax-mirror = cax.main:sync_mirror',
             'cax-status = cax.main:status',
             'massive-tsm = cax.main:massive_tsmclient',
             'cax-tsm-remove = cax.main:remove_from_tsm',
@@ -0,0 +1,114 @@
+"""Throughput and peak memory of the checksum implementations
+
+Run as
+
+    python tests/bench_digest.py [--size MB] [--files N] [--read-size BYTES]
+
+Each implementation runs in its own process, so that its peak RSS is
+measured alone.  The legacy ones are the functions cax used before
+cax.digest: adler32 read 256 MB blocks, crc32 iterated over 'lines' of the
+binary data.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def legacy_adler32(fname):
+    asum = 1
+    with open(fname, "rb") as f:
+        while True:
+            data = f.read(256 * 1024 * 1024)
+            if not data:
+                break
+            asum = zlib.adler32(data, asum)
+    return "%08x" % asum
+
+
+def legacy_crc32(fname):
+    prev = 0
+    for line in open(fname, "rb"):
+        prev = zlib.crc32(line, prev)
+    return "%X" % (prev & 0xFFFFFFFF)
+
+
+def streaming(algorithms):
+    def run(fname):
+        from cax import digest
+        return digest.file_digests(fname, algorithms)
+    return run
+
+
+IMPLEMENTATIONS = {
+    'legacy adler32': legacy_adler32,
+    'legacy crc32': legacy_crc32,
+    'legacy adler32+crc32+sha512': lambda fname: (
+        legacy_adler32(fname), legacy_crc32(fname),
+        __import__('checksumdir')._filehash(fname, __import__('hashlib').sha512)),
+    'digest adler32': streaming(('adler32',)),
+    'digest crc32': streaming(('crc32',)),
+    'digest adler32+crc32+sha512': streaming(('adler32', 'crc32', 'sha512')),
+}
+
+
+def measure(name, paths, read_size):
+    """Run one implementation over the files, in this process"""
+    from cax import config
+    config.set_digest_options(read_size=read_size)
+
+    start = time.time()
+    for path in paths:
+        IMPLEMENTATIONS[name](path)
+    seconds = time.time() - start
+
+    size = sum(os.path.getsize(path) for path in paths)
+    return {'name': name, 'MB/s': size / 1e6 / seconds,
+            'peak RSS MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=300, help="MB per file")
+    parser.add_argument('--files', type=int, default=3)
+    parser.add_argument('--read-size', dest='read_size', type=int, default=2**20)
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('paths', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.paths, args.read_size)))
+        return
+
+    with tempfile.TemporaryDirectory() as dirname:
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(dirname, 'xe1t_%06d.zip' % i)
+            with open(path, 'wb') as f:
+                for _ in range(args.size):
+                    f.write(os.urandom(2**20))
+            paths.append(path)
+
+        print("%-30s %10s %12s" % ('', 'MB/s', 'peak RSS MB'))
+        for name in IMPLEMENTATIONS:
+            result = subprocess.run(
+                [sys.executable, __file__, '--measure', name,
+                 '--read-size', str(args.read_size)] + paths,
+                stdout=subprocess.PIPE, universal_newlines=True)
+            if result.returncode:
+                print("%-30s failed" % name)
+                continue
+            result = json.loads(result.stdout)
+            print("%-30s %10.0f %12.0f" % (name, result['MB/s'],
+                                           result['peak RSS MB']))
+
+
+if __name__ == '__main__':
+    main()
@@ -39,3 +39,138 @@ def test_checksum(lone_run_collection):
         # (although there is a lot of code that  for status != verifying, this is all unreachable
         # due to a status check at the top, which was probably added later...)
         assert 'checksum' not in data_doc()
+
+
+def test_task_projection(lone_run_collection):
+    """Tests that a task declaring fields only receives those from the runs db.
+    """
+    from cax.task import Task
+
+    lone_run_collection.update_many({}, {'$set': {'processor': {'DEFAULT': {'gains': [1, 2, 3]}}}})
+
+    class ProjectingTask(Task):
+        fields = ('start',)
+        seen = []
+
+        def each_run(self):
+            self.seen.append(self.run_doc)
+
+    class FullTask(ProjectingTask):
+        fields = None
+        seen = []
+
+    ProjectingTask().go()
+    FullTask().go()
+    assert 'processor' not in ProjectingTask.seen[0]
+    assert 'data' in ProjectingTask.seen[0] and 'number' in ProjectingTask.seen[0]
+    assert 'processor' in FullTask.seen[0]
+
+
+def test_task_work_query(lone_run_collection):
+    """Tests that a task only sees runs matching its work query.
+    """
+    from cax.task import Task
+
+    class VerifyingOnlyTask(Task):
+        data_entries_found = 0
+
+        def work_query(self):
+            return {'data': {'$elemMatch': {'host': 'midway-login1',
+                                            'status': 'verifying'}}}
+
+        def each_location(self, data_doc):
+            self.data_entries_found += 1
+
+    t = VerifyingOnlyTask()
+    t.go()
+    run_status = lone_run_collection.find_one({})['data'][0]['status']
+    assert t.data_entries_found == (1 if run_status == 'verifying' else 0)
+
+
+def test_add_datum_ids(lone_run_collection):
+    """Tests the datum_id migration, and that updates then find the data location by its id.
+    """
+    from cax import rundb
+    from cax.tasks.filesystem import AddDatumIds
+
+    # A second, identical location must get its own id
+    datum = lone_run_collection.find_one({})['data'][0]
+    lone_run_collection.update_many({}, {'$push': {'data': datum}})
+
+    t = AddDatumIds()
+    t.go()
+    assert t.added == 2
+
+    run = lone_run_collection.find_one({})
+    ids = [d['datum_id'] for d in run['data']]
+    assert len(set(ids)) == 2
+
+    # Running again changes nothing
+    AddDatumIds().go()
+    assert [d['datum_id'] for d in lone_run_collection.find_one({})['data']] == ids
+
+    # The id still matches after other fields changed
+    stale = dict(run['data'][1], status='stale')
+    lone_run_collection.update_one(rundb.datum_query(run['_id'], stale),
+                                   {'$set': {'data.$.size': 7}})
+    assert [d.get('size') for d in lone_run_collection.find_one({})['data']] == [None, 7]
+
+
+def test_purge_not_buffered(lone_run_collection):
+    """Tests that purging a location is recorded right away, not left in the write buffer.
+    """
+    import pytest
+    from cax.tasks.checksum import CompareChecksums
+
+    class CrashingPurger(CompareChecksums):
+        def each_run(self):
+            self.update({'_id': self.run_doc['_id']}, {'$set': {'size': 1}})
+            self.purge(self.run_doc['data'][0], delete_data=False)
+
+            # Whatever is still queued is lost in a crash
+            self.write_buffer = None
+            raise RuntimeError("crash")
+
+    with pytest.raises(RuntimeError):
+        CrashingPurger().go()
+
+    run = lone_run_collection.find_one({})
+    assert run['data'] == [] and run['size'] == 1
+    assert 'last_modified' in run
+
+
+def test_purge_rereads_run(monkeypatch):
+    """Tests that the buffer purger checks the copies in the run database, not those of an old snapshot.
+    """
+    import datetime
+    import os
+    import tempfile
+    from cax import config, rundb
+    from cax.tasks.clear import BufferPurger
+    from .common import runs_collection
+
+    monkeypatch.setattr(config, 'purge_settings', lambda *args: 1)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        local = os.path.join(dirname, 'run')
+        os.mkdir(local)
+        copies = [{'host': host, 'location': location, 'status': 'transferred',
+                   'type': 'raw', 'checksum': 'abc'}
+                  for host, location in (('midway-login1', local),
+                                         ('xe1t-datamanager', '/data/run'),
+                                         ('tsm-server', '/tape/run'))]
+        runs_collection.insert_one({'number': 1,
+                                    'start': datetime.datetime.utcnow() - datetime.timedelta(days=10),
+                                    'data': copies})
+        try:
+            snapshot = rundb.RunSnapshot(config.mongo_collection(), {})
+
+            # One of the other copies is removed after the snapshot was read
+            runs_collection.update_one({}, {'$pull': {'data': {'host': 'tsm-server'}}})
+
+            BufferPurger().go(snapshot=snapshot)
+
+            assert os.path.isdir(local)
+            assert len(runs_collection.find_one({})['data']) == 2
+        finally:
+            runs_collection.delete_many({})
@@ -0,0 +1,145 @@
+import json
+import os
+
+import pytest
+
+from cax import config
+
+
+@pytest.fixture()
+def config_file(tmpdir):
+    """Fixture that points cax to a temporary cax.json, then back to the default"""
+    filename = str(tmpdir.join('cax.json'))
+    with open(filename, 'w') as f:
+        json.dump([{'name': 'here', 'purge': 3},
+                   {'name': 'there', 'purge': 4},
+                   {'name': 'here', 'purge': 5}], f)
+    config.set_json(filename)
+    yield filename
+    config.set_json('')
+
+
+def test_get_config_cached(config_file, monkeypatch):
+    assert config.get_config('here')['purge'] == 3
+    assert config.purge_settings('there') == 4
+
+    with pytest.raises(LookupError):
+        config.get_config('nowhere')
+
+    # Served from the cache while the file is unchanged
+    def fail(*args, **kwargs):
+        raise AssertionError("config file parsed again")
+    monkeypatch.setattr(config.json, 'loads', fail)
+    assert config.get_config('here') is config.get_config('here')
+
+
+def test_get_config_reloads_on_change(config_file):
+    assert config.get_config('there')['purge'] == 4
+
+    rewrite(config_file, [{'name': 'there', 'purge': 40}])
+
+    assert config.get_config('there')['purge'] == 40
+    with pytest.raises(LookupError):
+        config.get_config('here')
+
+
+def rewrite(config_file, docs):
+    """Replace the config file, making sure the change is seen"""
+    with open(config_file, 'w') as f:
+        f.write(docs if isinstance(docs, str) else json.dumps(docs))
+    # Even on coarse mtime filesystems
+    stat = os.stat(config_file)
+    os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_config_watcher(config_file):
+    watcher = config.ConfigWatcher()
+    try:
+        assert not watcher.reload()
+
+        # In-flight work keeps the config it started with
+        rewrite(config_file, [{'name': 'there', 'purge': 40}])
+        assert config.purge_settings('there') == 4
+
+        assert watcher.reload()
+        assert config.purge_settings('there') == 40
+
+        # Invalid configs are rejected
+        rewrite(config_file, '[{"name": "there", "purge": 50')
+        assert not watcher.reload()
+        rewrite(config_file, [{'name': 'there', 'method': 'ftp'}])
+        assert not watcher.reload()
+        assert config.purge_settings('there') == 40
+    finally:
+        watcher.stop()
+
+    rewrite(config_file, [{'name': 'there', 'purge': 60}])
+    assert config.purge_settings('there') == 60
+
+
+def test_config_watchers_nest(config_file):
+    with config.ConfigWatcher() as outer:
+        with config.ConfigWatcher():
+            pass
+
+        # The outer watcher still decides when the config is loaded
+        rewrite(config_file, [{'name': 'there', 'purge': 40}])
+        assert config.purge_settings('there') == 4
+        assert outer.reload()
+
+    assert outer.inotify is None
+    rewrite(config_file, [{'name': 'there', 'purge': 60}])
+    assert config.purge_settings('there') == 60
+
+
+def test_compile_hosts():
+    hosts = config.compile_hosts([
+        {'name': 'here', 'method': 'rsync', 'hostname': 'here.org',
+         'username': 'xe', 'dir_raw': '/data/raw', 'data_type': ['raw'],
+         'upload_options': ['there', 'tape'], 'download_options': ['there']},
+        {'name': 'there', 'method': 'scp', 'hostname': 'there.org',
+         'username': 'xenon', 'dir_raw': '/there/raw', 'nstreams': 4},
+        {'name': 'tape', 'method': 'tsm', 'hostname': 'tape.org',
+         'username': 'xe'}])
+
+    here = hosts['here']
+    assert [(route.host, route.method, route.server, route.username)
+            for route in here.routes('upload')] == [('there', 'scp', 'there.org', 'xenon'),
+                                                     ('tape', 'tsm', 'tape.org', 'xe')]
+    assert here.routes('upload')[0].base_dirs['raw'] == '/there/raw'
+    assert here.routes('download')[0].base_dirs['raw'] == '/data/raw'
+    assert hosts['there'].nstreams == 4
+    assert not hasattr(here, '__dict__')
+
+
+@pytest.mark.parametrize('docs', [
+    [{'name': 'here', 'method': 'rsnyc'}],
+    [{'name': 'here', 'method': 'rsync', 'upload_options': ['thre']}],
+    [{'name': 'here', 'method': 'rsync', 'purge': '5'}],
+    [{'name': 'here', 'method': 'rsync', 'data_type': ['raw'], 'upload_options': ['there']},
+     {'name': 'there', 'method': 'scp', 'dir_processed': '/there'}],
+])
+def test_compile_hosts_invalid(docs):
+    with pytest.raises(ValueError):
+        config.compile_hosts(docs)
+
+
+def test_default_config_compiles(monkeypatch):
+    config.set_json('')
+    assert config.get_host('midway-login1').name == 'midway-login1'
+
+    monkeypatch.setattr(config, 'get_hostname', lambda: 'midway-login1')
+    assert config.get_transfer_options('download', 'rsync') == ['login', 'xe1t-datamanager']
+    assert config.get_transfer_options('download', 'scp') == []
+
+
+def test_mongo_client_shared():
+    uri = 'mongodb://localhost:1/run'
+    config.set_mongo_options(pool_size=5, server_selection_timeout=1)
+    try:
+        client = config.mongo_client(uri, connect=False)
+        assert config.mongo_client(uri) is client
+        assert client.options.pool_options.max_pool_size == 5
+    finally:
+        config.set_mongo_options()
+        config.mongo_clients()[1].pop(uri).close()
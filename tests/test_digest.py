@@ -0,0 +1,156 @@
+import hashlib
+import os
+
+import pytest
+
+from cax import digest
+
+
+@pytest.fixture()
+def run_dir(tmpdir):
+    """Fixture making a directory tree of files of various sizes"""
+    for i, size in enumerate([0, 1, 1000, 3 * 2**16 + 7, 2**20 + 1]):
+        tmpdir.join('xe1t_%06d.zip' % i).write_binary(os.urandom(size))
+    tmpdir.mkdir('sub').join('b').write_binary(b'zip')
+    tmpdir.join('sub').mkdir('a').join('c').write_binary(os.urandom(5000))
+    return str(tmpdir)
+
+
+@pytest.mark.parametrize('workers,read_size', [(1, None), (4, 4096), (16, 2**16)])
+def test_dirhash_matches_checksumdir(run_dir, workers, read_size):
+    checksumdir = pytest.importorskip('checksumdir')
+    for algorithm in ('sha512', 'md5'):
+        assert digest.dirhash(run_dir, algorithm, workers=workers,
+                              read_size=read_size) == \
+               checksumdir.dirhash(run_dir, algorithm)
+
+
+def test_dirhash(run_dir):
+    hashes = sorted(hashlib.sha512(open(path, 'rb').read()).hexdigest()
+                    for path in digest.dir_files(run_dir))
+    assert len(hashes) == 7
+    assert digest.dirhash(run_dir) == \
+           hashlib.sha512(''.join(hashes).encode()).hexdigest()
+
+    with pytest.raises(TypeError):
+        digest.dirhash(os.path.join(run_dir, 'sub', 'b'))
+    with pytest.raises(NotImplementedError):
+        digest.dirhash(run_dir, 'crc32')
+
+
+def test_dir_digests_single_pass(run_dir, monkeypatch):
+    from cax.tasks.checksum import ChecksumMethods
+
+    reads = []
+    real_open = open
+
+    def counting_open(path, *args, **kwargs):
+        reads.append(path)
+        return real_open(path, *args, **kwargs)
+    monkeypatch.setattr('builtins.open', counting_open)
+
+    result = digest.dir_digests(run_dir, ('sha512', 'crc32', 'adler32'), workers=3)
+    assert sorted(reads) == sorted(digest.dir_files(run_dir))
+    monkeypatch.undo()
+
+    assert result.digests == {'sha512': digest.dirhash(run_dir)}
+    for name, size, digests in result.files:
+        assert size == os.path.getsize(os.path.join(run_dir, name))
+        path = os.path.join(run_dir, name)
+        assert digests['crc32'] == ChecksumMethods().get_crc32(path)
+        assert digests['adler32'] == ChecksumMethods().get_adler32(path)
+
+    doc = result.to_doc()
+    assert doc['sha512'] == digest.dirhash(run_dir)
+    assert doc['adler32'] == result.file_digests('adler32')
+    assert [name for name, _, _ in result.files][-2:] == ['sub/b', 'sub/a/c']
+
+
+def legacy_adler32(fname):
+    """ChecksumMethods.get_adler32 and config.get_adler32 before cax.digest"""
+    from zlib import adler32
+    asum = 1
+    with open(fname, "rb") as f:
+        while True:
+            data = f.read(256 * 1024 * 1024)
+            if not data:
+                break
+            asum = adler32(data, asum)
+            if asum < 0:
+                asum += 2**32
+    return hex(asum)[2:10].zfill(8).lower()
+
+
+def legacy_crc32(fname):
+    """ChecksumMethods.get_crc32 before cax.digest"""
+    from zlib import crc32
+    prev = 0
+    for line in open(fname, "rb"):
+        prev = crc32(line, prev)
+    return "%X" % (prev & 0xFFFFFFFF)
+
+
+@pytest.mark.parametrize('read_size', [1000, 4096, 2**20])
+def test_legacy_checksums(run_dir, tmpdir, read_size):
+    from cax import config
+    from cax.tasks.checksum import ChecksumMethods
+
+    lines = tmpdir.join('lines.txt')
+    lines.write_binary(b'\n'.join(os.urandom(i) for i in range(300)) + b'\n\n')
+    paths = list(digest.dir_files(run_dir)) + [str(lines)]
+
+    config.set_digest_options(read_size=read_size)
+    try:
+        for path in paths:
+            assert ChecksumMethods().get_adler32(path) == legacy_adler32(path)
+            assert config.get_adler32(path) == legacy_adler32(path)
+            assert ChecksumMethods().get_crc32(path) == legacy_crc32(path)
+    finally:
+        config.set_digest_options()
+
+    with pytest.raises(FileNotFoundError):
+        ChecksumMethods().get_crc32(os.path.join(run_dir, 'missing'))
+
+
+def test_checksum_cache(run_dir, tmpdir_factory, monkeypatch):
+    from cax import config
+
+    for name in digest.dir_files(run_dir):
+        os.utime(name, (1e9, 1e9))
+    path = os.path.join(run_dir, 'xe1t_000002.zip')
+    expected = digest.file_digests(path, ('sha512', 'adler32'))
+
+    config.set_checksum_cache(str(tmpdir_factory.mktemp('cache').join('checksums.sqlite')))
+    try:
+        assert digest.file_digests(path, ('sha512', 'adler32')) == expected
+
+        hashed = []
+        stream_digests = digest.stream_digests
+
+        def counting(f, algorithms, read_size=None):
+            hashed.append(tuple(algorithms))
+            return stream_digests(f, algorithms, read_size)
+        monkeypatch.setattr(digest, 'stream_digests', counting)
+
+        # Unchanged files are not read again, only new algorithms are computed
+        assert digest.file_digests(path, ('adler32', 'crc32'))['adler32'] == \
+               expected['adler32']
+        assert digest.dirhash(run_dir) == digest.dirhash(run_dir)
+        assert hashed.count(('crc32',)) == 1
+        assert hashed.count(('sha512',)) == 6
+        assert digest.filehash(path, 'crc32') and hashed.count(('crc32',)) == 1
+
+        # A changed file is hashed again
+        with open(path, 'ab') as f:
+            f.write(b'more')
+        os.utime(path, (1e9, 1e9))
+        assert digest.filehash(path, 'adler32') != expected['adler32']
+        assert hashed[-1] == ('adler32',)
+
+        # So is a file that may still be being written to
+        os.utime(path)
+        digest.filehash(path, 'md5')
+        digest.filehash(path, 'md5')
+        assert hashed[-2:] == [('md5',), ('md5',)]
+    finally:
+        config.set_checksum_cache(None)
@@ -0,0 +1,108 @@
+# Import runs_collection from the common setup, which replaces the runs db with a mongomock one.
+from .common import runs_collection
+
+import pymongo
+import pytest
+
+from cax import journal, rundb
+
+
+@pytest.fixture()
+def one_run():
+    """Fixture that puts a single run in the fake runs db, then cleans it up"""
+    runs_collection.insert_one({'number': 1, 'name': 'run_1',
+                                'data': [{'host': 'midway-login1', 'type': 'raw',
+                                          'status': 'transferring'}]})
+    yield runs_collection
+    runs_collection.delete_many({})
+
+
+class OfflineCollection:
+    """Collection whose methods in 'down' fail as if the database was down"""
+
+    def __init__(self, collection, down=('update',)):
+        self.collection = collection
+        self.down = down
+
+    def with_options(self, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith(self.down):
+            def fail(*args, **kwargs):
+                raise pymongo.errors.AutoReconnect('connection refused')
+            return fail
+        return getattr(self.collection, name)
+
+
+def test_journal_outage(one_run, tmpdir):
+    write_journal = journal.WriteJournal(str(tmpdir.join('journal.jsonl')))
+    offline = OfflineCollection(one_run)
+    collection = journal.JournaledCollection(offline, write_journal)
+
+    collection.update({'number': 1, 'data.host': 'midway-login1'},
+                      {'$set': {'data.$.status': 'transferred'}})
+    result = collection.update_one({'number': 1},
+                                   {'$push': {'data': {'host': 'tsm-server',
+                                                       'status': 'transferred'}}})
+    assert result.matched_count is None and len(write_journal) == 2
+
+    # Reads see the journaled updates
+    doc = collection.find_one({'number': 1})
+    assert [d['status'] for d in doc['data']] == ['transferred', 'transferred']
+    assert [d['host'] for d in next(iter(collection.find()))['data']] == \
+           ['midway-login1', 'tsm-server']
+
+    # Nothing is replayed while the database is down
+    assert collection.replay() == 0
+    assert one_run.find_one()['data'][0]['status'] == 'transferring'
+
+    offline.down = ()
+    assert collection.replay() == 2
+    assert len(write_journal) == 0
+    assert one_run.find_one()['data'] == doc['data']
+
+    # Replaying the same update again, as after a crash, changes nothing
+    write_journal.append({'number': 1}, {'$push': {'data': doc['data'][1]}})
+    assert collection.replay() == 1
+    assert one_run.find_one()['data'] == doc['data']
+
+
+def test_journal_write_after_outage(one_run, tmpdir, monkeypatch):
+    write_journal = journal.WriteJournal(str(tmpdir.join('journal.jsonl')))
+    offline = OfflineCollection(one_run)
+    collection = journal.JournaledCollection(offline, write_journal)
+
+    collection.update_one({'number': 1},
+                          {'$set': {'data.0.status': 'transferred'}})
+    offline.down = ()
+
+    # Shortly after the outage, writes queue up behind the journaled one
+    result = collection.update_one({'number': 1}, {'$set': {'tags': []}})
+    assert result.modified_count is None and len(write_journal) == 2
+
+    # Later, the journal is replayed before the write is sent
+    monkeypatch.setattr(journal, 'RETRY_INTERVAL', 0)
+    result = collection.update_one({'number': 1},
+                                   {'$push': {'tags': {'name': 'ok'}}})
+    assert result.modified_count == 1 and len(write_journal) == 0
+    doc = one_run.find_one()
+    assert doc['data'][0]['status'] == 'transferred'
+    assert doc['tags'] == [{'name': 'ok'}]
+
+
+def test_journal_snapshot(one_run, tmpdir):
+    write_journal = journal.WriteJournal(str(tmpdir.join('journal.jsonl')))
+    offline = OfflineCollection(one_run)
+    snapshot = rundb.RunSnapshot(
+        journal.JournaledCollection(offline, write_journal), {})
+    offline.down = ('update', 'find')
+
+    run_doc = next(iter(snapshot))
+    snapshot.writer().update({'_id': run_doc['_id']},
+                             {'$set': {'data.0.status': 'transferred'}})
+
+    # Later tasks of the cycle see the journaled update
+    assert run_doc['data'][0]['status'] == 'transferred'
+    assert 'last_modified' in run_doc
+    assert len(write_journal) == 1
@@ -0,0 +1,96 @@
+# Import runs_collection from the common setup, which replaces the runs db with a mongomock one.
+from .common import runs_collection
+
+import datetime
+import os
+import shutil
+
+import pytest
+
+from cax import config, digest, manifest, rundb
+
+
+@pytest.fixture()
+def bad_copy(tmpdir):
+    """Fixture with a good raw copy on the datamanager and a local copy to
+    verify, in which one file got corrupted and one is missing
+    """
+    good = tmpdir.mkdir('good')
+    for i in range(4):
+        good.join('xe1t_%06d.zip' % i).write_binary(os.urandom(1000 + i))
+    local = tmpdir.join('local')
+    shutil.copytree(str(good), str(local))
+    local.join('xe1t_000001.zip').write_binary(os.urandom(1001))
+    local.join('xe1t_000003.zip').remove()
+    local.join('stray.tmp').write_binary(b'')
+
+    good_digests = digest.dir_digests(str(good))
+    good_datum = {'host': 'xe1t-datamanager', 'type': 'raw',
+                  'status': 'transferred', 'location': str(good),
+                  'checksum': good_digests.digests['sha512'],
+                  'datum_id': rundb.new_datum_id()}
+    local_datum = {'host': 'midway-login1', 'type': 'raw',
+                   'status': 'verifying', 'location': str(local),
+                   'checksum': None, 'datum_id': rundb.new_datum_id(),
+                   'creation_time': datetime.datetime(2017, 1, 1)}
+    run_id = runs_collection.insert_one({'number': 1, 'name': 'run_1',
+                                         'data': [good_datum, local_datum]}).inserted_id
+    manifest.save({'_id': run_id}, good_datum, good_datum['checksum'],
+                  manifest.files(good_digests))
+
+    config.set_repair_transfers(True)
+    yield runs_collection
+    config.set_repair_transfers(False)
+    runs_collection.delete_many({})
+    manifest.collection().delete_many({})
+
+
+def local_datum():
+    return runs_collection.find_one({})['data'][1]
+
+
+def test_manifest_repair(bad_copy):
+    from cax.tasks.checksum import AddChecksum
+    from cax.tasks.clear import RetryBadChecksumTransfer, RetryStalledTransfer
+
+    AddChecksum().go()
+    datum = local_datum()
+    assert datum['status'] == 'transferred'
+    saved = manifest.load(datum)
+    assert [entry['name'] for entry in saved['files']] == \
+           ['stray.tmp', 'xe1t_000000.zip', 'xe1t_000001.zip', 'xe1t_000002.zip']
+    assert saved['files'][2]['size'] == 1001
+
+    # Only the bad files are left to fetch again
+    RetryBadChecksumTransfer().go()
+    datum = local_datum()
+    assert datum['status'] == 'repairing'
+    assert datum['repair']['fetch'] == ['xe1t_000001.zip', 'xe1t_000003.zip']
+    assert datum['repair']['delete'] == ['xe1t_000001.zip', 'stray.tmp']
+
+    # The repair is recent, even though the copy is old
+    os.utime(datum['location'], (1e9, 1e9))
+    RetryStalledTransfer().go()
+    assert local_datum()['status'] == 'repairing'
+
+    pytest.importorskip('scp')
+    from cax.tasks.data_mover import CopyPull
+
+    fetched = []
+
+    def copy(datum_original, datum_destination, method, option_type, data_type):
+        fetched.append(os.path.basename(datum_original['location']))
+        shutil.copy(datum_original['location'], datum_destination['location'])
+
+    task = CopyPull()
+    task.copy = copy
+    task.run_doc = runs_collection.find_one({})
+    task.repair(datum, task.run_doc['data'][0], 'rsync')
+    assert fetched == ['xe1t_000001.zip', 'xe1t_000003.zip']
+    assert local_datum()['status'] == 'verifying'
+
+    AddChecksum().go()
+    datum = local_datum()
+    assert datum['status'] == 'transferred'
+    assert datum['checksum'] == runs_collection.find_one({})['data'][0]['checksum']
+    assert 'repair' not in datum
@@ -0,0 +1,116 @@
+# Import runs_collection from the common setup, which replaces the runs db with a mongomock one.
+from .common import runs_collection
+from datetime import datetime, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+
+from cax import mirror, rundb
+
+
+@pytest.fixture()
+def run_mirror(tmpdir):
+    """Fixture with a few runs in the fake runs db and a mirror of them"""
+    t0 = datetime(2017, 1, 1)
+    runs_collection.insert_many([
+        {'_id': ObjectId.from_datetime(t0 + timedelta(hours=i)),
+         'number': i, 'name': 'run_%d' % i, 'detector': 'tpc',
+         'start': t0 + timedelta(hours=i),
+         'tags': [{'name': 'blinded'}] if i % 3 else [],
+         'processor': {'huge': 'not mirrored'},
+         'data': [{'host': 'midway-login1', 'type': 'raw',
+                   'status': 'transferred' if i % 2 else 'verifying',
+                   'location': '/data/run_%d' % i},
+                  {'host': 'tsm-server', 'type': 'raw', 'status': 'transferred',
+                   'location': '/tsm/run_%d' % i}]}
+        for i in range(10)])
+    run_mirror = mirror.RunMirror(str(tmpdir.join('mirror.sqlite')))
+    assert run_mirror.age() is None
+    assert run_mirror.sync(runs_collection) == 10
+    yield run_mirror
+    run_mirror.close()
+    runs_collection.delete_many({})
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'number': 3},
+    {'name': 'run_4'},
+    {'tags.name': {'$ne': 'blinded'}},
+    {'data.host': 'tsm-server'},
+    {'data': {'$elemMatch': {'host': 'midway-login1', 'status': 'verifying'}}},
+    {'data': {'$elemMatch': {'host': {'$in': ['tsm-server', 'login']},
+                             'type': 'raw', 'location': '/tsm/run_2'}}},
+    {'number': {'$lt': 5}, 'data.status': {'$in': ['verifying', 'error']}},
+    {'data': {'$not': {'$elemMatch': {'host': 'midway-login1',
+                                      'status': {'$nin': ['verifying']}}}}},
+    {'$and': [{'number': {'$gte': 2}},
+              {'$or': [{'start': {'$lt': datetime(2017, 1, 1, 5)}},
+                       {'detector': {'$in': ['muon_veto']}}]}]},
+    {'end': {'$exists': False}, 'start': {'$gt': datetime(2017, 1, 1, 7)}},
+])
+def test_mirror_answers_like_runs_db(run_mirror, query):
+    expected = list(runs_collection.find(query, projection=['number', 'data.status'],
+                                         sort=list(rundb.RUN_SORT)))
+    found = list(run_mirror.collection().find(query, projection=['number', 'data.status'],
+                                              sort=list(rundb.RUN_SORT)))
+    assert found == expected
+
+
+def test_mirror_sync(run_mirror):
+    assert run_mirror.age() < 60
+    doc = run_mirror.collection().find_one({'number': 1})
+    assert 'processor' not in doc and doc['start'] == datetime(2017, 1, 1, 1)
+
+    # Runs changed through cax are stamped, so picked up incrementally
+    runs_collection.update_one({'number': 1}, rundb.stamp({'$set': {'data': []}}))
+    runs_collection.insert_one({'number': 10, 'name': 'run_10', 'start': datetime(2017, 1, 2),
+                                'data': []})
+    assert run_mirror.sync(runs_collection) == 2
+    assert run_mirror.collection().find_one({'number': 1})['data'] == []
+
+    # A full sync drops deleted runs
+    runs_collection.delete_one({'number': 10})
+    run_mirror.sync(runs_collection, full=True)
+    assert run_mirror.collection().count_documents({}) == 10
+
+    with pytest.raises(mirror.ReadOnlyError):
+        run_mirror.collection().update_one({'number': 1}, {'$set': {'data': []}})
+
+
+def test_task_reads_mirror(run_mirror):
+    from cax.tasks.filesystem import StatusSingle
+    seen = []
+
+    class Status(StatusSingle):
+        def each_run(self):
+            seen.append(self.run_doc['number'])
+
+    task = Status('midway-login1', 'verifying')
+    task.collection = run_mirror.collection()
+    task.go()
+    assert seen == list(reversed(range(10)))
+
+
+def test_mirror_location_index(run_mirror, monkeypatch):
+    decoded = []
+    loads = mirror.json_util.loads
+
+    def counting(doc, *args, **kwargs):
+        decoded.append(doc)
+        return loads(doc, *args, **kwargs)
+    monkeypatch.setattr(mirror.json_util, 'loads', counting)
+
+    # Only the runs with such a data location are decoded
+    query = {'data': {'$elemMatch': {'host': 'midway-login1', 'status': 'verifying'}}}
+    assert len(list(run_mirror.collection().find(query))) == 5
+    assert len(decoded) == 5
+
+    # Mirrors without the index are not trusted with it, and fully resynced
+    with run_mirror.connection:
+        run_mirror.connection.execute('DELETE FROM locations')
+        run_mirror.set_meta('schema', 1)
+    stale = mirror.RunMirror(run_mirror.path)
+    assert len(list(stale.collection().find(query))) == 5
+    assert stale.sync(runs_collection) == 10 and stale.indexed
+    stale.close()
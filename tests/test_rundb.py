@@ -0,0 +1,379 @@
+# Import runs_collection from the common setup, which replaces the runs db with a mongomock one.
+from .common import runs_collection
+from datetime import datetime, timedelta
+import threading
+
+import pymongo
+import pytest
+
+from cax import rundb
+
+
+@pytest.fixture()
+def many_runs():
+    """Fixture that fills the fake runs db with 25 runs, then cleans it up"""
+    t0 = datetime(2017, 1, 1)
+    runs_collection.insert_many([{'number': i,
+                                  'name': 'run_%d' % i,
+                                  'start': t0 + timedelta(hours=i),
+                                  'data': []} for i in range(25)])
+    yield runs_collection
+    runs_collection.delete_many({})
+
+
+class FlakyCollection:
+    """Collection whose cursors die once after a few documents"""
+
+    def __init__(self, collection, fail_after):
+        self.collection = collection
+        self.fail_after = fail_after
+
+    def find(self, *args, **kwargs):
+        cursor = self.collection.find(*args, **kwargs)
+        if self.fail_after is None:
+            return cursor
+        fail_after, self.fail_after = self.fail_after, None
+        return FlakyCursor(cursor, fail_after)
+
+
+class FlakyCursor:
+    def __init__(self, cursor, fail_after):
+        self.cursor = cursor
+        self.fail_after = fail_after
+
+    def batch_size(self, n):
+        return self
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        for i, doc in enumerate(self.cursor):
+            if i == self.fail_after:
+                raise pymongo.errors.CursorNotFound('cursor id not found')
+            yield doc
+
+
+def test_iterate_runs_order(many_runs):
+    numbers = [doc['number'] for doc in rundb.iterate_runs(many_runs, batch_size=4)]
+    assert numbers == list(reversed(range(25)))
+
+
+def test_iterate_runs_resumes_after_cursor_timeout(many_runs):
+    collection = FlakyCollection(many_runs, fail_after=7)
+    numbers = [doc['number'] for doc in rundb.iterate_runs(collection, batch_size=4)]
+    assert numbers == list(reversed(range(25)))
+
+
+def test_iterate_runs_resumes_past_null_start(many_runs):
+    # Runs without start sort last
+    many_runs.insert_many([{'number': 25, 'start': None, 'data': []},
+                           {'number': 26, 'data': []}])
+    collection = FlakyCollection(many_runs, fail_after=20)
+    numbers = [doc['number'] for doc in rundb.iterate_runs(collection, batch_size=4)]
+    assert sorted(numbers) == list(range(27))
+
+    # Also when resuming among them
+    collection = FlakyCollection(many_runs, fail_after=25)
+    numbers = [doc['number'] for doc in rundb.iterate_runs(collection, batch_size=4)]
+    assert sorted(numbers) == list(range(27))
+
+
+def test_iterate_runs_projection_keeps_sort_keys(many_runs):
+    docs = list(rundb.iterate_runs(many_runs, {'number': {'$lt': 3}},
+                                   projection=['number']))
+    assert [doc['number'] for doc in docs] == [2, 1, 0]
+    assert all('start' in doc and 'name' not in doc for doc in docs)
+
+
+def test_snapshot_shared_between_tasks(many_runs):
+    from cax.task import Task
+
+    class Marker(Task):
+        def each_run(self):
+            if self.run_doc['number'] % 2:
+                self.collection.update_one({'_id': self.run_doc['_id']},
+                                           {'$push': {'data': {'host': 'here',
+                                                               'type': 'raw',
+                                                               'status': 'transferred'}}})
+
+    class Counter(Task):
+        found = 0
+
+        def each_run(self):
+            self.found += len(self.run_doc['data'])
+
+    snapshot = rundb.RunSnapshot(many_runs, {'number': {'$lt': 10}})
+    counter = Counter()
+    Marker().go(snapshot=snapshot)
+
+    # The counter sees the writes without querying the runs db again
+    counter.collection = None
+    counter.go(snapshot=snapshot)
+    assert counter.found == 5
+    assert len(snapshot) == 10
+
+
+def test_snapshot_rereads_from_primary(many_runs):
+    snapshot = rundb.RunSnapshot(many_runs.with_options(
+        read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED))
+    assert snapshot.primary.read_preference == pymongo.ReadPreference.PRIMARY
+
+
+def test_snapshot_task_order_per_run(many_runs):
+    from cax import scheduler
+    from cax.task import Task
+
+    reached, release = threading.Event(), threading.Event()
+
+    class CopyPull(Task):
+        def each_run(self):
+            # A long transfer of one run
+            if self.run_doc['number'] == 20:
+                reached.set()
+                assert release.wait(5)
+
+    class AddChecksum(Task):
+        after = ('CopyPull',)
+        seen = []
+
+        def each_run(self):
+            self.seen.append(self.run_doc['number'])
+
+    def run(task):
+        if isinstance(task, AddChecksum):
+            assert reached.wait(5)
+            task.go(snapshot=snapshot)
+            release.set()
+        else:
+            task.go(snapshot=snapshot)
+
+    # AddChecksum goes ahead with the runs CopyPull is done with
+    snapshot = rundb.RunSnapshot(many_runs)
+    tasks = [CopyPull(), AddChecksum()]
+    snapshot.expect(['CopyPull', 'AddChecksum'])
+    scheduler.run_task_graph(tasks, run, max_workers=2)
+    assert AddChecksum.seen == [24, 23, 22, 21]
+    assert tasks[1].backlog == 21
+    assert snapshot.todo == {}
+
+
+def test_snapshot_work_counts_runs_acted_on(many_runs):
+    from cax.task import Task
+
+    class Rewriter(Task):
+        fields = ('data',)
+
+        def each_run(self):
+            self.collection.update_one({'_id': self.run_doc['_id']},
+                                       {'$set': {'data': []}})
+
+    class Submitter(Task):
+        fields = ('data',)
+
+        def each_run(self):
+            if self.run_doc['number'] < 3:
+                self.acted_on()
+
+    snapshot = rundb.RunSnapshot(many_runs, projection=['number', 'data'])
+
+    # Writing the values runs already have is no work
+    assert Rewriter().go(snapshot=snapshot) == 0
+    assert Submitter().go(snapshot=snapshot) == 3
+
+    # Changes of fields outside the snapshot count, as they cannot be told
+    writer = snapshot.writer()
+    writer.update_many({'number': {'$lt': 2}}, {'$set': {'size': 1}})
+    assert len(writer.changed) == 2
+
+
+def test_union_projection():
+    class T:
+        def __init__(self, projection):
+            self._projection = projection
+
+        def projection(self):
+            return self._projection
+
+    assert rundb.union_projection([T(('data', 'processor.DEFAULT.gains')),
+                                   T(('number', 'processor'))]) == ['data', 'number', 'processor']
+    assert rundb.union_projection([T(('data',)), T(None)]) is None
+
+
+def test_change_tracker_watermark():
+    from bson.objectid import ObjectId
+    old = datetime(2017, 1, 1)
+    runs_collection.insert_many([{'_id': ObjectId.from_datetime(old + timedelta(hours=i)),
+                                  'number': i, 'start': old, 'data': []} for i in range(5)])
+    try:
+        # mongomock has no change streams, so this uses the watermark
+        tracker = rundb.RunChangeTracker(runs_collection, full_interval=3600)
+        assert tracker.stream is None
+        assert tracker.cycle_query({}) == {}
+
+        snapshot = rundb.RunSnapshot(runs_collection)
+        snapshot.collection.update_one({'number': 3}, {'$set': {'data': [1]}})
+        runs_collection.insert_one({'number': 5, 'start': old, 'data': []})
+
+        query = tracker.cycle_query({})
+        assert sorted(doc['number'] for doc in runs_collection.find(query)) == [3, 5]
+
+        # Nothing changed since
+        tracker.watermark += 2 * rundb.WATERMARK_OVERLAP
+        assert tracker.changed_ids() == set()
+
+        # Full reconciliation is due again
+        tracker.last_full[None] -= 3600
+        assert tracker.cycle_query({}) == {}
+    finally:
+        runs_collection.delete_many({})
+
+
+def test_task_writes_stamped(many_runs):
+    from cax.task import Task
+
+    class Writer(Task):
+        """Writes without going through Task.update"""
+        def each_run(self):
+            run_id = self.run_doc['_id']
+            kind = self.run_doc['number'] % 3
+            if kind == 0:
+                self.collection.update_one({'_id': run_id}, {'$set': {'size': 1}})
+            elif kind == 1:
+                self.collection.find_one_and_update({'_id': run_id},
+                                                    {'$pull': {'data': {'host': 'here'}}})
+            else:
+                self.collection.bulk_write([pymongo.UpdateOne({'_id': run_id},
+                                                              {'$inc': {'size': 1}})])
+
+    for snapshot in (None, rundb.RunSnapshot(many_runs)):
+        many_runs.update_many({}, {'$unset': {'last_modified': 1}})
+        Writer().go(snapshot=snapshot)
+        assert many_runs.count_documents({'last_modified': {'$exists': True}}) == 25
+
+
+def test_task_parallel_runs(many_runs):
+    from cax import config
+    from cax.task import Task
+
+    class Sizer(Task):
+        parallelism = 4
+        seen = []
+
+        def each_run(self):
+            self.seen.append((self.run_doc['number'], threading.get_ident()))
+            self.collection.update_one({'_id': self.run_doc['_id']},
+                                       {'$set': {'size': self.run_doc['number']}})
+
+    snapshot = rundb.RunSnapshot(many_runs)
+    config.set_workers(4)
+    try:
+        Sizer().go(snapshot=snapshot)
+    finally:
+        config.set_workers(1)
+
+    assert sorted(number for number, _ in Sizer.seen) == list(range(25))
+    assert all(doc['size'] == doc['number'] for doc in snapshot)
+
+
+def test_write_buffer(many_runs):
+    snapshot = rundb.RunSnapshot(many_runs)
+    writer = snapshot.writer()
+    buffer = rundb.WriteBuffer(writer, max_ops=10, max_delay=3600)
+
+    for doc in list(snapshot)[:9]:
+        buffer.update({'_id': doc['_id']}, {'$set': {'size': 1}})
+    assert many_runs.count_documents({'size': 1}) == 0
+
+    # The tenth update fills the buffer
+    doc = list(snapshot)[9]
+    buffer.update({'_id': doc['_id']}, {'$set': {'size': 1}})
+    assert many_runs.count_documents({'size': 1}) == 10
+    assert many_runs.count_documents({'last_modified': {'$exists': True}}) == 10
+    assert len(writer.changed) == 10
+    assert sum(1 for doc in snapshot if doc.get('size') == 1) == 10
+
+    # Updates of the same run stay in order
+    buffer.update({'_id': doc['_id']}, {'$set': {'size': 2}})
+    buffer.update({'_id': doc['_id']}, {'$inc': {'size': 1}})
+    buffer.flush()
+    assert many_runs.find_one({'_id': doc['_id']})['size'] == 3
+    assert buffer.flush() is None
+
+
+def test_write_buffer_flushed_before_visited(many_runs, monkeypatch):
+    from cax import config
+    from cax.task import Task
+
+    monkeypatch.setattr(config, 'CURSOR_BATCH_SIZE', 100)
+    monkeypatch.setattr(config, 'WRITE_BUFFER_DELAY', 3600)
+
+    class Marker(Task):
+        buffer_writes = True
+
+        def each_run(self):
+            if self.run_doc['number'] % 2:
+                self.update({'_id': self.run_doc['_id']},
+                            {'$set': {'size': 1}})
+
+    snapshot = rundb.RunSnapshot(many_runs)
+    snapshot.expect(['Marker'])
+
+    # Tasks that run after Marker see its writes once it visited a run
+    seen = []
+    visited = snapshot.visited
+
+    def check_visited(name, run_id):
+        doc = snapshot.by_id[run_id]
+        seen.append(doc.get('size') == (1 if doc['number'] % 2 else None))
+        visited(name, run_id)
+
+    monkeypatch.setattr(snapshot, 'visited', check_visited)
+    Marker().go(snapshot=snapshot)
+    assert len(seen) == 25 and all(seen)
+    assert many_runs.count_documents({'size': 1}) == 12
+
+
+def test_ensure_indexes():
+    from cax import config
+    collection = config.mongo_collection('index_test')
+    try:
+        states = rundb.ensure_indexes(collection, create=False)
+        assert {state for _, state in states} == {'missing'}
+
+        # Built in the background, not locking the database meanwhile
+        models = []
+        create_indexes = collection.create_indexes
+        collection.create_indexes = lambda indexes: models.extend(indexes) or \
+            create_indexes(indexes)
+        rundb.ensure_indexes(collection)
+        assert all(model.document['background'] for model in models)
+
+        states = rundb.ensure_indexes(collection, create=False)
+        assert {state for _, state in states} == {'exists'}
+        assert len(collection.index_information()) == len(rundb.RUN_INDEXES) + 1
+    finally:
+        collection.drop()
+
+
+def test_plan_summary():
+    plan = {'stage': 'FETCH',
+            'inputStage': {'stage': 'OR',
+                           'inputStages': [{'stage': 'IXSCAN', 'indexName': 'last_modified_1'},
+                                           {'stage': 'IXSCAN', 'indexName': '_id_'}]}}
+    assert rundb.plan_summary(plan) == 'FETCH <- OR <- (IXSCAN last_modified_1, IXSCAN _id_)'
+
+    # mongomock cannot explain queries
+    query, sort = rundb.canonical_queries('midway-login1')['data here']
+    assert rundb.explain_query(runs_collection, query, sort).startswith('no plan')
+
+
+def test_iterate_runs_driver_sort(many_runs):
+    many_runs.update_many({}, {'$set': {'detector': 'tpc',
+                                        'data': [{'host': 'tsm-server', 'status': 'transferred',
+                                                  'location': '/tsm/run'}]}})
+    collection = FlakyCollection(many_runs, fail_after=5)
+    docs = list(rundb.iterate_runs(collection, projection=['number', 'data.host'],
+                                   sort=rundb.DRIVER_SORT, batch_size=4))
+    assert [doc['number'] for doc in docs] == list(reversed(range(25)))
+    assert docs[0]['data'] == [{'host': 'tsm-server'}]
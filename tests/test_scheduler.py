@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+from cax import scheduler
+
+
+def make_task(name, after=()):
+    return type(name, (), {'after': after})()
+
+
+def test_run_task_graph_order():
+    order = []
+    tasks = [make_task('AddChecksum', after=('CopyPull',)),
+             make_task('CopyPull'),
+             make_task('CopyPush'),
+             make_task('AddSize', after=('AddChecksum', 'NotSelected'))]
+
+    scheduler.run_task_graph(tasks, lambda task: order.append(task.__class__.__name__))
+    assert order == ['CopyPull', 'AddChecksum', 'CopyPush', 'AddSize']
+
+
+def test_run_task_graph_concurrent():
+    # Both independent tasks must be running at the same time to pass
+    barrier = threading.Barrier(2, timeout=5)
+    tasks = [make_task('CopyPull'), make_task('CopyPush')]
+    scheduler.run_task_graph(tasks, lambda task: barrier.wait(), max_workers=2)
+
+
+def test_run_task_graph_cycle():
+    tasks = [make_task('A', after=('B',)), make_task('B', after=('A',))]
+    with pytest.raises(ValueError):
+        scheduler.run_task_graph(tasks, lambda task: None)
+
+
+def test_adaptive_schedule():
+    schedule = scheduler.AdaptiveSchedule(interval=60, max_interval=300)
+    schedule.add('CopyPull')
+    schedule.add('AddChecksum', after=('CopyPull',))
+    assert schedule.due(now=0) == ['CopyPull', 'AddChecksum']
+
+    # Nothing to do: back off exponentially up to the maximum
+    for wait in (120, 240, 300, 300):
+        schedule.record('CopyPull', 0, now=0)
+        assert schedule.time_to_next_run('CopyPull', now=0) == wait
+
+    schedule.record('AddChecksum', 0, now=0)
+    assert schedule.due(now=100) == []
+
+    # Work found: back to the base interval, and what runs after it is due
+    schedule.record('CopyPull', 3, now=100)
+    assert schedule.time_to_next_run('CopyPull', now=100) == 60
+    assert schedule.due(now=100) == ['AddChecksum']
+
+    # A backlog is worked on right away
+    schedule.record('AddChecksum', 1, backlog=2, now=100)
+    assert schedule.time_to_next_run(now=100) == 0
+
+
+def test_adaptive_schedule_empty():
+    schedule = scheduler.AdaptiveSchedule(max_interval=300)
+    assert schedule.due(now=0) == []
+    assert schedule.time_to_next_run(now=0) == 300
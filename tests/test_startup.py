@@ -0,0 +1,84 @@
+"""Check the command line tools and the cax modules start quickly
+
+pax, hax, sympy and ROOT take seconds to import, so cax must only import them
+in the code paths that use them.
+"""
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+SETUP_PY = os.path.join(os.path.dirname(__file__), '..', 'setup.py')
+CAX_DIR = os.path.join(os.path.dirname(__file__), '..', 'cax')
+
+# Modules that must not be imported when a command starts
+HEAVY_MODULES = ('pax', 'hax', 'sympy', 'ROOT')
+
+# Seconds a command may take to import cax
+STARTUP_BUDGET = 3
+
+
+def entry_points():
+    with open(SETUP_PY) as f:
+        return re.findall(r"'([\w-]+) = ([\w.]+):(\w+)'", f.read())
+
+
+def cax_modules():
+    """Every module of cax, so that those whose dependencies are installed
+    are checked even where some commands cannot be imported
+    """
+    modules = []
+    for package in ('cax', 'cax.tasks'):
+        directory = os.path.join(CAX_DIR, *package.split('.')[1:])
+        modules.extend('%s.%s' % (package, name[:-3])
+                       for name in sorted(os.listdir(directory))
+                       if name.endswith('.py') and name != '__init__.py')
+    return modules
+
+
+IMPORT_SCRIPT = """
+import sys, time
+
+class BlockHeavyModules:
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] in {heavy!r}:
+            raise ImportError("%s imported at startup" % name)
+
+sys.meta_path.insert(0, BlockHeavyModules())
+t0 = time.time()
+import {module}
+{function} and getattr({module}, {function})
+print(time.time() - t0)
+"""
+
+
+def check_import(module, function=None, skip_missing=True):
+    result = subprocess.run([sys.executable, '-c',
+                             IMPORT_SCRIPT.format(module=module, function=repr(function),
+                                                  heavy=HEAVY_MODULES)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+
+    # Skip only for a missing third party dependency, never for cax itself
+    # or a heavy module imported at startup
+    missing = re.search(r"ModuleNotFoundError: No module named '([\w.]+)'",
+                        result.stderr)
+    if skip_missing and missing and missing.group(1).split('.')[0] != 'cax':
+        pytest.skip("Dependency of %s not installed: %s" %
+                    (module, missing.group(1)))
+    assert result.returncode == 0, result.stderr
+    assert float(result.stdout) < STARTUP_BUDGET
+
+
+@pytest.mark.parametrize('module', cax_modules())
+def test_module_startup(module):
+    check_import(module)
+
+
+@pytest.mark.parametrize('script,module,function', entry_points())
+def test_startup(script, module, function):
+    # The commands import what only some of them need, e.g. scp for the
+    # transfer tasks, when they run
+    check_import(module, function, skip_missing=False)
@@ -0,0 +1,106 @@
+import argparse
+import io
+import json
+import logging
+import os
+
+from cax import config, worker
+from .common import runs_collection
+
+
+def fake_commands():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--once', action='store_true')
+    parser.add_argument('--name', type=str)
+    parser.add_argument('--log', type=str, default='info')
+    parser.add_argument('--log-file', dest='logfile', type=str)
+
+    def run(args):
+        assert args.once
+        print('Processing', args.name)
+        logging.debug('Details of %s', args.name)
+        if args.name == 'bad':
+            raise RuntimeError('no such run')
+
+    return {'cax': (lambda: parser, run)}
+
+
+def test_serve(monkeypatch, tmpdir):
+    monkeypatch.setattr(worker, 'commands', fake_commands)
+    logfile = str(tmpdir.join('run.log'))
+
+    stdin = io.StringIO(json.dumps(['--name', 'good', '--log', 'debug',
+                                    '--log-file', logfile]) + '\n' +
+                        json.dumps(['--name', 'bad']) + '\n')
+    stdout = io.StringIO()
+    worker.serve('cax', stdin=stdin, stdout=stdout)
+
+    messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    done = [message for message in messages if message.get('done')]
+    assert [message['ok'] for message in done] == [True, False]
+    assert 'no such run' in done[1]['error']
+
+    logs = [message['log'] for message in messages if 'log' in message]
+    assert logs[:2] == ['Processing good', 'Details of good']
+    with open(logfile) as f:
+        assert 'Details of good' in f.read()
+
+
+def test_worker_pool_restarts_dead_workers(monkeypatch):
+    started = []
+
+    class FakeWorker:
+        def __init__(self, command, setup=''):
+            started.append(self)
+            self.dead = False
+
+        def alive(self):
+            return not self.dead
+
+        def run(self, job_args, log):
+            log('working on %s' % job_args[1], logging.INFO)
+            if job_args[1] == 'crash':
+                self.dead = True
+                return 'worker died with exit code 1'
+            return None
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(worker, 'Worker', FakeWorker)
+    pool = worker.WorkerPool('cax', workers=2)
+    jobs = [(['--name', name], name) for name in ('a', 'crash', 'b', 'c')]
+    results = {name: error for name, error, _ in pool.run(jobs)}
+    pool.close()
+
+    assert set(results) == {'a', 'crash', 'b', 'c'}
+    assert results['crash'] is not None and results['a'] is None
+    assert 2 <= len(started) <= 3
+
+
+def test_run_job_leaves_nothing_open(monkeypatch):
+    from cax import main
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--once', action='store_true')
+    parser.add_argument('--log', type=str, default='info')
+    parser.add_argument('--log-file', dest='logfile', type=str)
+    parser.set_defaults(incremental=False, max_interval=3600, threads=1)
+
+    def run(args):
+        config.mongo_client('mongodb://localhost:27017/', connect=False)
+        main.run_daemon([], None, args)
+
+    monkeypatch.setattr(worker, 'commands', lambda: {'cax': (lambda: parser, run)})
+    writer = worker.ProtocolWriter(io.StringIO())
+
+    def open_fds():
+        return len(os.listdir('/proc/self/fd'))
+
+    assert worker.run_job('cax', [], writer) is None
+    fds = open_fds()
+    for _ in range(5):
+        assert worker.run_job('cax', [], writer) is None
+        assert not config._CONFIG_PINNED
+        assert not config.mongo_clients()[1]
+    assert open_fds() == fds